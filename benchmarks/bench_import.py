@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+
+"""Benchmarks for the startup latency of the moonshine package and CLI.
+
+Every case runs in a fresh interpreter, the fastest of ``--repeat`` runs is
+reported.  With ``--max-ms`` the script fails when a case is slower, so it
+can guard startup latency in CI::
+
+    python benchmarks/bench_import.py
+    python benchmarks/bench_import.py --repeat 20 --max-ms 150
+
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# modules that must not be loaded before a command needs them
+HEAVY = ("alembic", "sqlalchemy")
+
+PROBE = """
+import sys, time
+start = time.perf_counter()
+%s
+elapsed = time.perf_counter() - start
+print(elapsed)
+print(",".join(name for name in %r if name in sys.modules))
+"""
+
+HELP = """
+from moonshine import cli
+try:
+    cli.main(["--help"])
+except SystemExit:
+    pass
+"""
+
+CASES = (
+    ("import moonshine", "import moonshine", True),
+    ("import moonshine.cli", "import moonshine.cli", True),
+    ("moonshine --help", HELP, True),
+    ("import Moonshine", "from moonshine import Moonshine", False),
+)
+
+
+def probe(code):
+    env = dict(os.environ, PYTHONPATH=ROOT)
+    output = subprocess.check_output(
+        [sys.executable, "-c", PROBE % (code, HEAVY)],
+        env=env,
+        universal_newlines=True,
+    )
+    lines = output.splitlines()
+    return float(lines[-2]), [name for name in lines[-1].split(",") if name]
+
+
+def run(repeat):
+    results = []
+    for name, code, light in CASES:
+        timings = []
+        for _ in range(repeat):
+            elapsed, loaded = probe(code)
+            timings.append(elapsed)
+        best = min(timings)
+        results.append(
+            dict(name=name, seconds=best, loaded=loaded, light=light)
+        )
+        print(
+            "%-24s %10.2fms  %s" % (name, best * 1000, ",".join(loaded) or "-")
+        )
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument(
+        "--max-ms",
+        type=float,
+        help="fail when a case that should stay light takes longer",
+    )
+    parser.add_argument("--json", help="write the results to this file")
+    args = parser.parse_args(argv)
+
+    results = run(args.repeat)
+    if args.json:
+        with open(args.json, "w") as file_:
+            json.dump(
+                dict(repeat=args.repeat, results=results), file_, indent=2
+            )
+
+    failed = []
+    for result in results:
+        if not result["light"]:
+            continue
+        if result["loaded"]:
+            failed.append(
+                "%s loaded %s" % (result["name"], ", ".join(result["loaded"]))
+            )
+        if args.max_ms and result["seconds"] * 1000 > args.max_ms:
+            failed.append(
+                "%s took %.2fms, more than %.2fms"
+                % (result["name"], result["seconds"] * 1000, args.max_ms)
+            )
+    for message in failed:
+        print("FAIL: %s" % message, file=sys.stderr)
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,209 @@
+#!/usr/bin/env python
+
+"""Benchmarks for migration planning and execution.
+
+Generates a synthetic revision tree in a temporary directory and times the
+Moonshine operations that walk it, reporting wall time and peak memory::
+
+    python benchmarks/bench_moonshine.py --revisions 10000 --shape linear
+    python benchmarks/bench_moonshine.py --revisions 5000 --shape wide --index
+
+"""
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from moonshine import Moonshine  # noqa: E402
+
+REVISION_TEMPLATE = '''"""%(message)s
+
+Revision ID: %(revision)s
+Revises: %(down_revision)s
+
+"""
+from alembic import op
+
+
+revision = %(revision)r
+down_revision = %(down_revision)r
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.execute(%(upgrade)r)
+
+
+def downgrade():
+    pass
+'''
+
+
+def _rev_id(number):
+    return "%012x" % number
+
+
+def _write_revision(versions, number, down_revision, upgrade):
+    revision = _rev_id(number)
+    path = os.path.join(versions, "%s_bench.py" % revision)
+    with open(path, "w") as file_:
+        file_.write(
+            REVISION_TEMPLATE
+            % dict(
+                message="bench revision %d" % number,
+                revision=revision,
+                down_revision=down_revision,
+                upgrade=upgrade,
+            )
+        )
+    return revision
+
+
+def generate_linear(versions, count):
+    """A single chain of ``count`` revisions."""
+    down = _write_revision(
+        versions, 0, None, "CREATE TABLE bench (n INTEGER)"
+    )
+    for number in range(1, count):
+        down = _write_revision(
+            versions, number, down, "UPDATE bench SET n = n + 1"
+        )
+
+
+def generate_wide(versions, count, width=8, span=4):
+    """Repeated branch points of ``width`` branches of ``span`` revisions,
+    each closed by a merge revision, up to ``count`` revisions.
+
+    """
+    number = 0
+    down = _write_revision(
+        versions, number, None, "CREATE TABLE bench (n INTEGER)"
+    )
+    number += 1
+    while number < count:
+        tips = []
+        for _ in range(width):
+            tip = down
+            for _ in range(span):
+                if number >= count - 1:
+                    break
+                tip = _write_revision(
+                    versions, number, tip, "UPDATE bench SET n = n + 1"
+                )
+                number += 1
+            tips.append(tip)
+        tips = tuple(sorted(set(tips)))
+        down = _write_revision(
+            versions,
+            number,
+            tips if len(tips) > 1 else tips[0],
+            "UPDATE bench SET n = 0",
+        )
+        number += 1
+
+
+def measure(name, fn, results):
+    tracemalloc.start()
+    start = time.perf_counter()
+    fn()
+    elapsed = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    results.append(dict(name=name, seconds=elapsed, peak_bytes=peak))
+    print("%-24s %10.4fs %12.1f KiB" % (name, elapsed, peak / 1024.0))
+
+
+def run(count, shape, index):
+    workdir = tempfile.mkdtemp(prefix="moonshine_bench_")
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    try:
+        config_file = os.path.join(workdir, "moonshine.ini")
+        Moonshine(config_file=config_file).init("migrations")
+        versions = os.path.join(workdir, "migrations", "versions")
+        if shape == "wide":
+            generate_wide(versions, count)
+        else:
+            generate_linear(versions, count)
+
+        url = "sqlite:///%s" % os.path.join(workdir, "bench.db")
+
+        def moonshine():
+            return Moonshine(
+                config_file=config_file,
+                engine_config={"sqlalchemy.url": url},
+                revision_index=True if index else False,
+            )
+
+        head = moonshine().heads()[0].revision
+        results = []
+        print(
+            "%d revisions, %s shape%s"
+            % (count, shape, ", revision index" if index else "")
+        )
+        measure("load + heads", lambda: moonshine().heads(), results)
+        measure("load + history", lambda: moonshine().history(), results)
+        measure("load + show", lambda: moonshine().show(head), results)
+        measure("load + branches", lambda: moonshine().branches, results)
+
+        warm = moonshine()
+        warm.heads()
+        measure("warm history", warm.history, results)
+        measure("warm branches", lambda: warm.branches, results)
+        measure(
+            "warm iter_history(10)",
+            lambda: list(warm.iter_history(limit=10)),
+            results,
+        )
+        measure(
+            "upgrade(sql=True)",
+            lambda: warm.upgrade("head", sql=True),
+            results,
+        )
+        measure(
+            "upgrade(sql=True) stream",
+            lambda: warm.upgrade(
+                "head", sql=True, output_buffer=lambda text: None
+            ),
+            results,
+        )
+        return results
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(workdir)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--revisions", type=int, default=1000)
+    parser.add_argument("--shape", choices=("linear", "wide"), default="linear")
+    parser.add_argument(
+        "--index", action="store_true", help="use the revision index"
+    )
+    parser.add_argument("--json", help="write the results to this file")
+    args = parser.parse_args(argv)
+
+    results = run(args.revisions, args.shape, args.index)
+    if args.json:
+        with open(args.json, "w") as file_:
+            json.dump(
+                dict(
+                    revisions=args.revisions,
+                    shape=args.shape,
+                    index=args.index,
+                    results=results,
+                ),
+                file_,
+                indent=2,
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -4,4 +4,22 @@ __author__ = """Jaco Labuschagne"""
 __email__ = "zodimo@gmail.com"
 __version__ = "0.1.5"
 
-from .moonshine import Moonshine
+import sys
+
+__all__ = ["Moonshine"]
+
+if sys.version_info >= (3, 7):
+    # load alembic and SQLAlchemy only once Moonshine is used, see PEP 562
+
+    def __getattr__(name):
+        if name == "Moonshine":
+            from .moonshine import Moonshine
+
+            globals()["Moonshine"] = Moonshine
+            return Moonshine
+        raise AttributeError(
+            "module %r has no attribute %r" % (__name__, name)
+        )
+
+else:
+    from .moonshine import Moonshine
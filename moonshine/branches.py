@@ -0,0 +1,239 @@
+"""Upgrade independent branches of one database concurrently.
+
+A revision graph with separate branches, one per module or team, is
+upgraded one revision at a time on a single connection.  :func:`.groups`
+splits the pending revisions into groups that share no revision, no
+``depends_on`` edge, no row of the version table and no table, as far as
+the revision sources tell, and :func:`.upgrade_branches` runs each group on
+its own connection.
+
+As alembic's ``context`` and ``op`` proxies are process wide, the groups
+run in forked worker processes, like :func:`.fleet.run_many` does.  Every
+group moves its own rows of the version table only, so the version table
+ends up the same as after a serial upgrade; the version store is synced
+from it once all groups are done.  Groups whose tables can not be told,
+such as those with ``op.execute``, run one after the other once the
+concurrent groups are done.
+
+"""
+import copy
+import logging
+import multiprocessing
+import os
+import time
+import traceback
+
+from alembic.runtime.migration import MigrationContext
+from sqlalchemy.engine import Engine
+
+from .fleet import FleetResult
+from .plan import script_tables
+
+logger = logging.getLogger(__name__)
+
+
+class Group:
+    """Pending revisions to be upgraded together.
+
+    :param heads: the revisions to upgrade to, in order.
+
+    :param revisions: every pending revision of the group.
+
+    :param tables: names of the tables the group touches, ``None`` if they
+     are not known.
+
+    """
+
+    def __init__(self, heads, revisions, tables):
+        self.heads = heads
+        self.revisions = revisions
+        self.tables = tables
+
+    @property
+    def concurrent(self):
+        return self.tables is not None
+
+    def __repr__(self):
+        return "Group(%r, %d revisions)" % (self.heads, len(self.revisions))
+
+
+def _ancestors(script_directory, revisions):
+    found = set()
+    todo = list(revisions)
+    while todo:
+        revision = todo.pop()
+        if revision in found:
+            continue
+        found.add(revision)
+        script = script_directory.get_revision(revision)
+        todo.extend(script._all_down_revisions)
+    return found
+
+
+class _Partition:
+    # union-find over revision ids and table names
+
+    def __init__(self):
+        self.parent = {}
+
+    def find(self, item):
+        parent = self.parent.setdefault(item, item)
+        if parent != item:
+            parent = self.parent[item] = self.find(parent)
+        return parent
+
+    def union(self, a, b):
+        self.parent[self.find(a)] = self.find(b)
+
+
+def groups(script_directory, current_heads, revision="heads"):
+    """Split the revisions between ``current_heads`` and ``revision`` into
+    independent :class:`.Group` objects.
+
+    Revisions are grouped together when one is a down revision or a
+    dependency of the other, when both build on the same current head, as
+    they would move the same version table row, or when they touch a table
+    in common.
+
+    """
+    targets = [
+        script.revision for script in script_directory.get_revisions(revision)
+    ]
+    current_heads = set(current_heads)
+    applied = _ancestors(script_directory, current_heads)
+    pending = _ancestors(script_directory, targets) - applied
+
+    partition = _Partition()
+    tables = {}
+    for revision in pending:
+        partition.find(("revision", revision))
+        script = script_directory.get_revision(revision)
+        for down in script._all_down_revisions:
+            if down in pending or down in current_heads:
+                partition.union(("revision", revision), ("revision", down))
+        tables[revision] = script_tables(script.path, "upgrade")
+        for table in tables[revision] or ():
+            partition.union(("revision", revision), ("table", table))
+
+    members = {}
+    for revision in pending:
+        root = partition.find(("revision", revision))
+        members.setdefault(root, set()).add(revision)
+
+    found = []
+    for revisions in members.values():
+        heads = [target for target in targets if target in revisions]
+        touched = set()
+        for revision in revisions:
+            if tables[revision] is None:
+                touched = None
+                break
+            touched.update(tables[revision])
+        found.append(Group(heads, revisions, touched))
+
+    # a group of unknown tables may still share one with any other group
+    found.sort(key=lambda group: (not group.concurrent, group.heads))
+    return found
+
+
+def _upgrade_group(moonshine, group, tag):
+    start = time.time()
+    output = error = None
+    try:
+        output = "".join(
+            moonshine.upgrade(head, tag=tag) or "" for head in group.heads
+        )
+    except Exception:
+        error = traceback.format_exc()
+        logger.error("upgrade failed for branch %s", ", ".join(group.heads))
+    return FleetResult(
+        tuple(group.heads),
+        output=output,
+        elapsed=time.time() - start,
+        error=error,
+    )
+
+
+_worker = {}
+
+
+def _init_worker(moonshine, tag):
+    moonshine._after_fork()
+    _worker["moonshine"] = moonshine
+    _worker["tag"] = tag
+
+
+def _pool_run(group):
+    return _upgrade_group(_worker["moonshine"], group, _worker["tag"])
+
+
+def upgrade_branches(moonshine, revision="heads", tag=None, max_workers=None):
+    """Upgrade the database of ``moonshine`` to ``revision``, running
+    independent :func:`.groups` concurrently.
+
+    The ``migration_lock`` of ``moonshine``, if any, is held around all
+    groups, not taken by each of them.
+
+    :return: list of :class:`.FleetResult`, one per group, whose target is
+     the tuple of the group's heads.
+
+    """
+    engine = moonshine.engine
+    lock = moonshine._migration_lock(engine)
+    with moonshine._locked(lock, engine, revision) as pending:
+        if not pending:
+            return []
+        return _upgrade_branches(moonshine, revision, tag, max_workers)
+
+
+def _upgrade_branches(moonshine, revision, tag, max_workers):
+    engine = moonshine.engine
+    script_directory = moonshine.script_directory
+    moonshine.invalidate_current()
+    found = groups(
+        script_directory, moonshine._get_current_heads(engine), revision
+    )
+    concurrent = [group for group in found if group.concurrent]
+    serial = [group for group in found if not group.concurrent]
+    if max_workers is None:
+        max_workers = os.cpu_count() or 1
+    max_workers = min(max_workers, len(concurrent))
+    logger.info(
+        "Upgrading %d branch group(s), %d concurrently",
+        len(found),
+        len(concurrent) if max_workers > 1 else 0,
+    )
+
+    # run on a copy so that the caller's caches are left alone; the
+    # revision map is built before forking and shared by the workers
+    script_directory.revision_map.heads
+    worker = copy.copy(moonshine)
+    worker.migration_lock = False
+
+    if (
+        max_workers <= 1
+        or "fork" not in multiprocessing.get_all_start_methods()
+    ):
+        serial = concurrent + serial
+        results = []
+    else:
+        # create the version tables and the row of the version store up
+        # front, not racing in every worker
+        with engine.begin() as connection:
+            MigrationContext.configure(connection)._ensure_version_table()
+            moonshine.version_store.sync(connection)
+        # pooled connections must not be shared with the forked workers
+        if isinstance(engine, Engine):
+            engine.dispose()
+        context = multiprocessing.get_context("fork")
+        with context.Pool(
+            max_workers, initializer=_init_worker, initargs=(worker, tag)
+        ) as pool:
+            results = pool.map(_pool_run, concurrent, chunksize=1)
+
+    results.extend(_upgrade_group(worker, group, tag) for group in serial)
+    # each group wrote the heads it saw, the version table has them all
+    with engine.begin() as connection:
+        moonshine.version_store.sync(connection)
+    moonshine.invalidate_current()
+    return results
@@ -1,7 +1,10 @@
-"""Console script for moonshine."""
-import sys
+"""Console script for moonshine.
+
+Only click is imported up front; alembic and SQLAlchemy are loaded by the
+command that runs, so ``moonshine --help`` and friends start quickly.
+
+"""
 import click
-from moonshine import Moonshine
 
 CONTEXT_SETTINGS = dict(help_option_names=["-h", "--help"])
 
@@ -30,6 +33,8 @@ CONTEXT_SETTINGS = dict(help_option_names=["-h", "--help"])
     help="Write empty __init__.py files to the environment and version locations.",
 )
 def init(directory, template, package):
+    from moonshine.moonshine import Moonshine
+
     moonshine = Moonshine()
     moonshine.init(directory=directory, template=template, package=package)
 
@@ -111,6 +116,7 @@ def revision(
       .. versionadded:: 0.9.0
 
     """
+    from moonshine.moonshine import Moonshine
 
     Moonshine().revision(
         message=message,
@@ -163,6 +169,8 @@ def merge(revisions, message=None, branch_label=None, rev_id=None):
         :ref:`branches`
 
     """
+    from moonshine.moonshine import Moonshine
+
     Moonshine().merge(
         revisions=revisions,
         message=message,
@@ -171,6 +179,239 @@ def merge(revisions, message=None, branch_label=None, rev_id=None):
     )
 
 
+def runtime_options(fn):
+    """Options shared by the commands that read or change a database."""
+    for option in reversed(
+        (
+            click.option(
+                "-c",
+                "--config",
+                default="moonshine.ini",
+                envvar="ALEMBIC_CONFIG",
+                type=click.STRING,
+                help="Path to the configuration file. default=moonshine.ini",
+            ),
+            click.option(
+                "--url",
+                envvar="MOONSHINE_URL",
+                type=click.STRING,
+                help="Database url, default from sqlalchemy.url in the "
+                "configuration file",
+            ),
+            click.option(
+                "--socket",
+                "socket_path",
+                envvar="MOONSHINE_SOCKET",
+                type=click.STRING,
+                help="Send the command to the 'moonshine serve' daemon "
+                "listening on this Unix socket",
+            ),
+        )
+    ):
+        fn = option(fn)
+    return fn
+
+
+def run_command(command, config, url, socket_path, **kw):
+    """Run ``command`` here, or in the daemon when a socket is given, and
+    print its output.
+
+    """
+    from moonshine import server
+
+    if socket_path:
+        response = server.request(socket_path, command, url=url, **kw)
+        if response["error"]:
+            raise click.ClickException(response["error"])
+        output = response["output"]
+    else:
+        from alembic import util
+        from moonshine.moonshine import Moonshine
+
+        try:
+            output = server.execute(
+                Moonshine(config_file=config), command, url=url, **kw
+            )
+        except util.CommandError as err:
+            raise click.ClickException(str(err))
+    if output:
+        click.echo(output, nl=not output.endswith("\n"))
+
+
+@click.command()
+@click.argument("revision", default="head")
+@click.option(
+    "--sql",
+    is_flag=True,
+    help="Don't emit SQL to database - dump to standard output instead",
+)
+@click.option(
+    "--tag",
+    type=click.STRING,
+    help="Arbitrary 'tag' name - can be used by custom env.py scripts",
+)
+@runtime_options
+def upgrade(revision, sql, tag, config, url, socket_path):
+    """Upgrade to a later version."""
+    run_command(
+        "upgrade",
+        config,
+        url,
+        socket_path,
+        revision=revision,
+        sql=sql,
+        tag=tag,
+    )
+
+
+@click.command()
+@click.argument("revision")
+@click.option(
+    "--sql",
+    is_flag=True,
+    help="Don't emit SQL to database - dump to standard output instead",
+)
+@click.option(
+    "--tag",
+    type=click.STRING,
+    help="Arbitrary 'tag' name - can be used by custom env.py scripts",
+)
+@runtime_options
+def downgrade(revision, sql, tag, config, url, socket_path):
+    """Revert to a previous version."""
+    run_command(
+        "downgrade",
+        config,
+        url,
+        socket_path,
+        revision=revision,
+        sql=sql,
+        tag=tag,
+    )
+
+
+@click.command()
+@click.argument("revisions", nargs=-1, required=True)
+@click.option(
+    "--sql",
+    is_flag=True,
+    help="Don't emit SQL to database - dump to standard output instead",
+)
+@click.option(
+    "--tag",
+    type=click.STRING,
+    help="Arbitrary 'tag' name - can be used by custom env.py scripts",
+)
+@click.option(
+    "--purge",
+    is_flag=True,
+    help="Unconditionally erase the version table before stamping",
+)
+@runtime_options
+def stamp(revisions, sql, tag, purge, config, url, socket_path):
+    """'stamp' the revision table with the given revision; don't run any
+    migrations.
+
+    """
+    run_command(
+        "stamp",
+        config,
+        url,
+        socket_path,
+        revision=list(revisions),
+        sql=sql,
+        tag=tag,
+        purge=purge,
+    )
+
+
+@click.command()
+@click.option("-v", "--verbose", is_flag=True, help="Use more verbose output")
+@runtime_options
+def current(verbose, config, url, socket_path):
+    """Display the current revision for a database."""
+    run_command("current", config, url, socket_path, verbose=verbose)
+
+
+@click.command()
+@click.option(
+    "-r",
+    "--rev-range",
+    type=click.STRING,
+    help="Specify a revision range; format is [start]:[end]",
+)
+@click.option(
+    "-i",
+    "--indicate-current",
+    is_flag=True,
+    help="Indicate the current revision",
+)
+@click.option("-v", "--verbose", is_flag=True, help="Use more verbose output")
+@runtime_options
+def history(rev_range, indicate_current, verbose, config, url, socket_path):
+    """List changeset scripts in chronological order."""
+    run_command(
+        "history",
+        config,
+        url,
+        socket_path,
+        rev_range=rev_range,
+        indicate_current=indicate_current,
+        verbose=verbose,
+    )
+
+
+@click.command()
+@click.option(
+    "--resolve-dependencies",
+    is_flag=True,
+    help="Treat dependency versions as down revisions",
+)
+@click.option("-v", "--verbose", is_flag=True, help="Use more verbose output")
+@runtime_options
+def heads(resolve_dependencies, verbose, config, url, socket_path):
+    """Show current available heads in the script directory."""
+    run_command(
+        "heads",
+        config,
+        url,
+        socket_path,
+        resolve_dependencies=resolve_dependencies,
+        verbose=verbose,
+    )
+
+
+@click.command()
+@click.option(
+    "-c",
+    "--config",
+    default="moonshine.ini",
+    envvar="ALEMBIC_CONFIG",
+    type=click.STRING,
+    help="Path to the configuration file. default=moonshine.ini",
+)
+@click.option(
+    "--socket",
+    "socket_path",
+    default="moonshine.sock",
+    envvar="MOONSHINE_SOCKET",
+    type=click.STRING,
+    help="Unix socket to listen on. default=moonshine.sock",
+)
+def serve(config, socket_path):
+    """Keep the script directory and engine pools warm and answer commands
+    sent with --socket.
+
+    """
+    from moonshine import server
+    from moonshine.moonshine import Moonshine
+
+    moonshine = Moonshine(config_file=config, reuse_environment=True)
+    moonshine.script_directory.revision_map.heads
+    click.echo("Listening on %s" % socket_path)
+    server.serve(moonshine, socket_path)
+
+
 @click.group()
 def main(args=None):
     pass
@@ -179,6 +420,13 @@ def main(args=None):
 main.add_command(init)
 main.add_command(revision)
 main.add_command(merge)
+main.add_command(upgrade)
+main.add_command(downgrade)
+main.add_command(stamp)
+main.add_command(current)
+main.add_command(history)
+main.add_command(heads)
+main.add_command(serve)
 
 if __name__ == "__main__":
     main()
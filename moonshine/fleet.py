@@ -0,0 +1,437 @@
+"""Run Moonshine commands against many databases at once.
+
+Alembic installs ``alembic.context`` and ``alembic.op`` as process wide
+proxies while ``env.py`` runs, so migrations can not safely share a process.
+Targets are therefore fanned out over a pool of forked worker processes,
+which inherit the parent's already loaded ``ScriptDirectory`` instead of
+importing every revision file again.
+
+Most databases of a fleet sit on one of a few revisions.  :func:`.survey`
+groups the targets by their current heads and :func:`.upgrade_grouped`
+renders the ``--sql`` script once per group, then executes its statements
+on every member, without running ``env.py`` again.
+
+"""
+import asyncio
+import copy
+import logging
+import multiprocessing
+import os
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+from alembic import util
+from alembic.runtime.migration import MigrationContext
+from sqlalchemy.engine import Engine
+from sqlalchemy.engine.url import make_url
+
+from .version_store import file_checksum
+
+logger = logging.getLogger(__name__)
+
+
+class FleetResult:
+    """Outcome of running a command against a single target."""
+
+    def __init__(self, target, output=None, elapsed=0.0, error=None):
+        self.target = target
+        self.output = output
+        self.elapsed = elapsed
+        self.error = error
+
+    @property
+    def ok(self):
+        return self.error is None
+
+    def __repr__(self):
+        return "FleetResult(%r, ok=%r, elapsed=%.3f)" % (
+            self.target,
+            self.ok,
+            self.elapsed,
+        )
+
+
+def target_name(target):
+    """Return a printable name for an engine, engine config or url.
+
+    Passwords are masked.
+
+    """
+    if isinstance(target, Engine) or hasattr(target, "sync_engine"):
+        return repr(target.url)
+    if isinstance(target, dict):
+        target = target.get("sqlalchemy.url", "")
+    return repr(make_url(target))
+
+
+def _run_target(moonshine, command, target, args, kw):
+    start = time.time()
+    output = error = None
+    try:
+        moonshine.engine = target
+        output = getattr(moonshine, command)(*args, **kw)
+    except Exception:
+        error = traceback.format_exc()
+        logger.error("%s failed for %s", command, target_name(target))
+    return FleetResult(
+        target_name(target),
+        output=output,
+        elapsed=time.time() - start,
+        error=error,
+    )
+
+
+_worker = {}
+
+
+def _init_worker(moonshine, targets):
+    moonshine._after_fork()
+    _worker["moonshine"] = moonshine
+    _worker["targets"] = targets
+
+
+def _pool_run(job):
+    index, command, args, kw = job
+    return _run_target(
+        _worker["moonshine"], command, _worker["targets"][index], args, kw
+    )
+
+
+def run_many(moonshine, command, targets, args=(), kw=None, max_workers=None):
+    """Run ``command`` of ``moonshine`` once per target.
+
+    :param moonshine: the :class:`.Moonshine` whose script directory and
+     configuration are shared by every target.
+
+    :param command: name of the :class:`.Moonshine` method to call.
+
+    :param targets: iterable of engines, engine config dicts or urls.
+
+    :param max_workers: upper bound of concurrent worker processes.
+
+    :return: list of :class:`.FleetResult`, in the order of ``targets``.
+
+    """
+    targets = list(targets)
+    kw = kw or {}
+    if max_workers is None:
+        max_workers = (os.cpu_count() or 1) + 4
+    max_workers = min(max_workers, len(targets))
+
+    # build the revision map once, before forking, so that every worker
+    # shares it instead of importing the versions directory itself
+    moonshine.script_directory.revision_map.heads
+
+    # run on a copy so that the caller's engine is left in place
+    moonshine = copy.copy(moonshine)
+
+    if (
+        max_workers <= 1
+        or "fork" not in multiprocessing.get_all_start_methods()
+    ):
+        return [
+            _run_target(moonshine, command, target, args, kw)
+            for target in targets
+        ]
+
+    # pooled connections must not be shared with the forked workers
+    for target in targets:
+        if isinstance(target, Engine):
+            target.dispose()
+
+    jobs = [(index, command, args, kw) for index in range(len(targets))]
+    context = multiprocessing.get_context("fork")
+    with context.Pool(
+        max_workers, initializer=_init_worker, initargs=(moonshine, targets)
+    ) as pool:
+        return pool.map(_pool_run, jobs, chunksize=1)
+
+
+def current_many(moonshine, targets, max_workers=None):
+    """Read the current revisions of many targets.
+
+    Reading the version table does not run ``env.py``, so unlike
+    :func:`.run_many` this runs on a thread pool, with one pooled engine per
+    url shared across calls.
+
+    :return: list of :class:`.FleetResult`, in the order of ``targets``.
+
+    """
+    targets = list(targets)
+    if max_workers is None:
+        max_workers = (os.cpu_count() or 1) + 4
+    max_workers = max(1, min(max_workers, len(targets)))
+
+    def current(target):
+        start = time.time()
+        output = error = None
+        try:
+            engine = moonshine._get_engine(target)
+            output = moonshine.script_directory.get_revisions(
+                moonshine._get_current_heads(engine)
+            )
+        except Exception:
+            error = traceback.format_exc()
+            logger.error("current failed for %s", target_name(target))
+        return FleetResult(
+            target_name(target),
+            output=output,
+            elapsed=time.time() - start,
+            error=error,
+        )
+
+    # load the revision map before the threads race to build it
+    moonshine.script_directory.revision_map.heads
+    with ThreadPoolExecutor(max_workers) as executor:
+        return list(executor.map(current, targets))
+
+
+async def current_many_async(moonshine, targets, concurrency=10):
+    """Read the current revisions of many targets through async engines,
+    at most ``concurrency`` at a time.
+
+    :return: list of :class:`.FleetResult`, in the order of ``targets``.
+
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+    # load the revision map before the tasks are scheduled
+    moonshine.script_directory.revision_map.heads
+
+    async def current(target):
+        async with semaphore:
+            start = time.time()
+            output = error = None
+            try:
+                output = await moonshine.current_async(target)
+            except Exception:
+                error = traceback.format_exc()
+                logger.error("current failed for %s", target_name(target))
+            return FleetResult(
+                target_name(target),
+                output=output,
+                elapsed=time.time() - start,
+                error=error,
+            )
+
+    return list(await asyncio.gather(*[current(t) for t in targets]))
+
+
+class Survey:
+    """Targets grouped by the heads of their version table.
+
+    :ivar groups: ``dict`` of sorted heads tuple to the list of targets.
+
+    :ivar failed: list of :class:`.FleetResult` of the targets whose version
+     table could not be read.
+
+    """
+
+    def __init__(self, groups, failed):
+        self.groups = groups
+        self.failed = failed
+
+    def __repr__(self):
+        return "Survey(%d groups, %d failed)" % (
+            len(self.groups),
+            len(self.failed),
+        )
+
+
+def _survey(moonshine, targets, max_workers):
+    """Return ``dict`` of heads to target indexes and the failed results."""
+    groups = {}
+    failed = []
+    results = current_many(moonshine, targets, max_workers=max_workers)
+    for index, result in enumerate(results):
+        if result.ok:
+            heads = tuple(sorted(sc.revision for sc in result.output))
+            groups.setdefault(heads, []).append(index)
+        else:
+            failed.append((index, result))
+    return groups, failed
+
+
+def survey(moonshine, targets, max_workers=None):
+    """Read the version tables of many targets concurrently and group the
+    targets by their current heads.
+
+    :return: :class:`.Survey`
+
+    """
+    targets = list(targets)
+    groups, failed = _survey(moonshine, targets, max_workers)
+    return Survey(
+        dict(
+            (heads, [targets[index] for index in indexes])
+            for heads, indexes in groups.items()
+        ),
+        [result for index, result in failed],
+    )
+
+
+class _StatementSink:
+    """``--sql`` output buffer that keeps each statement on its own.
+
+    Alembic writes every statement, comment and transaction marker of an
+    offline script with a single ``write``.
+
+    """
+
+    skip = ("BEGIN", "COMMIT", "GO")
+
+    def __init__(self, terminator=";"):
+        self.terminator = terminator
+        self.statements = []
+
+    def write(self, text):
+        text = text.strip()
+        if text.endswith(self.terminator):
+            text = text[: -len(self.terminator)].rstrip()
+        if text and not text.startswith("--") and text not in self.skip:
+            self.statements.append(text)
+
+    def flush(self):
+        pass
+
+
+def _creates_table(statement, table):
+    words = statement.split(None, 3)
+    return (
+        len(words) > 2
+        and [word.upper() for word in words[:2]] == ["CREATE", "TABLE"]
+        and words[2].split("(")[0].split(".")[-1].strip('"`[]') == table
+    )
+
+
+def _apply_statements(moonshine, target, heads, statements, steps=()):
+    """Execute the rendered ``statements`` on ``target`` in one
+    transaction, after checking that it still sits on ``heads``, and bring
+    the version store up to date in the same transaction, recording
+    ``steps``, ``(revision, direction, checksum)`` tuples.  The
+    ``migration_lock``, if any, is held meanwhile.
+
+    """
+    engine = moonshine._get_engine(target)
+    lock = moonshine._migration_lock(engine)
+    with moonshine._locked(lock, engine, None), engine.begin() as conn:
+        context = MigrationContext.configure(conn)
+        current = tuple(sorted(context.get_current_heads()))
+        if current != heads:
+            raise util.CommandError(
+                "%s moved from %s to %s since the survey"
+                % (target_name(target), heads, current)
+            )
+        if context._has_version_table():
+            # the script of a group at base creates it, but a database
+            # downgraded to base has it already, empty
+            statements = [
+                statement
+                for statement in statements
+                if not _creates_table(statement, context.version_table)
+            ]
+        execute = getattr(conn, "exec_driver_sql", conn.execute)
+        for statement in statements:
+            execute(statement)
+        store = moonshine.version_store
+        for revision, direction, checksum in steps:
+            store.record(conn, revision, direction, checksum=checksum)
+        store.sync(conn)
+
+
+def upgrade_grouped(
+    moonshine, targets, revision="head", tag=None, max_workers=None
+):
+    """Upgrade many targets, rendering the migration once per group of
+    targets that share their current heads.
+
+    The ``--sql`` script of each group is rendered by
+    :meth:`.Moonshine.upgrade` and its statements are then executed on every
+    member, in one transaction per member, concurrently on a thread pool.
+    Revisions that read from the database while migrating can not be
+    rendered offline and must be applied with :func:`.run_many` instead.
+
+    :return: list of :class:`.FleetResult`, in the order of ``targets``,
+     whose output is the :class:`.Plan` that was applied.
+
+    """
+    targets = list(targets)
+    if max_workers is None:
+        max_workers = (os.cpu_count() or 1) + 4
+    max_workers = max(1, min(max_workers, len(targets)))
+
+    groups, failed = _survey(moonshine, targets, max_workers)
+    results = [None] * len(targets)
+    for index, result in failed:
+        results[index] = result
+
+    # the script is rendered in the dialect of the targets it runs on
+    rendered = {}
+    for heads, indexes in groups.items():
+        for index in indexes:
+            dialect = moonshine._get_engine(targets[index]).dialect.name
+            rendered.setdefault((heads, dialect), []).append(index)
+
+    jobs = []
+    for (heads, dialect), indexes in rendered.items():
+        start = time.time()
+        plan = statements = error = None
+        try:
+            plan = moonshine.plan(revision, from_=heads, downgrade=False)
+            statements = []
+            steps = []
+            if plan:
+                steps = [
+                    (
+                        step["revision"],
+                        step["direction"],
+                        file_checksum(step["path"]),
+                    )
+                    for step in plan.steps
+                ]
+                sink = _StatementSink()
+                moonshine.upgrade(
+                    "%s:%s" % (",".join(heads) or "base", revision),
+                    sql=True,
+                    tag=tag,
+                    output_buffer=sink,
+                    engine=targets[indexes[0]],
+                )
+                statements = sink.statements
+        except Exception:
+            error = traceback.format_exc()
+            logger.error("rendering the upgrade from %s failed", heads)
+        for index in indexes:
+            if error is None:
+                jobs.append((index, heads, plan, statements, steps))
+            else:
+                results[index] = FleetResult(
+                    target_name(targets[index]),
+                    elapsed=time.time() - start,
+                    error=error,
+                )
+
+    def apply(job):
+        index, heads, plan, statements, steps = job
+        target = targets[index]
+        start = time.time()
+        error = None
+        try:
+            if statements:
+                _apply_statements(
+                    moonshine, target, heads, statements, steps
+                )
+        except Exception:
+            error = traceback.format_exc()
+            logger.error("upgrade failed for %s", target_name(target))
+        results[index] = FleetResult(
+            target_name(target),
+            output=plan if error is None else None,
+            elapsed=time.time() - start,
+            error=error,
+        )
+
+    with ThreadPoolExecutor(max_workers) as executor:
+        list(executor.map(apply, jobs))
+    moonshine.invalidate_current()
+    return results
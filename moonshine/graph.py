@@ -0,0 +1,203 @@
+"""Compact in-memory revision graph.
+
+Alembic's revision map holds a :class:`.Script` per revision, with its
+module, docstring and a dozen derived attributes, for the life of the
+:class:`.ScriptDirectory`.  The :class:`.RevisionGraph` keeps only the
+identifiers, parents, branch labels and dependencies of each revision in
+``__slots__`` nodes, read from the :class:`.RevisionIndex` without
+importing the revision files.  That is enough to answer ``heads`` and
+``current``; the :class:`.Script` of a node is imported only when it is
+asked for, one file at a time.
+
+"""
+import bisect
+import logging
+import os
+
+from alembic import util
+from alembic.script import Script
+
+from .index import RevisionIndex, _as_tuple
+
+logger = logging.getLogger(__name__)
+
+
+class Node:
+    """A revision of the :class:`.RevisionGraph`.
+
+    Attributes that are not part of the graph, such as ``doc``, ``module``
+    or ``cmd_format``, are those of the revision's :class:`.Script`, which
+    is imported on first use.
+
+    """
+
+    __slots__ = (
+        "revision",
+        "down_revisions",
+        "dependencies",
+        "branch_labels",
+        "path",
+        "nextrev",
+        "_graph",
+        "_script",
+    )
+
+    def __init__(
+        self, graph, revision, down_revisions, dependencies, labels, path
+    ):
+        self._graph = graph
+        self.revision = revision
+        self.down_revisions = down_revisions
+        self.dependencies = dependencies
+        self.branch_labels = labels
+        self.path = path
+        self.nextrev = ()
+        self._script = None
+
+    @property
+    def down_revision(self):
+        if not self.down_revisions:
+            return None
+        if len(self.down_revisions) == 1:
+            return self.down_revisions[0]
+        return self.down_revisions
+
+    @property
+    def is_head(self):
+        return not self.nextrev
+
+    @property
+    def is_base(self):
+        return not self.down_revisions
+
+    @property
+    def is_branch_point(self):
+        return len(self.nextrev) > 1
+
+    @property
+    def is_merge_point(self):
+        return len(self.down_revisions) > 1
+
+    @property
+    def script(self):
+        """The full :class:`.Script`, imported from :attr:`.path` alone."""
+        if self._script is None:
+            dir_, filename = os.path.split(self.path)
+            script = Script._from_filename(
+                self._graph.script_directory, dir_, filename
+            )
+            # the relations alembic's revision map would have set
+            script.nextrev = script._all_nextrev = frozenset(self.nextrev)
+            self._script = script
+        return self._script
+
+    def __getattr__(self, name):
+        return getattr(self.script, name)
+
+    def __repr__(self):
+        return "Node(%r)" % self.revision
+
+
+class RevisionGraph:
+    """The revision graph of ``script_directory``.
+
+    :param index_path: location of a :class:`.RevisionIndex` file to read
+     and update, or ``None`` to parse the revision files every time.
+
+    """
+
+    __slots__ = (
+        "script_directory",
+        "nodes",
+        "heads",
+        "bases",
+        "_ids",
+        "_labels",
+    )
+
+    def __init__(self, script_directory, index_path=None):
+        self.script_directory = script_directory
+        index = RevisionIndex(index_path)
+        if index_path is not None:
+            index.load()
+        entries = index.refresh(script_directory)
+        if index_path is not None:
+            try:
+                index.save()
+            except (IOError, OSError) as err:
+                logger.warning("Could not write revision index: %s", err)
+
+        self.nodes = nodes = {}
+        self._labels = labels = {}
+        for path, entry in entries:
+            node = Node(
+                self,
+                entry["revision"],
+                util.to_tuple(_as_tuple(entry["down_revision"]), default=()),
+                util.to_tuple(_as_tuple(entry["depends_on"]), default=()),
+                util.to_tuple(_as_tuple(entry["branch_labels"]), default=()),
+                path,
+            )
+            nodes[node.revision] = node
+            for label in node.branch_labels:
+                labels[label] = node
+        # the index entries, with their docstrings, are not kept
+
+        children = {}
+        for node in nodes.values():
+            for down in node.down_revisions:
+                children.setdefault(down, []).append(node.revision)
+        for revision, nextrev in children.items():
+            if revision in nodes:
+                nodes[revision].nextrev = tuple(nextrev)
+
+        self.heads = tuple(
+            node.revision for node in nodes.values() if node.is_head
+        )
+        self.bases = tuple(
+            node.revision for node in nodes.values() if node.is_base
+        )
+        self._ids = sorted(nodes)
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def get(self, identifier):
+        """Return the :class:`.Node` of a revision id, unique id prefix or
+        branch label.
+
+        :raises KeyError: if there is no such revision, or the prefix is
+         ambiguous.
+
+        """
+        node = self.nodes.get(identifier)
+        if node is not None:
+            return node
+        node = self._labels.get(identifier)
+        if node is not None:
+            return node
+        start = bisect.bisect_left(self._ids, identifier)
+        matches = []
+        for revision in self._ids[start:start + 2]:
+            if revision.startswith(identifier):
+                matches.append(revision)
+        if len(matches) != 1:
+            raise KeyError(identifier)
+        return self.nodes[matches[0]]
+
+    def get_revisions(self, identifiers):
+        """Return the nodes of ``identifiers``, like
+        :meth:`.ScriptDirectory.get_revisions` does for a revision id,
+        prefix, branch label, tuple of those or ``head``, ``heads`` and
+        ``base``.
+
+        :raises KeyError: for anything else.
+
+        """
+        if identifiers in ("head", "heads"):
+            if identifiers == "head" and len(self.heads) > 1:
+                raise KeyError(identifiers)
+            identifiers = self.heads
+        elif identifiers in (None, "base", ()):
+            return ()
+        return tuple(self.get(id_) for id_ in util.to_tuple(identifiers))
@@ -0,0 +1,265 @@
+"""Persistent index of the revision graph.
+
+Building a revision map the alembic way imports every file in the
+``versions/`` directories.  The :class:`.RevisionIndex` instead keeps the
+identifiers of each revision file in a small JSON file, keyed by the file's
+modification time, size and content hash, so that only new or changed files
+are parsed.  Revision modules are imported once a migration actually needs
+them.
+
+"""
+import ast
+import functools
+import hashlib
+import json
+import logging
+import os
+import re
+
+from alembic import util
+from alembic.script import Script, ScriptDirectory
+from alembic.script.revision import Revision, RevisionMap
+
+logger = logging.getLogger(__name__)
+
+INDEX_FILE = "revision_index.json"
+INDEX_FORMAT = 1
+
+_revision_file = re.compile(r"(?!\.\#|__init__)(.*\.py)$")
+
+_fields = ("revision", "down_revision", "branch_labels", "depends_on")
+
+
+def _literal_fields(source, path):
+    """Read the revision identifiers and docstring of a revision file
+    without importing it, or return None if they are not plain literals.
+
+    """
+    try:
+        tree = ast.parse(source, path)
+    except SyntaxError:
+        return None
+
+    values = {}
+    for node in tree.body:
+        if isinstance(node, ast.Assign) and len(node.targets) == 1:
+            target = node.targets[0]
+        elif isinstance(node, ast.AnnAssign) and node.value is not None:
+            target = node.target
+        else:
+            continue
+        if isinstance(target, ast.Name) and target.id in _fields:
+            try:
+                values[target.id] = ast.literal_eval(node.value)
+            except ValueError:
+                return None
+
+    if not isinstance(values.get("revision"), str):
+        return None
+    doc = ast.get_docstring(tree, clean=False) or ""
+    return dict(
+        revision=values["revision"],
+        down_revision=values.get("down_revision"),
+        branch_labels=values.get("branch_labels"),
+        depends_on=values.get("depends_on"),
+        doc=doc.strip(),
+    )
+
+
+def _imported_fields(script_directory, path):
+    """Read the revision identifiers of a revision file by importing it."""
+    dir_, filename = os.path.split(path)
+    script = Script._from_filename(script_directory, dir_, filename)
+    if script is None:
+        return None
+    return dict(
+        revision=script.revision,
+        down_revision=script.down_revision,
+        branch_labels=list(script._orig_branch_labels),
+        depends_on=script.dependencies,
+        doc=script.longdoc,
+    )
+
+
+def _as_tuple(value):
+    if isinstance(value, list):
+        return tuple(value)
+    return value
+
+
+class RevisionIndex:
+    """The on-disk index of the revision files of a script directory.
+
+    :param path: location of the JSON index file.
+
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}
+        self.parsed = 0
+        self._dirty = False
+
+    def load(self):
+        try:
+            with open(self.path) as file_:
+                data = json.load(file_)
+        except (IOError, ValueError):
+            return self
+        if data.get("format") == INDEX_FORMAT:
+            self.entries = data.get("files", {})
+        return self
+
+    def save(self):
+        if not self._dirty:
+            return
+        tmp_path = "%s.%d.tmp" % (self.path, os.getpid())
+        with open(tmp_path, "w") as file_:
+            json.dump(
+                {"format": INDEX_FORMAT, "files": self.entries},
+                file_,
+                sort_keys=True,
+            )
+        os.replace(tmp_path, self.path)
+        self._dirty = False
+
+    def entry(self, script_directory, path):
+        """Return the index entry of a revision file, parsing it only if
+        it changed since it was last indexed.
+
+        """
+        stat = os.stat(path)
+        entry = self.entries.get(path)
+        if (
+            entry is not None
+            and entry["mtime"] == stat.st_mtime
+            and entry["size"] == stat.st_size
+        ):
+            return entry
+
+        with open(path, "rb") as file_:
+            source = file_.read()
+        sha1 = hashlib.sha1(source).hexdigest()
+
+        if entry is None or entry["sha1"] != sha1:
+            self.parsed += 1
+            fields = _literal_fields(source, path)
+            if fields is None:
+                fields = _imported_fields(script_directory, path)
+            if fields is None:
+                return None
+            entry = dict(fields, sha1=sha1)
+
+        entry.update(mtime=stat.st_mtime, size=stat.st_size)
+        self.entries[path] = entry
+        self._dirty = True
+        return entry
+
+    def refresh(self, script_directory):
+        """Bring the index up to date with the version locations of
+        ``script_directory``.
+
+        :return: list of ``(path, entry)`` tuples, one per revision file.
+
+        """
+        if script_directory.version_locations:
+            locations = [
+                location
+                for location in script_directory._version_locations
+                if os.path.exists(location)
+            ]
+        else:
+            locations = [script_directory.versions]
+
+        seen = {}
+        for location in locations:
+            for filename in sorted(os.listdir(location)):
+                if not _revision_file.match(filename):
+                    continue
+                path = os.path.realpath(os.path.join(location, filename))
+                if path in seen:
+                    util.warn(
+                        "File %s loaded twice! ignoring. Please ensure "
+                        "version_locations is unique." % path
+                    )
+                    continue
+                entry = self.entry(script_directory, path)
+                if entry is not None:
+                    seen[path] = entry
+
+        if set(self.entries) != set(seen):
+            self.entries = seen
+            self._dirty = True
+        return list(seen.items())
+
+
+class IndexedScript(Script):
+    """A :class:`.Script` built from a :class:`.RevisionIndex` entry.
+
+    The revision module is imported the first time :attr:`.module` is used.
+    :attr:`.checksum` is the SHA-1 of the file when it was indexed.
+
+    """
+
+    def __init__(self, entry, path):
+        self.path = path
+        self.checksum = entry["sha1"]
+        self._longdoc = entry["doc"]
+        self._module = None
+        Revision.__init__(
+            self,
+            entry["revision"],
+            _as_tuple(entry["down_revision"]),
+            dependencies=util.to_tuple(
+                _as_tuple(entry["depends_on"]), default=()
+            ),
+            branch_labels=util.to_tuple(
+                _as_tuple(entry["branch_labels"]), default=()
+            ),
+        )
+
+    @property
+    def module(self):
+        if self._module is None:
+            dir_, filename = os.path.split(self.path)
+            self._module = util.load_python_file(dir_, filename)
+        return self._module
+
+    @property
+    def longdoc(self):
+        return self._longdoc
+
+
+def _load_indexed_revisions(script_directory, index_path):
+    index = RevisionIndex(index_path).load()
+    entries = index.refresh(script_directory)
+    try:
+        index.save()
+    except (IOError, OSError) as err:
+        logger.warning("Could not write revision index: %s", err)
+    if index.parsed:
+        logger.info("Indexed %d revision file(s)", index.parsed)
+
+    for path, entry in entries:
+        yield IndexedScript(entry, path)
+
+
+def indexed_script_directory(config, index_path=True):
+    """Produce a :class:`.ScriptDirectory` given a :class:`.Config` instance,
+    whose revision map is built from a :class:`.RevisionIndex` instead of
+    importing every revision file.
+
+    :param index_path: location of the index file; ``True`` places it in
+    the script directory.
+
+    """
+    script = ScriptDirectory.from_config(config)
+    if script.sourceless:
+        # compiled revision files can not be parsed, import them instead
+        return script
+    if index_path is True:
+        index_path = os.path.join(script.dir, INDEX_FILE)
+    script.revision_map = RevisionMap(
+        functools.partial(_load_indexed_revisions, script, index_path)
+    )
+    return script
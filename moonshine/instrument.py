@@ -0,0 +1,280 @@
+"""Instrumentation of migrations run by Moonshine.
+
+Listeners registered with :meth:`.Moonshine.listen` are called with the
+event name and a ``dict`` payload:
+
+``revision_start``
+    a migration step is about to run.
+
+``revision_end``
+    the step, including the version table update, finished; carries the
+    ``elapsed`` wall time, the number of ``statements`` executed, the summed
+    ``rowcount`` and the ``error``, if the step failed.
+
+``statement``
+    a statement was executed on the migration connection; carries the
+    ``statement`` text, its ``elapsed`` wall time and ``rowcount``.  Only
+    emitted online, as ``--sql`` mode executes nothing.
+
+``lock_wait``
+    a step failed on a lock or statement timeout, see
+    :mod:`moonshine.timeouts`; carries the ``kind`` of timeout, the time
+    ``waited`` in the step and the ``attempt``, counting from 0.
+
+:class:`.ReportCollector` is a ready made listener that builds a JSON report
+and Prometheus metrics from these events.
+
+"""
+import json
+import time
+
+from sqlalchemy import event
+
+from .timeouts import timeout_kind
+
+EVENTS = ("revision_start", "revision_end", "statement", "lock_wait")
+
+
+def _step_info(step):
+    return _migration_info(step.info)
+
+
+def _migration_info(info):
+    if info.is_stamp:
+        direction = "stamp"
+    elif info.is_upgrade:
+        direction = "upgrade"
+    else:
+        direction = "downgrade"
+    return dict(
+        revision=",".join(info.up_revision_ids),
+        up_revisions=list(info.up_revision_ids),
+        down_revisions=list(info.down_revision_ids),
+        direction=direction,
+    )
+
+
+class Run:
+    """Instrumentation of a single ``env.py`` run.
+
+    :param emit: callable taking the event name and its payload.
+
+    :param attempt: number of the run, counting from 0, when it is retried.
+
+    """
+
+    def __init__(self, emit, attempt=0):
+        self.emit = emit
+        self.attempt = attempt
+        self.step = None
+        self.connection = None
+
+    def wrap(self, fn):
+        """Wrap a migration function so that the steps it returns are
+        instrumented.
+
+        """
+
+        def instrumented(rev, context):
+            return self.steps(fn(rev, context), context)
+
+        return instrumented
+
+    def steps(self, steps, context):
+        self._listen(context.connection)
+        for step in steps:
+            self._start(step)
+            yield step
+            self._end()
+        self.close()
+
+    def close(self, error=None):
+        """Finish the step in progress, if any, and stop listening."""
+        if self.step is not None:
+            kind = timeout_kind(error) if error is not None else None
+            if kind is not None:
+                self.emit(
+                    "lock_wait",
+                    dict(
+                        time=time.time(),
+                        revision=self.step["revision"],
+                        direction=self.step["direction"],
+                        kind=kind,
+                        waited=time.perf_counter() - self._step_started,
+                        attempt=self.attempt,
+                    ),
+                )
+            self._end(error)
+        if self.connection is not None:
+            event.remove(
+                self.connection, "before_cursor_execute", self._before_execute
+            )
+            event.remove(
+                self.connection, "after_cursor_execute", self._after_execute
+            )
+            self.connection = None
+
+    def _listen(self, connection):
+        if connection is None or self.connection is not None:
+            return
+        event.listen(connection, "before_cursor_execute", self._before_execute)
+        event.listen(connection, "after_cursor_execute", self._after_execute)
+        self.connection = connection
+
+    def _start(self, step):
+        self.step = _step_info(step)
+        self.step.update(statements=0, rowcount=0)
+        self._step_started = time.perf_counter()
+        self.emit(
+            "revision_start",
+            dict(
+                time=time.time(),
+                revision=self.step["revision"],
+                up_revisions=self.step["up_revisions"],
+                down_revisions=self.step["down_revisions"],
+                direction=self.step["direction"],
+            ),
+        )
+
+    def _end(self, error=None):
+        step, self.step = self.step, None
+        step.update(
+            time=time.time(),
+            elapsed=time.perf_counter() - self._step_started,
+            error=None if error is None else repr(error),
+        )
+        self.emit("revision_end", step)
+
+    def _before_execute(
+        self, conn, cursor, statement, parameters, context, executemany
+    ):
+        self._statement_started = time.perf_counter()
+
+    def _after_execute(
+        self, conn, cursor, statement, parameters, context, executemany
+    ):
+        elapsed = time.perf_counter() - self._statement_started
+        rowcount = cursor.rowcount
+        if rowcount is not None and rowcount < 0:
+            rowcount = None
+        if self.step is not None:
+            self.step["statements"] += 1
+            self.step["rowcount"] += rowcount or 0
+        self.emit(
+            "statement",
+            dict(
+                time=time.time(),
+                revision=self.step["revision"] if self.step else None,
+                statement=statement,
+                elapsed=elapsed,
+                rowcount=rowcount,
+                executemany=executemany,
+            ),
+        )
+
+
+class ReportCollector:
+    """Collects instrumentation events into a report::
+
+        collector = ReportCollector().attach(moonshine)
+        moonshine.upgrade("head")
+        print(collector.to_json())
+
+    :param keep_statements: keep the text and timing of every statement in
+     the report, not only their counts.
+
+    """
+
+    def __init__(self, keep_statements=True):
+        self.keep_statements = keep_statements
+        self.revisions = []
+        self.lock_waits = []
+        self._statements = []
+
+    def attach(self, moonshine):
+        for name in EVENTS:
+            moonshine.listen(name, self)
+        return self
+
+    def __call__(self, name, payload):
+        if name == "statement":
+            if self.keep_statements:
+                self._statements.append(
+                    dict(
+                        statement=payload["statement"],
+                        elapsed=payload["elapsed"],
+                        rowcount=payload["rowcount"],
+                    )
+                )
+        elif name == "lock_wait":
+            self.lock_waits.append(dict(payload))
+        elif name == "revision_end":
+            revision = dict(payload)
+            if self.keep_statements:
+                revision["statement_log"] = self._statements
+            self._statements = []
+            self.revisions.append(revision)
+
+    def report(self):
+        """Return the collected events as a JSON serializable ``dict``."""
+        return dict(
+            revisions=self.revisions,
+            elapsed=sum(rev["elapsed"] for rev in self.revisions),
+            statements=sum(rev["statements"] for rev in self.revisions),
+            rowcount=sum(rev["rowcount"] for rev in self.revisions),
+            errors=sum(1 for rev in self.revisions if rev["error"]),
+            lock_waits=self.lock_waits,
+            lock_wait=sum(wait["waited"] for wait in self.lock_waits),
+        )
+
+    def to_json(self, **kw):
+        return json.dumps(self.report(), **kw)
+
+    def prometheus(self, prefix="moonshine"):
+        """Render the collected events in the Prometheus text format."""
+        report = self.report()
+        lines = [
+            "# HELP %s_revision_duration_seconds Wall time spent applying "
+            "a revision." % prefix,
+            "# TYPE %s_revision_duration_seconds gauge" % prefix,
+        ]
+        for rev in self.revisions:
+            lines.append(
+                '%s_revision_duration_seconds{revision="%s",direction="%s"} '
+                "%.6f"
+                % (prefix, rev["revision"], rev["direction"], rev["elapsed"])
+            )
+        waited = {}
+        for wait in self.lock_waits:
+            key = (wait["revision"], wait["direction"])
+            waited[key] = waited.get(key, 0.0) + wait["waited"]
+        lines.extend(
+            [
+                "# HELP %s_revision_lock_wait_seconds Time a revision spent "
+                "in steps that hit a lock or statement timeout." % prefix,
+                "# TYPE %s_revision_lock_wait_seconds counter" % prefix,
+            ]
+        )
+        for (revision, direction), seconds in sorted(waited.items()):
+            lines.append(
+                '%s_revision_lock_wait_seconds{revision="%s",direction="%s"} '
+                "%.6f" % (prefix, revision, direction, seconds)
+            )
+        for name, help_, value in (
+            ("statements_total", "Statements executed.", report["statements"]),
+            ("rows_total", "Rows affected by statements.", report["rowcount"]),
+            (
+                "revision_errors_total",
+                "Revisions that failed.",
+                report["errors"],
+            ),
+            (
+                "lock_timeouts_total",
+                "Steps that hit a lock or statement timeout.",
+                len(self.lock_waits),
+            ),
+        ):
+            lines.append("# HELP %s_%s %s" % (prefix, name, help_))
+            lines.append("# TYPE %s_%s counter" % (prefix, name))
+            lines.append("%s_%s %d" % (prefix, name, value))
+        return "\n".join(lines) + "\n"
@@ -0,0 +1,253 @@
+"""A database-wide lock so that only one process migrates at a time.
+
+When many processes start together, each calling ``upgrade("head")``, they
+would all plan the same migrations and race on the version table.  With
+``migration_lock`` set, :meth:`.Moonshine.upgrade`, ``downgrade`` and
+``stamp`` take a lock before running ``env.py`` and release it once done:
+
+* PostgreSQL: a session level advisory lock, keyed by a hash of the name.
+* MySQL and MariaDB: ``GET_LOCK``.
+* Other databases: a row in a ``moonshine_lock`` table, held as a lease
+  that expires after ``lease`` seconds.
+
+The lock is held on a connection of its own, so that it spans the
+transactions of the migration.  Advisory locks go away with that
+connection if the process dies; a lock row stays until its lease runs out,
+so the lease must be longer than the longest migration.
+
+Before taking the lock, and again once it is taken, an upgrade or
+downgrade reads the current heads and returns at once if the database is
+at the target already.  The processes that waited on the one that did the
+work then skip planning it again.
+
+"""
+import datetime
+import hashlib
+import logging
+import os
+import socket
+import struct
+import threading
+import time
+from contextlib import contextmanager
+
+from alembic import util
+from sqlalchemy import (
+    Column,
+    DateTime,
+    MetaData,
+    String,
+    Table,
+    and_,
+    exc,
+    sql,
+)
+
+logger = logging.getLogger(__name__)
+
+LOCK_NAME = "moonshine"
+
+#: default name of the table of :class:`.TableLock`
+LOCK_TABLE = "moonshine_lock"
+
+
+class MigrationLock:
+    """Base class of the migration locks.
+
+    :param name: name of the lock; processes migrating the same database
+     with the same name exclude each other.
+
+    :param timeout: seconds to wait for the lock before raising
+     :class:`.CommandError`, or ``None`` to wait as long as it takes.
+
+    :param poll_interval: seconds between attempts, for the locks that
+     can not block until they are free.
+
+    """
+
+    def __init__(self, name=LOCK_NAME, timeout=None, poll_interval=1.0):
+        self.name = name
+        self.timeout = timeout
+        self.poll_interval = poll_interval
+
+    def try_acquire(self, connection):
+        """Take the lock if it is free; return whether it was taken."""
+        raise NotImplementedError()
+
+    def acquire(self, connection):
+        """Take the lock, waiting up to ``timeout``; return whether it was
+        taken.
+
+        """
+        deadline = None
+        if self.timeout is not None:
+            deadline = time.monotonic() + self.timeout
+        while not self.try_acquire(connection):
+            if deadline is not None and time.monotonic() >= deadline:
+                return False
+            logger.info("Waiting for migration lock %r", self.name)
+            time.sleep(self.poll_interval)
+        return True
+
+    def release(self, connection):
+        raise NotImplementedError()
+
+    @contextmanager
+    def hold(self, engine):
+        """Hold the lock on a connection of its own for the duration of the
+        block.
+
+        """
+        with engine.connect() as connection:
+            if not self.acquire(connection):
+                raise util.CommandError(
+                    "Timed out after %ss waiting for migration lock %r"
+                    % (self.timeout, self.name)
+                )
+            try:
+                yield
+            finally:
+                self.release(connection)
+
+
+class PostgresAdvisoryLock(MigrationLock):
+    """A PostgreSQL session level advisory lock.
+
+    Each statement runs in a transaction of its own, committed at once, so
+    that the lock connection is not left idle in a transaction.
+
+    """
+
+    @property
+    def key(self):
+        digest = hashlib.sha1(self.name.encode("utf-8")).digest()
+        return struct.unpack(">q", digest[:8])[0]
+
+    def _select(self, connection, function):
+        with connection.begin():
+            return connection.execute(
+                sql.text("SELECT %s(:key)" % function), dict(key=self.key)
+            ).scalar()
+
+    def try_acquire(self, connection):
+        return self._select(connection, "pg_try_advisory_lock")
+
+    def acquire(self, connection):
+        if self.timeout is not None:
+            return MigrationLock.acquire(self, connection)
+        self._select(connection, "pg_advisory_lock")
+        return True
+
+    def release(self, connection):
+        self._select(connection, "pg_advisory_unlock")
+
+
+class MySQLLock(MigrationLock):
+    """A MySQL or MariaDB named lock."""
+
+    def try_acquire(self, connection):
+        return self._get_lock(connection, 0)
+
+    def acquire(self, connection):
+        timeout = -1 if self.timeout is None else self.timeout
+        return self._get_lock(connection, timeout)
+
+    def _get_lock(self, connection, timeout):
+        return (
+            connection.execute(
+                sql.text("SELECT GET_LOCK(:name, :timeout)"),
+                dict(name=self.name, timeout=timeout),
+            ).scalar()
+            == 1
+        )
+
+    def release(self, connection):
+        connection.execute(
+            sql.text("SELECT RELEASE_LOCK(:name)"), dict(name=self.name)
+        )
+
+
+class TableLock(MigrationLock):
+    """A row of ``table``, leased for ``lease`` seconds.
+
+    The table is created when first needed.
+
+    """
+
+    def __init__(self, table=LOCK_TABLE, lease=3600, **kw):
+        MigrationLock.__init__(self, **kw)
+        self.table = Table(
+            table,
+            MetaData(),
+            Column("name", String(255), primary_key=True),
+            Column("owner", String(255), nullable=False),
+            Column("expires_at", DateTime, nullable=False),
+        )
+        self.lease = lease
+
+    def _owner(self):
+        return "%s:%d:%d" % (
+            socket.gethostname(),
+            os.getpid(),
+            threading.get_ident(),
+        )
+
+    def _create(self, connection):
+        try:
+            with connection.begin():
+                self.table.create(connection, checkfirst=True)
+        except exc.DBAPIError:
+            # created by another process in the meantime
+            if not connection.dialect.has_table(connection, self.table.name):
+                raise
+
+    def try_acquire(self, connection):
+        self._create(connection)
+        table = self.table
+        now = datetime.datetime.utcnow()
+        try:
+            with connection.begin():
+                connection.execute(
+                    table.delete().where(
+                        and_(
+                            table.c.name == self.name,
+                            table.c.expires_at < now,
+                        )
+                    )
+                )
+                connection.execute(
+                    table.insert().values(
+                        name=self.name,
+                        owner=self._owner(),
+                        expires_at=now
+                        + datetime.timedelta(seconds=self.lease),
+                    )
+                )
+        except exc.IntegrityError:
+            return False
+        return True
+
+    def release(self, connection):
+        table = self.table
+        with connection.begin():
+            connection.execute(
+                table.delete().where(
+                    and_(
+                        table.c.name == self.name,
+                        table.c.owner == self._owner(),
+                    )
+                )
+            )
+
+
+#: lock classes by dialect name, :class:`.TableLock` for the others
+LOCKS = {
+    "postgresql": PostgresAdvisoryLock,
+    "mysql": MySQLLock,
+    "mariadb": MySQLLock,
+}
+
+
+def lock_for(dialect, **kw):
+    """Return the :class:`.MigrationLock` suited to ``dialect``."""
+    return LOCKS.get(dialect.name, TableLock)(**kw)
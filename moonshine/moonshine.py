@@ -4,15 +4,83 @@ logger = logging.getLogger(__name__)
 from alembic.runtime.environment import EnvironmentContext
 from alembic.script import ScriptDirectory
 from alembic.config import Config
-from alembic import util, autogenerate
+from alembic import util
+from alembic.autogenerate import RevisionContext
+from alembic.script.revision import RevisionError
 from sqlalchemy import engine_from_config, create_engine, MetaData
 from sqlalchemy.engine import Engine
-import os, sys, io
+from sqlalchemy.engine.url import URL
+import copy, functools, os, sys, io, itertools, threading, time, types
+import weakref
 from contextlib import contextmanager
+from . import instrument, timeouts
+from .version_store import TableVersionStore, VersionStore, alembic_heads
+from .plan import build_plan
+from .index import INDEX_FILE, indexed_script_directory
+
+# fleet (multiprocessing), asyncio and sqlalchemy.ext.asyncio are imported
+# on first use, they are not needed by the common commands
 
 
 ALEMBIC_CONFIG = os.environ.get("ALEMBIC_CONFIG", "moonshine.ini")
 
+NAMING_CONVENTION = {
+    "ix": "ix_%(column_0_N_name)s",
+    "uq": "uq_%(table_name)s_%(column_0_N_name)s",
+    "ck": "ck_%(table_name)s_%(constraint_name)s",
+    "fk": "fk_%(table_name)s_%(column_0_N_name)s_%(referred_table_name)s",
+    "pk": "pk_%(table_name)s",
+}
+
+# alembic's context and op proxies are process wide, so env.py runs must not
+# interleave: neither across threads, nor across tasks of one event loop
+_env_lock = threading.RLock()
+_async_env_locks = weakref.WeakKeyDictionary()
+
+
+def _reset_env_lock():
+    # a lock held by another thread at fork time would never be released
+    # in the child, which only runs the forking thread
+    global _env_lock
+    _env_lock = threading.RLock()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_env_lock)
+
+
+def _async_api():
+    """Return ``(AsyncEngine, create_async_engine)``, or ``(None, None)``
+    before SQLAlchemy 1.4.
+
+    """
+    try:
+        from sqlalchemy.ext.asyncio import AsyncEngine, create_async_engine
+    except ImportError:
+        return None, None
+    return AsyncEngine, create_async_engine
+
+
+def _is_async_engine(value):
+    # only an AsyncEngine can be passed in if the module is loaded already
+    if "sqlalchemy.ext.asyncio" not in sys.modules:
+        return False
+    AsyncEngine = _async_api()[0]
+    return AsyncEngine is not None and isinstance(value, AsyncEngine)
+
+
+def _path_option(value):
+    """Read an ini option that is either a boolean or a path: ``True`` when
+    ``value`` is true, ``None`` when it is false or missing, otherwise the
+    path.
+
+    """
+    if value is None or value.strip().lower() in ("", "false"):
+        return None
+    if util.asbool(value):
+        return True
+    return value
+
 
 class Moonshine:
     """
@@ -22,29 +90,65 @@ class Moonshine:
     Commands not implemented(yet):
         list_templates      
         edit
-
-    AUTO-GENERATE NOT SUPPORTED
     """
 
     __config = None
     __engine = None
+    __async_engine = None
     __script_directory = None
     __environment_context = None
-
-    target_metadata = MetaData(
-        naming_convention={
-            "ix": "ix_%(column_0_N_name)s",
-            "uq": "uq_%(table_name)s_%(column_0_N_name)s",
-            "ck": "ck_%(table_name)s_%(constraint_name)s",
-            "fk": "fk_%(table_name)s_%(column_0_N_name)s_%(referred_table_name)s",
-            "pk": "pk_%(table_name)s",
-        }
-    )
+    __env_code = None
+    __current_cache = None
+    __engines = None
+    __history_cache = None
+    __branches = None
+    __listeners = None
+    __plans = None
+    __graph = None
+    __version_store = None
+    __lock = None
 
     def __init__(
-        self, config_file=ALEMBIC_CONFIG, engine=None, engine_config=None,
+        self,
+        config_file=ALEMBIC_CONFIG,
+        engine=None,
+        engine_config=None,
+        revision_index=None,
+        reuse_environment=False,
+        current_ttl=None,
+        transaction_per_migration=False,
+        lock_timeout=None,
+        statement_timeout=None,
+        retries=0,
+        retry_backoff=1.0,
+        target_metadata=None,
+        compact_revisions=None,
+        reflection_cache=None,
+        version_store=None,
+        migration_lock=None,
     ):
         self.config = Config(file_=config_file)
+        if target_metadata is None:
+            target_metadata = MetaData(naming_convention=NAMING_CONVENTION)
+        self.target_metadata = target_metadata
+        self.revision_index = revision_index
+        self.reuse_environment = reuse_environment
+        self.current_ttl = current_ttl
+        self.transaction_per_migration = transaction_per_migration
+        self.lock_timeout = lock_timeout
+        self.statement_timeout = statement_timeout
+        self.retries = retries
+        self.retry_backoff = retry_backoff
+        self.compact_revisions = compact_revisions
+        self.reflection_cache = reflection_cache
+        self.__version_store = version_store
+        self.migration_lock = migration_lock
+        self.__current_cache = {}
+        self.__engines = {}
+        self.__history_cache = {}
+        self.__listeners = {}
+        self.__plans = {}
+        self.__lock = threading.RLock()
         if engine is not None:
             self.engine = engine
         elif engine_config is not None:
@@ -84,9 +188,198 @@ class Moonshine:
     def script_directory(self) -> ScriptDirectory:
         if isinstance(self.__script_directory, ScriptDirectory):
             return self.__script_directory
-        self.__script_directory = ScriptDirectory.from_config(self.config)
+        with self.__lock:
+            if self.__script_directory is None:
+                self.__script_directory = self._load_script_directory()
         return self.__script_directory
 
+    def _revision_index_path(self):
+        revision_index = self.revision_index
+        if revision_index is None:
+            revision_index = _path_option(
+                self.config.get_main_option("revision_index")
+            )
+        return revision_index or None
+
+    def _load_script_directory(self):
+        revision_index = self._revision_index_path()
+        if revision_index:
+            return indexed_script_directory(self.config, revision_index)
+        return ScriptDirectory.from_config(self.config)
+
+    def _reflection_cache(self):
+        from .reflection import CACHE_FILE, ReflectionCache
+
+        path = self.reflection_cache
+        if path is None:
+            path = _path_option(
+                self.config.get_main_option("reflection_cache")
+            )
+        if path is True:
+            path = os.path.join(self.script_directory.dir, CACHE_FILE)
+        return ReflectionCache(path or None).load()
+
+    @property
+    def revision_graph(self):
+        """The compact :class:`.RevisionGraph` of the script directory,
+        used by ``heads``, ``current`` and ``show`` when
+        ``compact_revisions`` is set.
+
+        """
+        graph = self.__graph
+        if graph is not None:
+            return graph
+        from .graph import RevisionGraph
+
+        with self.__lock:
+            if self.__graph is None:
+                script = self.script_directory
+                index_path = self._revision_index_path()
+                if index_path is True:
+                    index_path = os.path.join(script.dir, INDEX_FILE)
+                self.__graph = RevisionGraph(script, index_path)
+            return self.__graph
+
+    @property
+    def version_store(self):
+        """The :class:`.VersionStore` the current heads are read from and
+        applied revisions recorded in: a :class:`.TableVersionStore` when
+        ``version_store`` is true, alembic's version table otherwise.
+
+        """
+        store = self.__version_store
+        if isinstance(store, VersionStore):
+            return store
+        with self.__lock:
+            store = self.__version_store
+            if store is None:
+                store = util.asbool(
+                    self.config.get_main_option("version_store")
+                )
+            if store is True:
+                store = TableVersionStore()
+            elif not isinstance(store, VersionStore):
+                store = VersionStore()
+            self.__version_store = store
+        return store
+
+    def _migration_lock(self, engine):
+        """The :class:`.MigrationLock` taken around migrations on
+        ``engine``, or ``None``.
+
+        """
+        lock = self.migration_lock
+        if lock is None:
+            lock = util.asbool(self.config.get_main_option("migration_lock"))
+        if lock is True:
+            from .lock import lock_for
+
+            lock = lock_for(engine.dialect)
+        return lock or None
+
+    def _bookkeeping_tables(self):
+        """Names of the tables Moonshine keeps its own state in: those of
+        the version store, the migration lock and the checkpoints of
+        :mod:`moonshine.operations`, by their default names and by the
+        names configured here.
+
+        """
+        from .lock import LOCK_TABLE, TableLock
+        from .operations import progress_table
+        from .version_store import HISTORY_TABLE, VERSION_TABLE
+
+        names = {VERSION_TABLE, HISTORY_TABLE, LOCK_TABLE, progress_table.name}
+        store = self.version_store
+        if isinstance(store, TableVersionStore):
+            names.update([store.table.name, store.history_table.name])
+        if isinstance(self.migration_lock, TableLock):
+            names.add(self.migration_lock.table.name)
+        return names
+
+    def _at_revision(self, engine, revision):
+        """Whether the heads of ``engine`` are exactly ``revision``."""
+        try:
+            targets = self._get_revisions(revision)
+        except (util.CommandError, RevisionError):
+            # relative identifiers, several heads for "head"
+            return False
+        # not from the version store, which catches up with versions
+        # changed without it only when a run goes ahead
+        with engine.connect() as conn:
+            heads = alembic_heads(conn)
+        return set(heads) == set(script.revision for script in targets)
+
+    @contextmanager
+    def _locked(self, lock, engine, revision):
+        """Hold ``lock`` for the block, which gets whether there is
+        anything to do: not when the database is at ``revision`` already.
+
+        """
+        if lock is None:
+            yield True
+            return
+        if revision is not None and self._at_revision(engine, revision):
+            yield False
+            return
+        with lock.hold(engine):
+            # another process may have done the work while we waited
+            yield revision is None or not self._at_revision(engine, revision)
+
+    def _use_graph(self):
+        compact = self.compact_revisions
+        if compact is None:
+            compact = util.asbool(
+                self.config.get_main_option("compact_revisions")
+            )
+        return compact and not self.script_directory.sourceless
+
+    def _get_revisions(self, identifiers):
+        """``get_revisions`` from the compact revision graph if enabled,
+        from the script directory otherwise.
+
+        """
+        if self._use_graph():
+            try:
+                return self.revision_graph.get_revisions(identifiers)
+            except KeyError:
+                # relative and qualified identifiers, or unknown ones
+                # which the script directory reports properly
+                pass
+        return self.script_directory.get_revisions(identifiers)
+
+    def listen(self, event, fn):
+        """Call ``fn(event, payload)`` whenever ``event`` happens during
+        ``upgrade``, ``downgrade`` or ``stamp``.
+
+        :param event: one of ``revision_start``, ``revision_end`` or
+        ``statement``; see :mod:`moonshine.instrument`.
+
+        """
+        if event not in instrument.EVENTS:
+            raise util.CommandError("No such event %r" % event)
+        self.__listeners.setdefault(event, []).append(fn)
+
+    def _emit(self, event, payload):
+        for fn in self.__listeners.get(event, ()):
+            fn(event, payload)
+
+    def invalidate(self):
+        """Forget the loaded script directory and compiled ``env.py`` so
+        that both are read from disk again on next use.
+
+        """
+        self.__script_directory = None
+        self.__environment_context = None
+        self.__env_code = None
+        self._revisions_changed()
+
+    def _revisions_changed(self):
+        """Drop everything memoized from the revision graph."""
+        self.__history_cache.clear()
+        self.__branches = None
+        self.__plans.clear()
+        self.__graph = None
+
     @property
     def engine(self):
         assert (
@@ -99,9 +392,25 @@ class Moonshine:
         if isinstance(value, Engine):
             self.__engine = value
 
-        if isinstance(value, dict):
+        elif isinstance(value, dict):
             self.__engine = engine_from_config(value)
 
+        elif isinstance(value, (str, URL)):
+            self.__engine = create_engine(value)
+
+        elif _is_async_engine(value):
+            self.__async_engine = value
+
+        else:
+            raise TypeError("Unsupported engine type %r" % type(value))
+
+    @property
+    def async_engine(self):
+        assert (
+            self.__async_engine is not None
+        ), "SQLAchemy AsyncEngine is not configured."
+        return self.__async_engine
+
     @property
     def environment_context(self) -> EnvironmentContext:
         if isinstance(self.__environment_context, EnvironmentContext):
@@ -115,10 +424,25 @@ class Moonshine:
     @contextmanager
     def migration_context(self):
         with self.engine.connect() as conn:
-            env = self.environment_context
+            # configure a context of our own, the shared one may be in use
+            env = EnvironmentContext(
+                self._call_config(), self.script_directory
+            )
             env.configure(connection=conn)
             yield env.get_context()
 
+    def _call_config(self):
+        """Return a copy of the configuration for a single call.
+
+        The parsed file is shared, the ``attributes`` passed on to
+        ``env.py`` are not, so that calls from several threads do not see
+        each other's engine or output buffer.
+
+        """
+        config = copy.copy(self.config)
+        config.attributes = dict(self.config.attributes)
+        return config
+
     def get_template_directory(self):
         """Return the directory where Moonshine setup templates are found.
 
@@ -203,6 +527,7 @@ class Moonshine:
         rev_id=None,
         depends_on=None,
         process_revision_directives=None,
+        autogenerate=False,
     ):
         """Create a new revision file.
 
@@ -239,10 +564,19 @@ class Moonshine:
 
         .. versionadded:: 0.9.0
 
+        :param autogenerate: whether or not to autogenerate the script from
+        the database, comparing it to ``target_metadata``; this is the
+        ``--autogenerate`` option to ``alembic revision``.  The database is
+        reflected in bulk, and the reflected tables are kept in the
+        ``reflection_cache`` file when one is configured; see
+        :mod:`moonshine.reflection`.  The tables Moonshine keeps its own
+        state in are left out of the comparison, as alembic does with its
+        version table.
+
         """
         command_args = dict(
             message=message,
-            autogenerate=False,
+            autogenerate=autogenerate,
             sql=False,
             head=head,
             splice=splice,
@@ -251,14 +585,36 @@ class Moonshine:
             rev_id=rev_id,
             depends_on=depends_on,
         )
-        revision_context = autogenerate.RevisionContext(
+        revision_context = RevisionContext(
             self.config,
             self.script_directory,
             command_args,
             process_revision_directives=process_revision_directives,
         )
 
+        if autogenerate:
+            from . import reflection
+
+            cache = self._reflection_cache()
+
+            def retrieve_migrations(rev, context):
+                reflection.run_autogenerate(
+                    revision_context,
+                    rev,
+                    context,
+                    cache,
+                    exclude_tables=self._bookkeeping_tables(),
+                )
+                return []
+
+            self._run_env(
+                retrieve_migrations,
+                template_args=revision_context.template_args,
+                revision_context=revision_context,
+            )
+
         scripts = [script for script in revision_context.generate_scripts()]
+        self._revisions_changed()
         if len(scripts) == 1:
             return scripts[0]
         else:
@@ -282,7 +638,7 @@ class Moonshine:
 
         """
 
-        return self.script_directory.generate_revision(
+        script = self.script_directory.generate_revision(
             rev_id or util.rev_id(),
             message,
             refresh=True,
@@ -290,11 +646,26 @@ class Moonshine:
             branch_labels=branch_label,
             config=self.config,
         )
+        self._revisions_changed()
+        return script
 
-    def upgrade(self, revision, sql=False, tag=None):
+    def upgrade(
+        self,
+        revision,
+        sql=False,
+        tag=None,
+        output_buffer=None,
+        transaction_per_migration=None,
+        connection=None,
+        lock_timeout=None,
+        statement_timeout=None,
+        retries=None,
+        engine=None,
+    ):
         """Upgrade to a later version.
 
-        :param revision: string revision target or range for --sql mode
+        :param revision: string revision target or range for --sql mode;
+        the start of a range may list several heads separated by commas.
 
         :param sql: if True, use ``--sql`` mode
 
@@ -302,38 +673,110 @@ class Moonshine:
         ``env.py`` scripts via the :meth:`.EnvironmentContext.get_tag_argument`
         method.
 
+        :param output_buffer: file-like object or callable that receives the
+        ``--sql`` output as it is generated, instead of returning it.
+
+        :param transaction_per_migration: commit each revision, together
+        with its version table update, in its own transaction; defaults to
+        the instance setting.  A failed upgrade then resumes from the last
+        committed revision when retried.
+
+        :param connection: run on this connection instead of one checked out
+        from the engine.
+
+        :param lock_timeout: seconds a statement may wait on a lock; see
+        :mod:`moonshine.timeouts`.  Defaults to the instance setting.
+
+        :param statement_timeout: seconds a statement may run.  Defaults to
+        the instance setting.
+
+        :param retries: number of times a run that hit a timeout is tried
+        again, after a jittered exponential backoff.  Defaults to the
+        instance setting.
+
+        :param engine: engine, engine config dict or url to run on instead of
+        the instance's engine, so that threads can share one instance.
+
         """
-        config = self.config
         script = self.script_directory
-        config.attributes["engine"] = self.engine
-        config.attributes["target_metadata"] = self.target_metadata
-
-        output_buffer = io.StringIO()
-        config.attributes["output_buffer"] = output_buffer
 
         starting_rev = None
         if ":" in revision:
             if not sql:
                 raise util.CommandError("Range revision not allowed")
             starting_rev, revision = revision.split(":", 2)
+            if "," in starting_rev:
+                # several heads to start from
+                starting_rev = starting_rev.split(",")
 
         def do_upgrade(rev, context):
             return script._upgrade_revs(revision, rev)
 
-        with EnvironmentContext(
-            config,
-            script,
-            fn=do_upgrade,
-            as_sql=sql,
+        return self._run_env(
+            do_upgrade,
+            sql=sql,
+            output_buffer=output_buffer,
+            transaction_per_migration=transaction_per_migration,
+            connection=connection,
+            engine=engine,
+            lock_timeout=lock_timeout,
+            statement_timeout=statement_timeout,
+            retries=retries,
+            target=revision,
             starting_rev=starting_rev,
             destination_rev=revision,
             tag=tag,
-        ):
-            script.run_env()
-            output_buffer.seek(0)
-            return output_buffer.read()
+        )
+
+    def upgrade_many(
+        self, targets, revision, sql=False, tag=None, max_workers=None
+    ):
+        """Upgrade many databases to a later version, concurrently.
+
+        Every target runs the same upgrade against the script directory of
+        this instance, which is loaded once and shared by all workers.  A
+        failing target does not stop the others.
+
+        :param targets: iterable of engines, engine config dicts or urls
+
+        :param revision: string revision target or range for --sql mode
+
+        :param sql: if True, use ``--sql`` mode
 
-    def downgrade(self, revision, sql=False, tag=None):
+        :param tag: an arbitrary "tag" that can be intercepted by custom
+        ``env.py`` scripts via the :meth:`.EnvironmentContext.get_tag_argument`
+        method.
+
+        :param max_workers: maximum number of targets upgraded at once.
+
+        :return: list of :class:`.FleetResult` in the order of ``targets``,
+        each carrying the output, the elapsed time and the error, if any.
+
+        """
+        from . import fleet
+
+        return fleet.run_many(
+            self,
+            "upgrade",
+            targets,
+            args=(revision,),
+            kw=dict(sql=sql, tag=tag),
+            max_workers=max_workers,
+        )
+
+    def downgrade(
+        self,
+        revision,
+        sql=False,
+        tag=None,
+        output_buffer=None,
+        transaction_per_migration=None,
+        connection=None,
+        lock_timeout=None,
+        statement_timeout=None,
+        retries=None,
+        engine=None,
+    ):
         """Revert to a previous version.
 
         :param revision: string revision target or range for --sql mode
@@ -344,14 +787,29 @@ class Moonshine:
         ``env.py`` scripts via the :meth:`.EnvironmentContext.get_tag_argument`
         method.
 
+        :param output_buffer: file-like object or callable that receives the
+        ``--sql`` output as it is generated, instead of returning it.
+
+        :param transaction_per_migration: commit each revision, together
+        with its version table update, in its own transaction; defaults to
+        the instance setting.
+
+        :param connection: run on this connection instead of one checked out
+        from the engine.
+
+        :param lock_timeout: seconds a statement may wait on a lock.
+
+        :param statement_timeout: seconds a statement may run.
+
+        :param retries: number of times a run that hit a timeout is tried
+        again.
+
+        :param engine: engine, engine config dict or url to run on instead of
+        the instance's engine.
+
         """
 
-        config = self.config
         script = self.script_directory
-        config.attributes["engine"] = self.engine
-
-        output_buffer = io.StringIO()
-        config.attributes["output_buffer"] = output_buffer
 
         starting_rev = None
         if ":" in revision:
@@ -366,18 +824,70 @@ class Moonshine:
         def do_downgrade(rev, context):
             return script._downgrade_revs(revision, rev)
 
-        with EnvironmentContext(
-            config,
-            script,
-            fn=do_downgrade,
-            as_sql=sql,
+        return self._run_env(
+            do_downgrade,
+            sql=sql,
+            output_buffer=output_buffer,
+            transaction_per_migration=transaction_per_migration,
+            connection=connection,
+            engine=engine,
+            lock_timeout=lock_timeout,
+            statement_timeout=statement_timeout,
+            retries=retries,
+            target=revision,
             starting_rev=starting_rev,
             destination_rev=revision,
             tag=tag,
-        ):
-            script.run_env()
-            output_buffer.seek(0)
-            return output_buffer.read()
+        )
+
+    def plan(self, target, from_=None, downgrade=None, timings=None):
+        """Return the :class:`.Plan` of revision steps that an upgrade or
+        downgrade from ``from_`` to ``target`` would run.
+
+        The plan is worked out from the revision graph, no transaction is
+        opened.  Plans are cached by (heads, target) until the revisions
+        change.
+
+        :param target: string revision target, as for :meth:`.upgrade`.
+
+        :param from_: revision or sequence of heads to start from; defaults
+        to the current heads of the database.
+
+        :param downgrade: plan a downgrade when True, an upgrade when False;
+        by default an upgrade is tried first, then a downgrade.
+
+        :param timings: optional ``dict`` of revision to seconds used as the
+        cost estimate of each step; such plans are not cached.
+
+        """
+        if from_ is None:
+            heads = self._get_current_heads(self.engine)
+        elif from_ == "base":
+            heads = ()
+        else:
+            heads = util.to_tuple(from_)
+        heads = tuple(sorted(heads))
+
+        key = (heads, target, downgrade)
+        plan = self.__plans.get(key) if timings is None else None
+        if plan is None:
+            script = self.script_directory
+            if downgrade:
+                steps = script._downgrade_revs(target, heads)
+            else:
+                try:
+                    steps = script._upgrade_revs(target, heads)
+                except util.CommandError as err:
+                    if downgrade is not None:
+                        raise
+                    try:
+                        steps = script._downgrade_revs(target, heads)
+                    except util.CommandError:
+                        raise err
+            plan = build_plan(heads, target, steps, timings=timings)
+            if timings is None:
+                self.__plans[key] = plan
+        return plan
 
     def show(self, revision):
         """Show the revision(s) denoted by the given symbol.
@@ -385,8 +895,7 @@ class Moonshine:
         :param revision: string revision target
 
         """
-        script = self.script_directory
-        return script.get_revisions(revision)
+        return self._get_revisions(revision)
 
     def history(self, rev_range="base:heads", indicate_current=False):
         """List changeset scripts in chronological order.
@@ -399,15 +908,7 @@ class Moonshine:
 
         """
 
-        if rev_range is not None:
-            if ":" not in rev_range:
-                raise util.CommandError(
-                    "History range requires [start]:[end], "
-                    "[start]:, or :[end]"
-                )
-            base, head = rev_range.strip().split(":")
-        else:
-            base = head = None
+        base, head = self._split_history_range(rev_range)
 
         environment = (
             util.asbool(self.config.get_main_option("revision_environment"))
@@ -416,15 +917,22 @@ class Moonshine:
 
         def _display_history(base, head, currents=()):
 
-            history = list()
-            for sc in self.script_directory.walk_revisions(
-                base=base or "base", head=head or "heads"
-            ):
-                if indicate_current:
-                    sc._db_current_indicator = sc in currents
-                history.insert(0, sc)
+            key = (base, head)
+            history = self.__history_cache.get(key)
+            if history is None:
+                history = list(
+                    self.script_directory.walk_revisions(
+                        base=base or "base", head=head or "heads"
+                    )
+                )
+                history.reverse()
+                self.__history_cache[key] = history
 
-            return history
+            if indicate_current:
+                for sc in history:
+                    sc._db_current_indicator = sc.revision in currents
+
+            return list(history)
 
         def _display_history_w_current(base, head):
             def _display_current_history(rev):
@@ -436,7 +944,8 @@ class Moonshine:
                     return _display_history(base, head, rev)
                 return []
 
-            rev = self.current
+            # ids, the current revisions may be nodes of the compact graph
+            rev = tuple(sc.revision for sc in self.current)
             return _display_current_history(rev)
 
         if base == "current" or head == "current" or environment:
@@ -444,6 +953,36 @@ class Moonshine:
         else:
             return _display_history(base, head)
 
+    def iter_history(self, rev_range="base:heads", limit=None):
+        """Iterate changeset scripts, newest first.
+
+        Scripts are produced as the revision graph is walked, so showing the
+        latest few revisions does not build the whole history.
+
+        :param rev_range: string revision range
+
+        :param limit: maximum number of scripts to produce.
+
+        """
+        base, head = self._split_history_range(rev_range)
+        return itertools.islice(
+            self.script_directory.walk_revisions(
+                base=base or "base", head=head or "heads"
+            ),
+            limit,
+        )
+
+    @staticmethod
+    def _split_history_range(rev_range):
+        if rev_range is None:
+            return None, None
+        if ":" not in rev_range:
+            raise util.CommandError(
+                "History range requires [start]:[end], " "[start]:, or :[end]"
+            )
+        base, head = rev_range.strip().split(":")
+        return base, head
+
     def heads(self, resolve_dependencies=False):
         """Show current available heads in the script directory.
 
@@ -453,6 +992,8 @@ class Moonshine:
         if resolve_dependencies:
             return self.script_directory.get_revisions("heads")
 
+        if self._use_graph():
+            return self._get_revisions(self.revision_graph.heads)
         return self.script_directory.get_revisions(
             self.script_directory.get_heads()
         )
@@ -460,22 +1001,464 @@ class Moonshine:
     @property
     def branches(self):
         """Show current branch points."""
-        script = self.script_directory
-        branches = list()
-        for sc in script.walk_revisions():
-            if sc.is_branch_point:
-                branches.append(sc)
-        return branches
+        if self.__branches is None:
+            self.__branches = [
+                sc
+                for sc in self.script_directory.walk_revisions()
+                if sc.is_branch_point
+            ]
+        return list(self.__branches)
 
     @property
     def current(self):
-        """Display the current revision for a database."""
-        with self.migration_context as migration_context:
-            return self.script_directory.get_revisions(
-                migration_context.get_current_heads()
+        """Display the current revision for a database.
+
+        When ``current_ttl`` is set, the heads read from the version table
+        are cached for that many seconds, or until the next ``upgrade``,
+        ``downgrade`` or ``stamp``.
+
+        """
+        return self._get_revisions(self._get_current_heads(self.engine))
+
+    def current_many(self, targets, max_workers=None):
+        """Display the current revision for many databases at once.
+
+        The version tables are read concurrently, through one pooled engine
+        per url, without running ``env.py``.
+
+        :param targets: iterable of engines, engine config dicts or urls
+
+        :param max_workers: maximum number of databases queried at once.
+
+        :return: list of :class:`.FleetResult` in the order of ``targets``,
+        whose output is the tuple of current revisions.
+
+        """
+        from . import fleet
+
+        return fleet.current_many(self, targets, max_workers=max_workers)
+
+    def verify(self, engine=None):
+        """Find the applied revisions whose files changed since, by the
+        checksums the ``version_store`` recorded; see
+        :mod:`moonshine.verify`.
+
+        Files are hashed through the revision index, so with
+        ``revision_index`` set only the files changed since they were last
+        indexed are read.
+
+        :param engine: engine, engine config dict or url; defaults to the
+        instance's engine.
+
+        :return: list of :class:`.Drift`, empty if nothing changed.
+
+        """
+        from . import verify
+
+        engine = self.engine if engine is None else self._get_engine(engine)
+        return verify.verify(self, engine)
+
+    def verify_many(self, targets, max_workers=None):
+        """:meth:`verify` many databases at once, hashing the revision files
+        only once.
+
+        :param targets: iterable of engines, engine config dicts or urls
+
+        :param max_workers: maximum number of databases queried at once.
+
+        :return: list of :class:`.FleetResult` in the order of ``targets``,
+        whose output is the list of :class:`.Drift`.
+
+        """
+        from . import verify
+
+        return verify.verify_many(self, targets, max_workers=max_workers)
+
+    def survey(self, targets, max_workers=None):
+        """Group many databases by their current heads.
+
+        :param targets: iterable of engines, engine config dicts or urls
+
+        :return: :class:`.Survey` whose ``groups`` map each sorted tuple of
+        heads to its targets.
+
+        """
+        from . import fleet
+
+        return fleet.survey(self, targets, max_workers=max_workers)
+
+    def squash(self, revision, message=None, url="sqlite://"):
+        """Replace ``revision`` and all of its ancestors with one baseline
+        revision that creates the schema as of ``revision``.
+
+        The baseline keeps the identifier of ``revision``, so databases at
+        or past it are unaffected; the replaced files are moved to a
+        ``replaced/`` directory.  See :mod:`moonshine.squash`.
+
+        :param message: message of the baseline revision.
+
+        :param url: empty scratch database the revisions are run on to
+        reflect the schema; use one of the production dialect when the
+        revisions are dialect specific.
+
+        :return: the baseline :class:`.Script`.
+
+        """
+        from . import squash
+
+        return squash.squash(self, revision, message=message, url=url)
+
+    def upgrade_grouped(
+        self, targets, revision="head", tag=None, max_workers=None
+    ):
+        """Upgrade many databases, rendering the ``--sql`` script only once
+        per group of databases on the same heads and executing it on every
+        member of the group.
+
+        ``env.py`` runs once per group instead of once per database, so the
+        revisions must not depend on reading the database while migrating.
+
+        :param targets: iterable of engines, engine config dicts or urls
+
+        :param max_workers: maximum number of databases upgraded at once.
+
+        :return: list of :class:`.FleetResult` in the order of ``targets``,
+        whose output is the applied :class:`.Plan`.
+
+        """
+        from . import fleet
+
+        return fleet.upgrade_grouped(
+            self, targets, revision, tag=tag, max_workers=max_workers
+        )
+
+    def upgrade_branches(self, revision="heads", tag=None, max_workers=None):
+        """Upgrade to ``revision``, applying independent branches
+        concurrently on separate connections.
+
+        Pending revisions are grouped by their down revisions, ``depends_on``
+        edges, version table rows and the tables their ``upgrade()`` touches;
+        see :mod:`moonshine.branches`.  Groups that share none of those run
+        in parallel worker processes, the others one after another.
+
+        :param max_workers: maximum number of groups upgraded at once.
+
+        :return: list of :class:`.FleetResult`, one per group of branches,
+        whose target is the tuple of the group's heads.
+
+        """
+        from . import branches
+
+        return branches.upgrade_branches(
+            self, revision, tag=tag, max_workers=max_workers
+        )
+
+    def apply_history(self, limit=None, engine=None):
+        """The revisions applied to a database, latest first, as recorded
+        by the ``version_store``; see :mod:`moonshine.version_store`.
+
+        :param limit: maximum number of entries returned.
+
+        :param engine: engine, engine config dict or url; defaults to the
+        instance's engine.
+
+        :return: list of ``dict`` with the ``revision``, ``direction``,
+        ``applied_at``, ``duration``, ``host`` and ``checksum`` of each
+        step.
+
+        """
+        engine = self.engine if engine is None else self._get_engine(engine)
+        with engine.connect() as conn:
+            return self.version_store.history(conn, limit)
+
+    def invalidate_current(self):
+        """Forget all cached current heads."""
+        self.__current_cache.clear()
+
+    def _after_fork(self):
+        """Replace the locks inherited by a forked worker process, which
+        may have been held by another thread of its parent.
+
+        """
+        self.__lock = threading.RLock()
+
+    def _get_engine(self, target):
+        """Return the engine for an engine, engine config dict or url,
+        creating it only once per url.
+
+        """
+        if isinstance(target, Engine):
+            return target
+        if isinstance(target, dict):
+            key = target.get("sqlalchemy.url")
+        else:
+            key = str(target)
+        engine = self.__engines.get(key)
+        if engine is None:
+            if isinstance(target, dict):
+                engine = engine_from_config(target)
+            else:
+                engine = create_engine(target)
+            engine = self.__engines.setdefault(key, engine)
+        return engine
+
+    def _get_current_heads(self, engine):
+        key = str(engine.url)
+        heads = self._cached_heads(key)
+        if heads is None:
+            with engine.connect() as conn:
+                heads = self.version_store.read_heads(conn)
+            self._cache_heads(key, heads)
+        return heads
+
+    def _cached_heads(self, key):
+        if self.current_ttl:
+            cached = self.__current_cache.get(key)
+            if cached is not None and cached[0] > time.monotonic():
+                return cached[1]
+        return None
+
+    def _cache_heads(self, key, heads):
+        if self.current_ttl:
+            self.__current_cache[key] = (
+                time.monotonic() + self.current_ttl,
+                heads,
+            )
+
+    def _get_async_engine(self, target=None):
+        """Return the async engine for an async engine, engine config dict
+        or url, creating it only once per url.
+
+        """
+        if target is None:
+            return self.async_engine
+        if _is_async_engine(target):
+            return target
+        create_async_engine = _async_api()[1]
+        if create_async_engine is None:
+            raise util.CommandError(
+                "Async support requires SQLAlchemy 1.4 or later"
+            )
+        if isinstance(target, dict):
+            key = target.get("sqlalchemy.url")
+        else:
+            key = str(target)
+        engine = self.__engines.get(key)
+        if engine is None:
+            options = {}
+            if isinstance(target, dict):
+                # as engine_from_config does, which has no async version
+                # before SQLAlchemy 1.4.29
+                prefix = "sqlalchemy."
+                options = {
+                    name[len(prefix):]: value
+                    for name, value in target.items()
+                    if name.startswith(prefix) and name != prefix + "url"
+                }
+                options["_coerce_config"] = True
+            engine = self.__engines.setdefault(
+                key, create_async_engine(key, **options)
+            )
+        return engine
+
+    async def upgrade_async(
+        self, revision, tag=None, transaction_per_migration=None, engine=None
+    ):
+        """Upgrade to a later version through an ``AsyncEngine``.
+
+        The migration runs on an ``AsyncConnection`` by way of ``run_sync``,
+        so the event loop is not blocked on the database.
+
+        :param engine: async engine or url; defaults to the instance's
+        ``async_engine``.
+
+        """
+        return await self._run_async(
+            "upgrade",
+            engine,
+            revision,
+            tag=tag,
+            transaction_per_migration=transaction_per_migration,
+        )
+
+    async def downgrade_async(
+        self, revision, tag=None, transaction_per_migration=None, engine=None
+    ):
+        """Revert to a previous version through an ``AsyncEngine``.
+
+        :param engine: async engine or url; defaults to the instance's
+        ``async_engine``.
+
+        """
+        return await self._run_async(
+            "downgrade",
+            engine,
+            revision,
+            tag=tag,
+            transaction_per_migration=transaction_per_migration,
+        )
+
+    async def stamp_async(self, revision, tag=None, purge=False, engine=None):
+        """'stamp' the revision table through an ``AsyncEngine``.
+
+        :param engine: async engine or url; defaults to the instance's
+        ``async_engine``.
+
+        """
+        return await self._run_async(
+            "stamp", engine, revision, tag=tag, purge=purge
+        )
+
+    async def current_async(self, engine=None):
+        """Display the current revision for a database, through an
+        ``AsyncEngine``.
+
+        :param engine: async engine or url; defaults to the instance's
+        ``async_engine``.
+
+        """
+        engine = self._get_async_engine(engine)
+        key = str(engine.url)
+        heads = self._cached_heads(key)
+        if heads is None:
+            async with engine.connect() as conn:
+                heads = await conn.run_sync(self.version_store.read_heads)
+            self._cache_heads(key, heads)
+        return self._get_revisions(heads)
+
+    async def current_many_async(self, targets, concurrency=10):
+        """Display the current revision for many databases, at most
+        ``concurrency`` at a time, through ``asyncio.gather``.
+
+        :return: list of :class:`.FleetResult` in the order of ``targets``.
+
+        """
+        from . import fleet
+
+        return await fleet.current_many_async(
+            self, targets, concurrency=concurrency
+        )
+
+    async def upgrade_many_async(
+        self, targets, revision, sql=False, tag=None, max_workers=None
+    ):
+        """Run :meth:`.upgrade_many` without blocking the event loop.
+
+        The targets are upgraded by the worker processes of
+        :meth:`.upgrade_many`, so they must be sync engines or urls.
+
+        """
+        import asyncio
+
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            None,
+            functools.partial(
+                self.upgrade_many,
+                targets,
+                revision,
+                sql=sql,
+                tag=tag,
+                max_workers=max_workers,
+            ),
+        )
+
+    async def _run_async(self, command, engine, *args, **kw):
+        """Run the method ``command`` on a connection of ``engine``.
+
+        The command runs in the event loop's thread, by way of
+        ``run_sync``; the migration lock, the ``env.py`` lock and the
+        retries after a timeout are waited for here with ``asyncio``, so
+        that they do not block the event loop.
+
+        """
+        import asyncio
+
+        engine = self._get_async_engine(engine)
+        loop = asyncio.get_running_loop()
+        lock = _async_env_locks.get(loop)
+        if lock is None:
+            lock = _async_env_locks.setdefault(loop, asyncio.Lock())
+        migration_lock = self._migration_lock(engine)
+        worker = copy.copy(self)
+        worker.migration_lock = False
+        worker.retries = 0
+
+        def run(connection):
+            return getattr(worker, command)(
+                *args, connection=connection, **kw
             )
 
-    def stamp(self, revision, sql=False, tag=None, purge=False):
+        async def poll(try_acquire, timeout, interval, name):
+            deadline = None if timeout is None else loop.time() + timeout
+            while not await try_acquire():
+                if deadline is not None and loop.time() >= deadline:
+                    raise util.CommandError(
+                        "Timed out after %ss waiting for %s" % (timeout, name)
+                    )
+                await asyncio.sleep(interval)
+
+        async def migrate():
+            env_lock = _env_lock
+
+            async def try_env_lock():
+                return env_lock.acquire(blocking=False)
+
+            await poll(try_env_lock, None, 0.01, "the env.py lock")
+            try:
+                async with engine.connect() as conn:
+                    result = await conn.run_sync(run)
+                    await conn.commit()
+            finally:
+                env_lock.release()
+            return result
+
+        async def locked():
+            if migration_lock is None:
+                return await migrate()
+            async with engine.connect() as conn:
+                await poll(
+                    lambda: conn.run_sync(migration_lock.try_acquire),
+                    migration_lock.timeout,
+                    migration_lock.poll_interval,
+                    "migration lock %r" % migration_lock.name,
+                )
+                try:
+                    return await migrate()
+                finally:
+                    await conn.run_sync(migration_lock.release)
+
+        attempt = 0
+        async with lock:
+            while True:
+                try:
+                    return await locked()
+                except Exception as err:
+                    kind = timeouts.timeout_kind(err)
+                    if kind is None or attempt >= self.retries:
+                        raise
+                    delay = timeouts.backoff(attempt, self.retry_backoff)
+                    logger.warning(
+                        "%s timeout, retrying in %.1fs (attempt %d of %d)",
+                        kind,
+                        delay,
+                        attempt + 1,
+                        self.retries,
+                    )
+                    self.invalidate_current()
+                    await asyncio.sleep(delay)
+                    attempt += 1
+
+    def stamp(
+        self,
+        revision,
+        sql=False,
+        tag=None,
+        purge=False,
+        output_buffer=None,
+        connection=None,
+        engine=None,
+    ):
         """'stamp' the revision table with the given revision; don't
         run any migrations.
 
@@ -498,14 +1481,18 @@ class Moonshine:
 
         .. versionadded:: 1.2
 
+        :param output_buffer: file-like object or callable that receives the
+        ``--sql`` output as it is generated, instead of returning it.
+
+        :param connection: run on this connection instead of one checked out
+        from the engine.
+
+        :param engine: engine, engine config dict or url to run on instead of
+        the instance's engine.
+
         """
 
-        config = self.config
         script = self.script_directory
-        config.attributes["engine"] = self.engine
-
-        output_buffer = io.StringIO()
-        config.attributes["output_buffer"] = output_buffer
 
         starting_rev = None
         if sql:
@@ -529,16 +1516,165 @@ class Moonshine:
         def do_stamp(rev, context):
             return script._stamp_revs(util.to_tuple(destination_revs), rev)
 
-        with EnvironmentContext(
-            config,
-            script,
-            fn=do_stamp,
-            as_sql=sql,
+        return self._run_env(
+            do_stamp,
+            sql=sql,
+            output_buffer=output_buffer,
+            connection=connection,
+            engine=engine,
             starting_rev=starting_rev if sql else None,
             destination_rev=util.to_tuple(destination_revs),
             tag=tag,
             purge=purge,
-        ):
-            script.run_env()
-            output_buffer.seek(0)
-            return output_buffer.read()
+        )
+
+    def _run_env(
+        self,
+        fn,
+        sql=False,
+        output_buffer=None,
+        transaction_per_migration=None,
+        connection=None,
+        engine=None,
+        lock_timeout=None,
+        statement_timeout=None,
+        retries=None,
+        target=None,
+        **kw
+    ):
+        """Run ``env.py`` with ``fn`` as the migration function.
+
+        In ``--sql`` mode the script is written to ``output_buffer`` as it is
+        generated, when one is given, and ``None`` is returned.  Otherwise
+        the script is collected and returned as a string.
+
+        A run that fails on a lock or statement timeout is run again, up to
+        ``retries`` times, after a jittered exponential backoff.
+
+        Online runs hold the ``migration_lock``, if any; see
+        :mod:`moonshine.lock`.  They are skipped when the database is at
+        the ``target`` revision already.
+
+        """
+        config = self._call_config()
+        script = self.script_directory
+        if connection is not None:
+            config.attributes["engine"] = connection.engine
+        elif engine is not None:
+            config.attributes["engine"] = self._get_engine(engine)
+        else:
+            config.attributes["engine"] = self.engine
+        config.attributes["connection"] = connection
+        config.attributes["target_metadata"] = self.target_metadata
+        if transaction_per_migration is None:
+            transaction_per_migration = self.transaction_per_migration
+        config.attributes[
+            "transaction_per_migration"
+        ] = transaction_per_migration
+
+        streaming = output_buffer is not None
+        if not streaming:
+            output_buffer = io.StringIO()
+        elif not hasattr(output_buffer, "write"):
+            output_buffer = _CallableBuffer(output_buffer)
+        config.attributes["output_buffer"] = output_buffer
+
+        if lock_timeout is None:
+            lock_timeout = self.lock_timeout
+        if statement_timeout is None:
+            statement_timeout = self.statement_timeout
+        if retries is None:
+            retries = self.retries
+        fn = self.version_store.wrap(fn)
+        config.attributes["on_version_apply"] = fn.on_version_apply
+        fn = timeouts.Guard(lock_timeout, statement_timeout).wrap(fn)
+        lock = None
+        if not sql:
+            lock = self._migration_lock(config.attributes["engine"])
+
+        attempt = 0
+        while True:
+            run = None
+            migrate = fn
+            if self.__listeners:
+                run = instrument.Run(self._emit, attempt=attempt)
+                migrate = run.wrap(fn)
+            try:
+                with self._locked(
+                    lock, config.attributes["engine"], target
+                ) as pending:
+                    if pending:
+                        with _env_lock, EnvironmentContext(
+                            config, script, fn=migrate, as_sql=sql, **kw
+                        ):
+                            if self.reuse_environment:
+                                self._exec_env(script)
+                            else:
+                                script.run_env()
+                break
+            except Exception as err:
+                if run is not None:
+                    run.close(error=err)
+                kind = timeouts.timeout_kind(err)
+                if sql or kind is None or attempt >= retries:
+                    raise
+                delay = timeouts.backoff(attempt, self.retry_backoff)
+                logger.warning(
+                    "%s timeout, retrying in %.1fs (attempt %d of %d)",
+                    kind,
+                    delay,
+                    attempt + 1,
+                    retries,
+                )
+                self.invalidate_current()
+                time.sleep(delay)
+                attempt += 1
+
+        if not sql:
+            self.invalidate_current()
+
+        if streaming:
+            return None
+        return output_buffer.getvalue()
+
+    def _exec_env(self, script):
+        """Run ``env.py`` from a code object compiled once per instance.
+
+        The source is compiled again only when the file's modification time
+        or size changes.
+
+        """
+        path = script.env_py_location
+        try:
+            stat = os.stat(path)
+        except OSError:
+            # sourceless environment, let alembic locate the compiled file
+            return script.run_env()
+
+        key = (stat.st_mtime, stat.st_size)
+        if self.__env_code is None or self.__env_code[0] != key:
+            with open(path, "rb") as file_:
+                code = compile(file_.read(), path, "exec")
+            self.__env_code = (key, code)
+
+        module = types.ModuleType("env_py")
+        module.__file__ = path
+        exec(self.__env_code[1], module.__dict__)
+
+
+class _CallableBuffer:
+    """Adapt a callable to the file-like ``output_buffer`` interface.
+
+    Alembic writes each statement of the ``--sql`` output with a single
+    ``write()``, so the callable receives one statement per call.
+
+    """
+
+    def __init__(self, fn):
+        self.fn = fn
+
+    def write(self, text):
+        self.fn(text)
+
+    def flush(self):
+        pass
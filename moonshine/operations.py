@@ -0,0 +1,658 @@
+"""Operations for use inside revision scripts.
+
+These complement ``alembic.op`` for data migrations on large tables::
+
+    from alembic import op
+    from moonshine.operations import batched_update
+
+    def upgrade():
+        op.add_column("account", sa.Column("active", sa.Boolean()))
+        batched_update("account", {"active": True}, chunk_size=5000)
+
+:func:`.online_alter` changes a large table without locking it for the
+length of an ``ALTER TABLE``, by altering a copy and swapping it in.
+
+"""
+import json
+import logging
+import time
+from contextlib import contextmanager
+
+from alembic import op, util
+from alembic.operations import Operations
+from alembic.runtime.migration import MigrationContext
+from sqlalchemy import (
+    Column,
+    DateTime,
+    Index,
+    Integer,
+    MetaData,
+    String,
+    Table,
+    Text,
+    UniqueConstraint,
+    and_,
+    func,
+    select,
+)
+
+logger = logging.getLogger(__name__)
+
+progress_table = Table(
+    "moonshine_batch_progress",
+    MetaData(),
+    Column("name", String(255), primary_key=True),
+    Column("last_key", Text, nullable=False),
+    Column("rows", Integer, nullable=False),
+    Column("updated_at", DateTime, nullable=False),
+)
+
+
+def _reflect(table, bind):
+    if isinstance(table, Table):
+        return table
+    return Table(table, MetaData(), autoload_with=bind)
+
+
+def _key_column(table, key):
+    if key is not None:
+        return table.c[key]
+    columns = list(table.primary_key.columns)
+    if len(columns) != 1:
+        raise util.CommandError(
+            "batched_update of %s needs a key column, the primary key "
+            "does not have exactly one column" % table.name
+        )
+    return columns[0]
+
+
+def _load_checkpoint(conn, name):
+    row = conn.execute(
+        select([progress_table.c.last_key, progress_table.c.rows]).where(
+            progress_table.c.name == name
+        )
+    ).first()
+    if row is None:
+        return None, 0
+    return json.loads(row.last_key), row.rows
+
+
+def _save_checkpoint(conn, name, last_key, rows):
+    values = dict(
+        last_key=json.dumps(last_key), rows=rows, updated_at=func.now()
+    )
+    result = conn.execute(
+        progress_table.update()
+        .where(progress_table.c.name == name)
+        .values(**values)
+    )
+    if not result.rowcount:
+        conn.execute(progress_table.insert().values(name=name, **values))
+
+
+def _delete_checkpoint(conn, name):
+    conn.execute(progress_table.delete().where(progress_table.c.name == name))
+
+
+def batched_update(
+    table,
+    values,
+    where=None,
+    key=None,
+    chunk_size=1000,
+    sleep=0,
+    name=None,
+    progress=None,
+    bind=None,
+):
+    """Update the rows of a large table in chunks of its key.
+
+    Each chunk is committed in its own transaction, together with a
+    checkpoint in the ``moonshine_batch_progress`` table, so that an
+    interrupted update resumes after the last committed chunk when the
+    revision is run again.  The migration's own transaction is committed
+    first, see :meth:`.MigrationContext.autocommit_block`.
+
+    :param table: :class:`~sqlalchemy.schema.Table` or table name.
+
+    :param values: ``dict`` of column names to values or SQL expressions,
+     or a callable that receives the table and returns one.
+
+    :param where: optional filter, or callable that receives the table and
+     returns one; rows outside it are left alone.
+
+    :param key: name of the unique, ordered column to walk; defaults to the
+     single column primary key.
+
+    :param chunk_size: number of keys per chunk.
+
+    :param sleep: seconds to wait between chunks, to let replicas catch up.
+
+    :param name: checkpoint name; defaults to the table and column names.
+
+    :param progress: callable that receives a ``dict`` of ``rows``,
+     ``chunks``, ``elapsed``, ``rows_per_second`` and ``last_key`` after
+     each chunk.
+
+    :param bind: connection whose engine runs the chunks, outside of any
+     migration; defaults to ``op.get_bind()``.
+
+    :return: the final progress ``dict``.
+
+    """
+    if bind is None:
+        context = op.get_context()
+        bind = op.get_bind()
+    else:
+        context = None
+
+    table = _reflect(table, bind)
+    if callable(values):
+        values = values(table)
+    if callable(where):
+        where = where(table)
+    key_column = _key_column(table, key)
+    if name is None:
+        name = "%s:%s" % (table.name, ",".join(sorted(values)))
+
+    if context is not None and context.as_sql:
+        # nothing to walk in --sql mode, emit a single statement
+        update = table.update().values(**values)
+        if where is not None:
+            update = update.where(where)
+        op.execute(update)
+        return None
+
+    with _autocommit_block(context):
+        return _run_batches(
+            bind.engine,
+            table,
+            values,
+            where,
+            key_column,
+            chunk_size,
+            sleep,
+            name,
+            progress,
+        )
+
+
+@contextmanager
+def _autocommit_block(context):
+    if context is None:
+        yield
+    else:
+        with context.autocommit_block():
+            yield
+
+
+def _run_batches(
+    engine, table, values, where, key_column, chunk_size, sleep, name, progress
+):
+    def update(conn, last_key, upper):
+        criteria = [key_column <= upper]
+        if last_key is not None:
+            criteria.append(key_column > last_key)
+        if where is not None:
+            criteria.append(where)
+        return conn.execute(
+            table.update().where(and_(*criteria)).values(**values)
+        ).rowcount
+
+    return _run_chunks(
+        engine, key_column, chunk_size, sleep, name, progress, update
+    )
+
+
+def _run_chunks(engine, key_column, chunk_size, sleep, name, progress, chunk):
+    """Walk ``key_column`` in chunks of ``chunk_size`` keys, calling
+    ``chunk(conn, last_key, upper)`` for each in its own transaction,
+    together with the checkpoint ``name``.
+
+    """
+    progress_table.create(engine, checkfirst=True)
+    with engine.connect() as conn:
+        last_key, rows = _load_checkpoint(conn, name)
+    if last_key is not None:
+        logger.info("Resuming %s after key %r", name, last_key)
+
+    chunks = 0
+    started = time.time()
+    stats = dict(
+        rows=rows,
+        chunks=0,
+        elapsed=0.0,
+        rows_per_second=None,
+        last_key=last_key,
+    )
+    while True:
+        with engine.begin() as conn:
+            bounds = select([key_column]).order_by(key_column)
+            if last_key is not None:
+                bounds = bounds.where(key_column > last_key)
+            upper = conn.execute(
+                bounds.offset(chunk_size - 1).limit(1)
+            ).scalar()
+            if upper is None:
+                upper_query = select([func.max(key_column)])
+                if last_key is not None:
+                    upper_query = upper_query.where(key_column > last_key)
+                upper = conn.execute(upper_query).scalar()
+            if upper is None:
+                _delete_checkpoint(conn, name)
+                break
+
+            rows += max(chunk(conn, last_key, upper) or 0, 0)
+            last_key = upper
+            _save_checkpoint(conn, name, last_key, rows)
+
+        chunks += 1
+        elapsed = time.time() - started
+        stats = dict(
+            rows=rows,
+            chunks=chunks,
+            elapsed=elapsed,
+            rows_per_second=rows / elapsed if elapsed else None,
+            last_key=last_key,
+        )
+        logger.info(
+            "%s: %d rows in %d chunks, %.1f rows/s",
+            name,
+            rows,
+            chunks,
+            stats["rows_per_second"] or 0,
+        )
+        if progress is not None:
+            progress(stats)
+        if sleep:
+            time.sleep(sleep)
+
+    return stats
+
+
+ONLINE_DIALECTS = ("sqlite", "mysql", "postgresql")
+
+
+def online_alter(
+    table,
+    alter,
+    key=None,
+    chunk_size=1000,
+    sleep=0,
+    progress=None,
+    bind=None,
+):
+    """Alter a large table online, through an altered copy that is kept in
+    sync by triggers and swapped in at the end::
+
+        def upgrade():
+            online_alter(
+                "account",
+                lambda op, name: op.add_column(
+                    name, sa.Column("active", sa.Boolean())
+                ),
+                chunk_size=5000,
+                sleep=0.1,
+            )
+
+    The steps are:
+
+    1. create the shadow table ``_<table>_new`` with the columns, primary
+       key and indexes of ``table``, and call ``alter(op, "_<table>_new")``
+       on it, where the table is still empty;
+    2. add triggers that repeat every insert, update and delete of
+       ``table`` on the shadow table;
+    3. copy the rows in chunks of the key, one transaction and checkpoint
+       per chunk, like :func:`.batched_update`;
+    4. compare the row counts of both tables, without locking them, and
+       drop the shadow table if they differ;
+    5. in a single transaction rename ``table`` to ``_<table>_old`` and
+       the shadow table to ``table``, then drop the triggers; then drop
+       the old table and give the indexes their original names back.
+
+    Columns present in both tables are copied, so added columns take their
+    defaults and dropped columns are left behind; renaming columns is not
+    supported.  Foreign keys of or to the table are not carried over.  An
+    interrupted run resumes with the existing shadow table from the last
+    copied chunk.  In ``--sql`` mode ``alter`` is applied to ``table``
+    itself.  Supported on SQLite, MySQL and PostgreSQL.
+
+    :param table: :class:`~sqlalchemy.schema.Table` or table name.
+
+    :param alter: callable receiving the alembic ``op`` and the name of the
+     table to alter.
+
+    :param key: name of the unique, ordered column to copy by; defaults to
+     the single column primary key.
+
+    :param chunk_size: number of keys copied per chunk.
+
+    :param sleep: seconds to wait between chunks, to throttle the copy.
+
+    :param progress: callable that receives the ``dict`` of ``rows``,
+     ``chunks``, ``elapsed``, ``rows_per_second`` and ``last_key`` after
+     each chunk.
+
+    :param bind: connection whose engine runs the change, outside of any
+     migration; defaults to ``op.get_bind()``.
+
+    :return: the final progress ``dict``.
+
+    """
+    if bind is None:
+        context = op.get_context()
+        bind = op.get_bind()
+        operations = op
+    else:
+        context = None
+        operations = Operations(MigrationContext.configure(bind))
+
+    dialect = bind.dialect.name
+    table = _reflect(table, bind)
+    key_column = _key_column(table, key)
+
+    if context is not None and context.as_sql:
+        alter(operations, table.name)
+        return None
+
+    if dialect not in ONLINE_DIALECTS:
+        raise util.CommandError(
+            "online_alter does not support the %s dialect" % dialect
+        )
+
+    with _autocommit_block(context):
+        return _OnlineAlter(bind.engine, table, key_column, dialect).run(
+            operations, alter, chunk_size, sleep, progress
+        )
+
+
+class _OnlineAlter:
+    """The statements of :func:`.online_alter` for one table."""
+
+    def __init__(self, engine, table, key_column, dialect):
+        self.engine = engine
+        self.table = table
+        self.key = key_column.name
+        self.dialect = dialect
+        self.quote = engine.dialect.identifier_preparer.quote
+        self.shadow_name = "_%s_new" % table.name
+        self.old_name = "_%s_old" % table.name
+        self.trigger = "%s_moonshine_sync" % table.name
+        # (name, column names, unique) of the indexes to rebuild; unique
+        # constraints are carried over as unique indexes
+        self.indexes = []
+        for index in table.indexes:
+            if index.name:
+                self.indexes.append(
+                    (
+                        index.name,
+                        [column.name for column in index.columns],
+                        index.unique,
+                    )
+                )
+        names = set(name for name, columns, unique in self.indexes)
+        for constraint in table.constraints:
+            if (
+                isinstance(constraint, UniqueConstraint)
+                and constraint.name
+                and constraint.name not in names
+            ):
+                self.indexes.append(
+                    (
+                        constraint.name,
+                        [column.name for column in constraint.columns],
+                        True,
+                    )
+                )
+
+    def _temporary_name(self, name):
+        if self.dialect == "mysql":
+            # index names are per table
+            return name
+        # index names are per schema, not per table
+        return "_%s_new" % name
+
+    def run(self, operations, alter, chunk_size, sleep, progress):
+        with self.engine.connect() as conn:
+            exists = self.engine.dialect.has_table(conn, self.shadow_name)
+        name = "online_alter:%s" % self.table.name
+        if not exists:
+            self._create_shadow()
+            # a checkpoint without its shadow table would skip the rows
+            # before it
+            progress_table.create(self.engine, checkfirst=True)
+            with self.engine.begin() as conn:
+                _delete_checkpoint(conn, name)
+            alter(operations, self.shadow_name)
+        else:
+            logger.info("Resuming with the existing %s", self.shadow_name)
+        shadow = Table(self.shadow_name, MetaData(), autoload_with=self.engine)
+        self.columns = [
+            column.name
+            for column in self.table.columns
+            if column.name in shadow.columns
+        ]
+        if self.key not in self.columns:
+            raise util.CommandError(
+                "online_alter can not drop the key column %s" % self.key
+            )
+
+        with self.engine.begin() as conn:
+            for statement in self._drop_triggers() + self._triggers():
+                conn.execute(statement)
+
+        copy = self._copy(shadow)
+        stats = _run_chunks(
+            self.engine,
+            self.table.c[self.key],
+            chunk_size,
+            sleep,
+            name,
+            progress,
+            copy,
+        )
+
+        self._check_count()
+        # rename while the triggers are in place, so that no write is
+        # missed; on MySQL each DDL statement commits on its own
+        with self.engine.begin() as conn:
+            for statement in self._swap(conn) + self._drop_triggers(
+                self.old_name
+            ):
+                conn.execute(statement)
+        with self.engine.begin() as conn:
+            conn.execute("DROP TABLE %s" % self.quote(self.old_name))
+            for statement in self._rename_indexes():
+                conn.execute(statement)
+        return stats
+
+    def _check_count(self):
+        """Compare the row counts of the table and the shadow table, in a
+        single statement and without locking either, and drop the shadow
+        table if they differ.
+
+        """
+        q = self.quote
+        with self.engine.connect() as conn:
+            rows, copied = conn.execute(
+                "SELECT (SELECT count(*) FROM %s), (SELECT count(*) FROM %s)"
+                % (q(self.table.name), q(self.shadow_name))
+            ).first()
+        if rows == copied:
+            return
+        with self.engine.begin() as conn:
+            for statement in self._drop_triggers():
+                conn.execute(statement)
+            conn.execute("DROP TABLE %s" % q(self.shadow_name))
+        raise util.CommandError(
+            "online_alter copied %d of the %d rows of %s, dropped %s; "
+            "run it again" % (copied, rows, self.table.name, self.shadow_name)
+        )
+
+    def _create_shadow(self):
+        shadow = Table(
+            self.shadow_name,
+            MetaData(),
+            *[column.copy() for column in self.table.columns]
+        )
+        for name, columns, unique in self.indexes:
+            Index(
+                self._temporary_name(name),
+                *[shadow.c[column] for column in columns],
+                unique=unique
+            )
+        shadow.create(self.engine)
+
+    def _copy(self, shadow):
+        names = self.columns
+        source = self.table
+        key_column = source.c[self.key]
+        dialect = self.dialect
+
+        def copy(conn, last_key, upper):
+            criteria = [key_column <= upper]
+            if last_key is not None:
+                criteria.append(key_column > last_key)
+            rows = select([source.c[name] for name in names]).where(
+                and_(*criteria)
+            )
+            if dialect == "postgresql":
+                from sqlalchemy.dialects.postgresql import insert
+
+                statement = (
+                    insert(shadow).from_select(names, rows)
+                ).on_conflict_do_nothing()
+            else:
+                # rows already written by the triggers win
+                statement = (
+                    shadow.insert()
+                    .from_select(names, rows)
+                    .prefix_with("OR IGNORE", dialect="sqlite")
+                    .prefix_with("IGNORE", dialect="mysql")
+                )
+            return conn.execute(statement).rowcount
+
+        return copy
+
+    def _triggers(self):
+        q = self.quote
+        table, shadow, key = (
+            q(self.table.name),
+            q(self.shadow_name),
+            q(self.key),
+        )
+        columns = ", ".join(q(name) for name in self.columns)
+        new = ", ".join("NEW.%s" % q(name) for name in self.columns)
+        trigger = self.trigger
+
+        if self.dialect == "postgresql":
+            return [
+                "CREATE OR REPLACE FUNCTION %s() RETURNS trigger AS $$\n"
+                "BEGIN\n"
+                "  IF TG_OP IN ('UPDATE', 'DELETE') THEN\n"
+                "    DELETE FROM %s WHERE %s = OLD.%s;\n"
+                "  END IF;\n"
+                "  IF TG_OP IN ('INSERT', 'UPDATE') THEN\n"
+                "    DELETE FROM %s WHERE %s = NEW.%s;\n"
+                "    INSERT INTO %s (%s) VALUES (%s);\n"
+                "  END IF;\n"
+                "  RETURN NULL;\n"
+                "END $$ LANGUAGE plpgsql"
+                % (
+                    q(trigger),
+                    shadow,
+                    key,
+                    key,
+                    shadow,
+                    key,
+                    key,
+                    shadow,
+                    columns,
+                    new,
+                ),
+                "CREATE TRIGGER %s AFTER INSERT OR UPDATE OR DELETE ON %s "
+                "FOR EACH ROW EXECUTE PROCEDURE %s()"
+                % (q(trigger), table, q(trigger)),
+            ]
+
+        if self.dialect == "mysql":
+            each_row, replace = "FOR EACH ROW", "REPLACE INTO"
+        else:
+            each_row, replace = "", "INSERT OR REPLACE INTO"
+        upsert = "%s %s (%s) VALUES (%s)" % (replace, shadow, columns, new)
+        delete = "DELETE FROM %s WHERE %s = OLD.%s" % (shadow, key, key)
+        return [
+            "CREATE TRIGGER %s AFTER INSERT ON %s %s BEGIN %s; END"
+            % (q(trigger + "_ins"), table, each_row, upsert),
+            "CREATE TRIGGER %s AFTER UPDATE ON %s %s BEGIN %s; %s; END"
+            % (q(trigger + "_upd"), table, each_row, delete, upsert),
+            "CREATE TRIGGER %s AFTER DELETE ON %s %s BEGIN %s; END"
+            % (q(trigger + "_del"), table, each_row, delete),
+        ]
+
+    def _drop_triggers(self, table=None):
+        q = self.quote
+        if self.dialect == "postgresql":
+            return [
+                "DROP TRIGGER IF EXISTS %s ON %s"
+                % (q(self.trigger), q(table or self.table.name)),
+                "DROP FUNCTION IF EXISTS %s()" % q(self.trigger),
+            ]
+        return [
+            "DROP TRIGGER IF EXISTS %s" % q(self.trigger + suffix)
+            for suffix in ("_ins", "_upd", "_del")
+        ]
+
+    def _swap(self, conn):
+        q = self.quote
+        table, shadow, old = (
+            q(self.table.name),
+            q(self.shadow_name),
+            q(self.old_name),
+        )
+        if self.dialect == "mysql":
+            return [
+                "RENAME TABLE %s TO %s, %s TO %s" % (table, old, shadow, table)
+            ]
+        statements = [
+            "ALTER TABLE %s RENAME TO %s" % (table, old),
+            "ALTER TABLE %s RENAME TO %s" % (shadow, table),
+        ]
+        if self.dialect == "postgresql":
+            # serial sequences would be dropped with the old table
+            for name in self.columns:
+                sequence = conn.execute(
+                    "SELECT pg_get_serial_sequence(%(table)s, %(column)s)",
+                    dict(table=self.table.name, column=name),
+                ).scalar()
+                if sequence:
+                    statements.append(
+                        "ALTER SEQUENCE %s OWNED BY %s.%s"
+                        % (sequence, table, q(name))
+                    )
+        return statements
+
+    def _rename_indexes(self):
+        q = self.quote
+        if self.dialect == "mysql":
+            return []
+        if self.dialect == "postgresql":
+            return [
+                "ALTER INDEX %s RENAME TO %s"
+                % (q(self._temporary_name(name)), q(name))
+                for name, columns, unique in self.indexes
+            ]
+        # SQLite can not rename an index, build it again
+        statements = []
+        for name, columns, unique in self.indexes:
+            statements.append("DROP INDEX %s" % q(self._temporary_name(name)))
+            statements.append(
+                "CREATE %sINDEX %s ON %s (%s)"
+                % (
+                    "UNIQUE " if unique else "",
+                    q(name),
+                    q(self.table.name),
+                    ", ".join(q(column) for column in columns),
+                )
+            )
+        return statements
@@ -0,0 +1,309 @@
+"""Migration plans: the revision steps an upgrade or downgrade would run.
+
+A :class:`.Plan` is computed from the revision graph alone, without a
+database transaction, and depends only on the heads it starts from and the
+target.  Plans compare and hash by that ``key``, so that many databases can
+be grouped by identical plans::
+
+    plans = {}
+    for tenant, heads in surveyed_heads:
+        plan = moonshine.plan("head", from_=heads)
+        plans.setdefault(plan, []).append(tenant)
+
+"""
+import ast
+import os
+
+from .instrument import _step_info
+
+# calls counted as operations, besides those on ``op``
+_OPERATIONS = ("batched_update", "online_alter")
+
+# positions and keywords of the table names each operation touches
+_TABLE_ARGUMENTS = {
+    "create_table": ((0,), ("table_name",)),
+    "drop_table": ((0,), ("table_name",)),
+    "rename_table": ((0, 1), ("old_table_name", "new_table_name")),
+    "add_column": ((0,), ("table_name",)),
+    "drop_column": ((0,), ("table_name",)),
+    "alter_column": ((0,), ("table_name",)),
+    "batch_alter_table": ((0,), ("table_name",)),
+    "create_table_comment": ((0,), ("table_name",)),
+    "drop_table_comment": ((0,), ("table_name",)),
+    "create_index": ((1,), ("table_name",)),
+    "drop_index": ((1,), ("table_name",)),
+    "create_unique_constraint": ((1,), ("table_name",)),
+    "create_primary_key": ((1,), ("table_name",)),
+    "create_check_constraint": ((1,), ("table_name",)),
+    "create_exclude_constraint": ((1,), ("table_name",)),
+    "drop_constraint": ((1,), ("table_name",)),
+    "create_foreign_key": ((1, 2), ("source_table", "referent_table")),
+    "batched_update": ((0,), ("table",)),
+    "online_alter": ((0,), ("table",)),
+}
+
+# operations that touch no table
+_NO_TABLES = ("f", "inline_literal")
+
+# modules whose calls only build objects, such as ``sa.Column``
+_CONSTRUCTORS = ("sa", "sqlalchemy")
+
+_calls_cache = {}
+
+
+def _called_name(node):
+    func = node.func
+    if isinstance(func, ast.Attribute):
+        if isinstance(func.value, ast.Name) and func.value.id == "op":
+            return func.attr
+    elif isinstance(func, ast.Name) and func.id in _OPERATIONS:
+        return func.id
+    return None
+
+
+def _statement_calls(function):
+    """Return the ids of the calls of ``function`` that are not arguments
+    of, or called on the result of, another call, leaving out calls that
+    only build objects and those on ``batch_alter_table`` batches.
+
+    """
+    nested = set()
+    skipped = set(_CONSTRUCTORS)
+    for node in ast.walk(function):
+        if isinstance(node, ast.Call):
+            nested.update(
+                id(child)
+                for child in ast.walk(node)
+                if child is not node and isinstance(child, ast.Call)
+            )
+        elif isinstance(node, ast.withitem):
+            expr = node.context_expr
+            if (
+                isinstance(expr, ast.Call)
+                and _called_name(expr) == "batch_alter_table"
+                and isinstance(node.optional_vars, ast.Name)
+            ):
+                skipped.add(node.optional_vars.id)
+    statements = set()
+    for node in ast.walk(function):
+        if not isinstance(node, ast.Call) or id(node) in nested:
+            continue
+        func = node.func
+        if isinstance(func, ast.Attribute):
+            func = func.value
+        if isinstance(func, ast.Name) and func.id in skipped:
+            continue
+        statements.add(id(node))
+    return statements
+
+
+def _string(node):
+    try:
+        value = ast.literal_eval(node)
+    except ValueError:
+        return None
+    return value if isinstance(value, str) else None
+
+
+def _script_calls(path, function):
+    """Return ``(name, call)`` of the operations called by ``function`` in
+    the revision script at ``path``, in source order.  Other calls made
+    as statements, such as of helper functions, come with ``None`` as
+    their name.
+
+    Parsed sources are cached by path, modification time and size.
+
+    """
+    try:
+        stat = os.stat(path)
+    except (OSError, TypeError):
+        return []
+    key = (path, stat.st_mtime, stat.st_size, function)
+    calls = _calls_cache.get(key)
+    if calls is None:
+        calls = []
+        try:
+            with open(path, "rb") as file_:
+                tree = ast.parse(file_.read(), path)
+        except (SyntaxError, ValueError):
+            tree = None
+        for node in getattr(tree, "body", ()):
+            if isinstance(node, ast.FunctionDef) and node.name == function:
+                found = [
+                    call
+                    for call in ast.walk(node)
+                    if isinstance(call, ast.Call)
+                ]
+                found.sort(key=lambda call: (call.lineno, call.col_offset))
+                statements = _statement_calls(node)
+                calls = [
+                    (name, call)
+                    for name, call in zip(map(_called_name, found), found)
+                    if name is not None or id(call) in statements
+                ]
+        _calls_cache[key] = calls
+    return calls
+
+
+def script_operations(path, function):
+    """Return the ``op`` operations called by ``function`` in the revision
+    script at ``path``, in source order.
+
+    """
+    return [
+        name
+        for name, call in _script_calls(path, function)
+        if name is not None
+    ]
+
+
+def _foreign_tables(call):
+    # tables referenced by ForeignKey("table.column") in a create_table
+    tables = set()
+    for node in ast.walk(call):
+        if not isinstance(node, ast.Call):
+            continue
+        func = node.func
+        name = getattr(func, "attr", None) or getattr(func, "id", None)
+        if name == "ForeignKey" and node.args:
+            columns = [node.args[0]]
+        elif name == "ForeignKeyConstraint" and len(node.args) > 1:
+            columns = getattr(node.args[1], "elts", ())
+        else:
+            continue
+        for column in columns:
+            column = _string(column)
+            if column is None or "." not in column:
+                return None
+            tables.add(column.rsplit(".", 2)[-2])
+    return tables
+
+
+def script_tables(path, function):
+    """Return the names of the tables ``function`` in the revision script at
+    ``path`` touches, or ``None`` when that can not be told from its source,
+    such as for ``op.execute``, calls of helper functions or names that are
+    not literals.
+
+    """
+    tables = set()
+    for name, call in _script_calls(path, function):
+        if name in _NO_TABLES:
+            continue
+        if name not in _TABLE_ARGUMENTS:
+            return None
+        positions, keywords = _TABLE_ARGUMENTS[name]
+        nodes = [call.args[i] for i in positions if i < len(call.args)]
+        nodes.extend(kw.value for kw in call.keywords if kw.arg in keywords)
+        if not nodes:
+            return None
+        for node in nodes:
+            table = _string(node)
+            if table is None:
+                return None
+            tables.add(table)
+        if name == "create_table":
+            foreign = _foreign_tables(call)
+            if foreign is None:
+                return None
+            tables.update(foreign)
+    return tables
+
+
+class Plan:
+    """The ordered revision steps from ``heads`` to ``target``.
+
+    Each step is a ``dict`` of ``revision``, ``up_revisions``,
+    ``down_revisions``, ``direction``, ``doc``, ``path``, the
+    ``operations`` its function calls and, when timings were given, the
+    ``estimated_seconds`` it took before.
+
+    """
+
+    def __init__(self, heads, target, steps):
+        self.heads = heads
+        self.target = target
+        self.steps = steps
+
+    @property
+    def key(self):
+        return (self.heads, self.target)
+
+    @property
+    def direction(self):
+        if not self.steps:
+            return None
+        return self.steps[0]["direction"]
+
+    @property
+    def revisions(self):
+        return [step["revision"] for step in self.steps]
+
+    @property
+    def operations(self):
+        return sum(len(step["operations"]) for step in self.steps)
+
+    @property
+    def estimated_seconds(self):
+        """Sum of the known step timings, ``None`` if none are known."""
+        timings = [
+            step["estimated_seconds"]
+            for step in self.steps
+            if step.get("estimated_seconds") is not None
+        ]
+        return sum(timings) if timings else None
+
+    def to_dict(self):
+        return dict(
+            heads=list(self.heads),
+            target=self.target,
+            direction=self.direction,
+            operations=self.operations,
+            estimated_seconds=self.estimated_seconds,
+            steps=self.steps,
+        )
+
+    def __iter__(self):
+        return iter(self.steps)
+
+    def __len__(self):
+        return len(self.steps)
+
+    def __eq__(self, other):
+        return isinstance(other, Plan) and self.key == other.key
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self.key)
+
+    def __repr__(self):
+        return "Plan(%r -> %r, %d steps)" % (
+            self.heads,
+            self.target,
+            len(self.steps),
+        )
+
+
+def build_plan(heads, target, steps, timings=None):
+    """Describe the migration ``steps`` from ``heads`` to ``target``.
+
+    :param timings: optional ``dict`` of revision to seconds, such as the
+     ``elapsed`` of earlier ``revision_end`` events.
+
+    """
+    described = []
+    for step in steps:
+        info = _step_info(step)
+        script = step.revision
+        function = "upgrade" if info["direction"] == "upgrade" else "downgrade"
+        info.update(
+            doc=script.doc,
+            path=script.path,
+            operations=script_operations(script.path, function),
+        )
+        if timings is not None:
+            info["estimated_seconds"] = timings.get(info["revision"])
+        described.append(info)
+    return Plan(heads, target, described)
@@ -0,0 +1,348 @@
+"""Bulk and cached schema reflection for autogenerate.
+
+Alembic's autogenerate reflects the database one table at a time, and
+SQLAlchemy's inspector runs several catalog queries per table: on
+PostgreSQL about ten, three of them for the columns alone.  With thousands
+of tables, comparing the schema takes minutes.
+
+The :class:`.BulkInspector` takes the place of the dialect's inspector
+while autogenerate runs.  On first use of a schema it reflects every table
+of it at once, in a few catalog queries, for the dialects in
+:data:`PREFETCH`.  Anything not prefetched is reflected per table as
+usual.  Either way each result is reflected only once.
+
+Results are kept in a :class:`.ReflectionCache` file between runs, per
+database and the heads of its version table.  A database whose schema
+is only ever changed by migrations has the same schema at the same heads,
+so later runs skip reflection.  The table names are still read every time.
+If they changed, the cached entries of that schema are dropped.
+
+"""
+import copy
+import logging
+import os
+import pickle
+
+from sqlalchemy import sql
+from sqlalchemy.engine.reflection import Inspector
+
+logger = logging.getLogger(__name__)
+
+CACHE_FILE = "reflection_cache.pickle"
+CACHE_FORMAT = 1
+
+
+class ReflectionCache:
+    """The on-disk cache of reflected tables.
+
+    :param path: location of the cache file, or ``None`` for a cache that
+     lives as long as the object.
+
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self.databases = {}
+
+    def load(self):
+        if self.path is None:
+            return self
+        try:
+            with open(self.path, "rb") as file_:
+                data = pickle.load(file_)
+        except (IOError, EOFError, ValueError, pickle.UnpicklingError):
+            return self
+        except Exception as err:
+            # types of a dialect that is no longer installed, for instance
+            logger.warning("Could not read reflection cache: %s", err)
+            return self
+        if isinstance(data, dict) and data.get("format") == CACHE_FORMAT:
+            self.databases = data.get("databases", {})
+        return self
+
+    def save(self):
+        if self.path is None:
+            return
+        tmp_path = "%s.%d.tmp" % (self.path, os.getpid())
+        with open(tmp_path, "wb") as file_:
+            pickle.dump(
+                {"format": CACHE_FORMAT, "databases": self.databases}, file_
+            )
+        os.replace(tmp_path, self.path)
+
+    def entries(self, database, heads):
+        """Return the cached entries of ``database`` at ``heads``, starting
+        over if it was cached at other heads.
+
+        """
+        heads = tuple(sorted(heads))
+        cached = self.databases.get(database)
+        if cached is None or cached[0] != heads:
+            cached = self.databases[database] = (heads, {})
+        return cached[1]
+
+
+class BulkInspector(Inspector):
+    """An :class:`.Inspector` that reflects whole schemas at once and keeps
+    every result in ``entries``.
+
+    :param entries: ``dict`` of earlier results, such as those of a
+     :class:`.ReflectionCache`; updated in place.
+
+    """
+
+    def __init__(self, bind, entries=None):
+        init = getattr(Inspector, "_init_connection", None)
+        if init is not None:
+            # SQLAlchemy 1.4 deprecates the constructor
+            init(self, bind)
+        else:
+            Inspector.__init__(self, bind)
+        self.entries = {} if entries is None else entries
+        self.prefetched = set()
+
+    def get_table_names(self, schema=None, **kw):
+        names = Inspector.get_table_names(self, schema, **kw)
+        key = ("get_table_names", schema, None)
+        if self.entries.get(key) != sorted(names):
+            stale = [k for k in self.entries if k[1] == schema]
+            for k in stale:
+                del self.entries[k]
+            self.entries[key] = sorted(names)
+        return names
+
+    def _reflect(self, method, table_name, schema, kw):
+        key = (method, schema, table_name)
+        if key not in self.entries and schema not in self.prefetched:
+            self.prefetched.add(schema)
+            self.entries.update(prefetch(self, schema))
+        if key not in self.entries:
+            self.entries[key] = getattr(Inspector, method)(
+                self, table_name, schema=schema, **kw
+            )
+        # reflection modifies what it is given, the entries stay pristine
+        return copy.deepcopy(self.entries[key])
+
+    def get_columns(self, table_name, schema=None, **kw):
+        return self._reflect("get_columns", table_name, schema, kw)
+
+    def get_pk_constraint(self, table_name, schema=None, **kw):
+        return self._reflect("get_pk_constraint", table_name, schema, kw)
+
+    def get_foreign_keys(self, table_name, schema=None, **kw):
+        return self._reflect("get_foreign_keys", table_name, schema, kw)
+
+    def get_indexes(self, table_name, schema=None, **kw):
+        return self._reflect("get_indexes", table_name, schema, kw)
+
+    def get_unique_constraints(self, table_name, schema=None, **kw):
+        return self._reflect("get_unique_constraints", table_name, schema, kw)
+
+    def get_check_constraints(self, table_name, schema=None, **kw):
+        return self._reflect("get_check_constraints", table_name, schema, kw)
+
+    def get_table_comment(self, table_name, schema=None, **kw):
+        return self._reflect("get_table_comment", table_name, schema, kw)
+
+
+_POSTGRESQL_COLUMNS = """
+SELECT c.relname, a.attname,
+  pg_catalog.format_type(a.atttypid, a.atttypmod),
+  (SELECT pg_catalog.pg_get_expr(d.adbin, d.adrelid)
+    FROM pg_catalog.pg_attrdef d
+   WHERE d.adrelid = a.attrelid AND d.adnum = a.attnum
+   AND a.atthasdef),
+  a.attnotnull, pgd.description, %(generated)s
+FROM pg_catalog.pg_class c
+JOIN pg_catalog.pg_namespace n ON n.oid = c.relnamespace
+JOIN pg_catalog.pg_attribute a ON a.attrelid = c.oid
+LEFT JOIN pg_catalog.pg_description pgd ON (
+    pgd.objoid = a.attrelid AND pgd.objsubid = a.attnum)
+WHERE %(where)s AND a.attnum > 0 AND NOT a.attisdropped
+ORDER BY c.relname, a.attnum
+"""
+
+_POSTGRESQL_PRIMARY_KEYS = """
+SELECT c.relname, con.conname, a.attname
+FROM pg_catalog.pg_class c
+JOIN pg_catalog.pg_namespace n ON n.oid = c.relnamespace
+JOIN (
+    SELECT ix.indrelid, unnest(ix.indkey) attnum,
+           generate_subscripts(ix.indkey, 1) ord
+    FROM pg_catalog.pg_index ix
+    WHERE ix.indisprimary
+) k ON k.indrelid = c.oid
+JOIN pg_catalog.pg_attribute a ON a.attrelid = c.oid AND a.attnum = k.attnum
+LEFT JOIN pg_catalog.pg_constraint con
+  ON con.conrelid = c.oid AND con.contype = 'p'
+WHERE %(where)s
+ORDER BY c.relname, k.ord
+"""
+
+_POSTGRESQL_COMMENTS = """
+SELECT c.relname, pgd.description
+FROM pg_catalog.pg_class c
+JOIN pg_catalog.pg_namespace n ON n.oid = c.relnamespace
+LEFT JOIN pg_catalog.pg_description pgd
+  ON pgd.objoid = c.oid AND pgd.objsubid = 0
+  AND pgd.classoid = 'pg_catalog.pg_class'::regclass
+WHERE %(where)s
+"""
+
+
+def _postgresql_supported(dialect):
+    # the per-table reflection this mirrors changes between versions
+    code = getattr(dialect._get_column_info, "__code__", None)
+    return code is not None and code.co_varnames[1:10] == (
+        "name",
+        "format_type",
+        "default",
+        "notnull",
+        "domains",
+        "enums",
+        "schema",
+        "comment",
+        "generated",
+    )
+
+
+def _prefetch_postgresql(inspector, schema):
+    """Columns, primary keys and table comments of every table of
+    ``schema`` in five queries, post-processed by the dialect the way its
+    per-table reflection does.
+
+    """
+    dialect = inspector.dialect
+    if not _postgresql_supported(dialect):
+        return
+    bind = inspector.bind
+    if schema is not None:
+        where = "n.nspname = :schema"
+        params = {"schema": schema}
+    else:
+        where = "pg_catalog.pg_table_is_visible(c.oid)"
+        params = {}
+    where += " AND c.relkind IN ('r', 'p', 'v', 'm', 'f')"
+    generated = "NULL"
+    if dialect.server_version_info >= (12,):
+        generated = "a.attgenerated"
+
+    def query(template):
+        text = sql.text(template % dict(where=where, generated=generated))
+        return bind.execute(text, **params)
+
+    columns = {}
+    rows = query(_POSTGRESQL_COLUMNS).fetchall()
+    if rows:
+        domains = dialect._load_domains(bind)
+        enums = {}
+        for rec in dialect._load_enums(bind, schema="*"):
+            if rec["visible"]:
+                enums[(rec["name"],)] = rec
+            else:
+                enums[(rec["schema"], rec["name"])] = rec
+    for table, name, type_, default, notnull, comment, generated in rows:
+        columns.setdefault(table, []).append(
+            dialect._get_column_info(
+                name,
+                type_,
+                default,
+                notnull,
+                domains,
+                enums,
+                schema,
+                comment,
+                generated,
+            )
+        )
+
+    primary_keys = {}
+    for table, name, column in query(_POSTGRESQL_PRIMARY_KEYS):
+        pk = primary_keys.setdefault(
+            table, {"constrained_columns": [], "name": name}
+        )
+        pk["constrained_columns"].append(column)
+
+    for table, comment in query(_POSTGRESQL_COMMENTS):
+        yield ("get_columns", schema, table), columns.get(table, [])
+        yield ("get_pk_constraint", schema, table), primary_keys.get(
+            table, {"constrained_columns": [], "name": None}
+        )
+        yield ("get_table_comment", schema, table), {"text": comment}
+
+
+#: prefetch functions by dialect name, producing ``((method, schema,
+#: table), result)`` for all tables of a schema
+PREFETCH = {"postgresql": _prefetch_postgresql}
+
+
+def prefetch(inspector, schema):
+    """Reflect all tables of ``schema`` with the :data:`PREFETCH` function
+    of the inspector's dialect, if there is one.
+
+    """
+    fn = PREFETCH.get(inspector.dialect.name)
+    if fn is None:
+        return ()
+    return list(fn(inspector, schema))
+
+
+def _exclude_tables(include_object, names):
+    """Wrap the ``include_object`` hook of ``env.py``, which may be
+    ``None``, so that the tables ``names`` are left out.
+
+    """
+
+    def include(object_, name, type_, reflected, compare_to):
+        if type_ == "table" and name in names:
+            return False
+        if include_object is None:
+            return True
+        return include_object(object_, name, type_, reflected, compare_to)
+
+    return include
+
+
+def run_autogenerate(
+    revision_context, rev, migration_context, cache=None, exclude_tables=()
+):
+    """Run autogenerate of ``revision_context`` with a
+    :class:`.BulkInspector`, whose results are kept in ``cache``.
+
+    :param exclude_tables: names of tables left out of the comparison.
+
+    """
+    bind = migration_context.bind
+    if cache is not None:
+        entries = cache.entries(
+            repr(bind.engine.url), migration_context.get_current_heads()
+        )
+    else:
+        entries = {}
+    inspector = BulkInspector(bind, entries)
+
+    class _Inspector(BulkInspector):
+        def __new__(cls, *args, **kw):
+            return inspector
+
+    # alembic and SQLAlchemy ask the dialect for its inspector class
+    dialect = bind.dialect
+    dialect.inspector = _Inspector
+    opts = migration_context.opts
+    include_object = opts.get("include_object")
+    if exclude_tables:
+        opts["include_object"] = _exclude_tables(
+            include_object, set(exclude_tables)
+        )
+    try:
+        revision_context.run_autogenerate(rev, migration_context)
+    finally:
+        del dialect.inspector
+        opts["include_object"] = include_object
+
+    if cache is not None:
+        try:
+            cache.save()
+        except (IOError, OSError, pickle.PicklingError) as err:
+            logger.warning("Could not write reflection cache: %s", err)
+    return inspector
@@ -0,0 +1,178 @@
+"""The ``moonshine serve`` daemon and the commands shared with the CLI.
+
+The daemon keeps one :class:`.Moonshine`, so the ``ScriptDirectory``, the
+compiled ``env.py`` and one engine pool per url stay warm between commands.
+It listens on a local Unix socket and speaks one JSON object per line in
+each direction::
+
+    {"command": "upgrade", "url": "postgresql://...", "revision": "head"}
+    {"output": "", "error": null}
+
+Commands are answered one at a time, as alembic's ``context`` and ``op``
+proxies are process wide.  New and changed revision files are picked up by
+comparing the modification times and sizes of the files in the version
+directories before each command.
+
+Only the standard library is imported here, so that the CLI can act as a
+client without loading alembic.
+
+"""
+import json
+import logging
+import os
+import socket
+import socketserver
+
+logger = logging.getLogger(__name__)
+
+COMMANDS = ("upgrade", "downgrade", "stamp", "current", "history", "heads")
+
+# commands that do not need a database unless asked for the current revision
+_SCRIPT_COMMANDS = ("history", "heads")
+
+
+def _format(scripts, verbose=False, **kw):
+    return "\n".join(sc.cmd_format(verbose, **kw) for sc in scripts)
+
+
+def execute(moonshine, command, url=None, **kw):
+    """Run the CLI ``command`` with ``moonshine`` and return its text output.
+
+    :param url: database url; defaults to the ``sqlalchemy.url`` option of
+     the configuration file.  Engines are created once per url.
+
+    """
+    from alembic import util
+
+    if command not in COMMANDS:
+        raise util.CommandError("No such command %r" % command)
+    if url is None:
+        url = moonshine.config.get_main_option("sqlalchemy.url")
+    if url is not None:
+        moonshine.engine = moonshine._get_engine(url)
+    elif command not in _SCRIPT_COMMANDS or kw.get("indicate_current"):
+        raise util.CommandError("%s needs a database url, see --url" % command)
+
+    verbose = kw.get("verbose", False)
+    if command == "upgrade" or command == "downgrade":
+        output = getattr(moonshine, command)(
+            kw["revision"], sql=kw.get("sql", False), tag=kw.get("tag")
+        )
+    elif command == "stamp":
+        output = moonshine.stamp(
+            kw["revision"],
+            sql=kw.get("sql", False),
+            tag=kw.get("tag"),
+            purge=kw.get("purge", False),
+        )
+    elif command == "current":
+        output = _format(moonshine.current, verbose)
+    elif command == "heads":
+        output = _format(
+            moonshine.heads(kw.get("resolve_dependencies", False)),
+            verbose,
+            include_branches=True,
+            tree_indicators=False,
+        )
+    else:
+        output = _format(
+            moonshine.history(
+                kw.get("rev_range") or "base:heads",
+                indicate_current=kw.get("indicate_current", False),
+            ),
+            verbose,
+            include_branches=True,
+            include_doc=True,
+            include_parents=True,
+        )
+    return output or ""
+
+
+def _versions_stamp(moonshine):
+    stamp = []
+    for path in moonshine.script_directory._version_locations:
+        try:
+            files = sorted(
+                (entry.name, entry.stat().st_mtime_ns, entry.stat().st_size)
+                for entry in os.scandir(path)
+                if entry.is_file()
+            )
+            stamp.append((path, os.stat(path).st_mtime_ns, files))
+        except OSError:
+            stamp.append((path, None, None))
+    return stamp
+
+
+class _Handler(socketserver.StreamRequestHandler):
+    def handle(self):
+        for line in self.rfile:
+            if not line.strip():
+                continue
+            response = self.server.answer(line)
+            self.wfile.write(json.dumps(response).encode("utf-8") + b"\n")
+            self.wfile.flush()
+
+
+class Server(socketserver.UnixStreamServer):
+    """Answers CLI commands for ``moonshine`` on the Unix socket ``path``."""
+
+    def __init__(self, moonshine, path):
+        self.moonshine = moonshine
+        self.path = path
+        self._stamp = _versions_stamp(moonshine)
+        if os.path.exists(path):
+            os.unlink(path)
+        socketserver.UnixStreamServer.__init__(self, path, _Handler)
+
+    def answer(self, line):
+        try:
+            request = json.loads(line.decode("utf-8"))
+            command = request.pop("command")
+            stamp = _versions_stamp(self.moonshine)
+            if stamp != self._stamp:
+                logger.info("Version directories changed, reloading")
+                self.moonshine.invalidate()
+                self._stamp = _versions_stamp(self.moonshine)
+            return dict(
+                output=execute(self.moonshine, command, **request),
+                error=None,
+            )
+        except Exception as err:
+            logger.exception("Command failed")
+            return dict(output=None, error=str(err) or repr(err))
+
+    def server_close(self):
+        socketserver.UnixStreamServer.server_close(self)
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+
+def serve(moonshine, path):
+    """Answer commands on ``path`` until interrupted."""
+    server = Server(moonshine, path)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+def request(path, command, **kw):
+    """Send ``command`` to the daemon listening on ``path``.
+
+    :return: ``dict`` of the command's ``output`` and ``error``.
+
+    """
+    kw["command"] = command
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        client.connect(path)
+        client.sendall(json.dumps(kw).encode("utf-8") + b"\n")
+        with client.makefile("rb") as reader:
+            line = reader.readline()
+    finally:
+        client.close()
+    if not line:
+        raise ConnectionError("No response from %s" % path)
+    return json.loads(line.decode("utf-8"))
@@ -0,0 +1,205 @@
+"""Squash the start of the revision history into one baseline revision.
+
+A new database replays every revision from ``base``.  :func:`.squash` runs
+the revisions up to a given one on a scratch database, reflects the schema
+they produce and writes it out as a single baseline revision, which takes
+over the identifier of that revision.  The revision files it replaces are
+moved into a ``replaced/`` directory next to them, where alembic does not
+look for revisions.
+
+Databases already at or past the squashed revision carry on as before, as
+the identifier in their version table is unchanged.  Databases behind it
+must be upgraded past it before squashing.
+
+The baseline is built from reflection, so it holds tables, columns,
+constraints and indexes, but no data inserted by the replaced revisions,
+nor views, triggers, sequences or anything else reflection does not see.
+
+"""
+import logging
+import os
+
+from alembic import util
+from alembic.autogenerate import render
+from alembic.autogenerate.api import AutogenContext
+from alembic.operations import ops
+from alembic.runtime.migration import MigrationContext
+from sqlalchemy import MetaData, create_engine
+
+logger = logging.getLogger(__name__)
+
+REPLACED_DIRECTORY = "replaced"
+
+_VERSION_TABLE = "alembic_version"
+
+
+def replaced_revisions(script_directory, revision):
+    """Return the scripts that squashing up to ``revision`` replaces:
+    ``revision`` itself and all of its ancestors, dependencies included.
+
+    :raises CommandError: if a revision outside of those depends on any
+     but ``revision``, which would leave it dangling.
+
+    """
+    script = script_directory.get_revision(revision)
+    if script is None:
+        raise util.CommandError("No such revision %r" % revision)
+
+    replaced = {}
+    todo = [script]
+    while todo:
+        sc = todo.pop()
+        if sc.revision in replaced:
+            continue
+        replaced[sc.revision] = sc
+        todo.extend(
+            script_directory.get_revision(down)
+            for down in sc._all_down_revisions
+        )
+    if len(replaced) == 1:
+        raise util.CommandError(
+            "Revision %s is a base already, nothing to squash"
+            % script.revision
+        )
+
+    for sc in script_directory.walk_revisions():
+        if sc.revision in replaced:
+            continue
+        for down in sc._all_down_revisions:
+            if down in replaced and down != script.revision:
+                raise util.CommandError(
+                    "Revision %s depends on %s, which would be squashed; "
+                    "squash up to a revision that all later revisions "
+                    "descend from" % (sc.revision, down)
+                )
+    return script, list(replaced.values())
+
+
+def reflect_schema(moonshine, revision, url):
+    """Upgrade the scratch database at ``url`` to ``revision`` and return
+    the reflected :class:`.MetaData`, without the version table and the
+    other tables Moonshine keeps its own state in.
+
+    """
+    engine = create_engine(url)
+    try:
+        with engine.connect() as connection:
+            if engine.dialect.get_table_names(connection):
+                raise util.CommandError(
+                    "Scratch database %s is not empty" % engine.url
+                )
+            moonshine.upgrade(revision, connection=connection)
+            metadata = MetaData()
+            metadata.reflect(bind=connection)
+    finally:
+        engine.dispose()
+    for name in {_VERSION_TABLE} | moonshine._bookkeeping_tables():
+        if name in metadata.tables:
+            metadata.remove(metadata.tables[name])
+    return metadata, engine.dialect.name
+
+
+def schema_operations(metadata):
+    """Return the ``UpgradeOps`` creating and the ``DowngradeOps``
+    dropping every table of ``metadata``.
+
+    """
+    upgrade, downgrade = [], []
+    for table in metadata.sorted_tables:
+        upgrade.append(ops.CreateTableOp.from_table(table))
+        upgrade.extend(ops.CreateIndexOp.from_index(i) for i in table.indexes)
+    for table in reversed(metadata.sorted_tables):
+        downgrade.extend(ops.DropIndexOp.from_index(i) for i in table.indexes)
+        downgrade.append(ops.DropTableOp.from_table(table))
+    return ops.UpgradeOps(upgrade), ops.DowngradeOps(downgrade)
+
+
+def render_operations(upgrade_ops, downgrade_ops, dialect_name):
+    """Render the operations into ``upgrades``, ``downgrades`` and
+    ``imports`` template arguments of ``script.py.mako``.
+
+    """
+    context = MigrationContext.configure(dialect_name=dialect_name)
+    autogen_context = AutogenContext(
+        context,
+        opts=dict(
+            sqlalchemy_module_prefix="sa.",
+            alembic_module_prefix="op.",
+            render_item=None,
+            render_as_batch=False,
+        ),
+    )
+    template_args = {}
+    render._render_python_into_templatevars(
+        autogen_context,
+        ops.MigrationScript(None, upgrade_ops, downgrade_ops),
+        template_args,
+    )
+    return template_args
+
+
+def _branch_labels(replaced):
+    # labels of the replaced revisions now label their descendant baseline
+    labels = set()
+    for sc in replaced:
+        labels.update(sc._orig_branch_labels)
+    return tuple(sorted(labels)) or None
+
+
+def _move(path, directory):
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    destination = os.path.join(directory, os.path.basename(path))
+    os.replace(path, destination)
+    return destination
+
+
+def squash(moonshine, revision, message=None, url="sqlite://"):
+    """Replace ``revision`` and its ancestors by a baseline revision.
+
+    :return: the baseline :class:`.Script`.
+
+    """
+    script_directory = moonshine.script_directory
+    script, replaced = replaced_revisions(script_directory, revision)
+
+    metadata, dialect_name = reflect_schema(moonshine, script.revision, url)
+    template_args = render_operations(
+        *schema_operations(metadata), dialect_name=dialect_name
+    )
+    if message is None:
+        message = "baseline of %s" % script.revision
+
+    moved = []
+    try:
+        for sc in replaced:
+            directory = os.path.join(
+                os.path.dirname(sc.path), REPLACED_DIRECTORY
+            )
+            moved.append((_move(sc.path, directory), sc.path))
+
+        create_date = script_directory._generate_create_date()
+        path = script_directory._rev_path(
+            os.path.dirname(script.path), script.revision, message, create_date
+        )
+        script_directory._generate_template(
+            os.path.join(script_directory.dir, "script.py.mako"),
+            path,
+            up_revision=script.revision,
+            down_revision=None,
+            branch_labels=_branch_labels(replaced),
+            depends_on=None,
+            create_date=create_date,
+            comma=util.format_as_comma,
+            message=message,
+            **template_args
+        )
+    except Exception:
+        for destination, source in reversed(moved):
+            os.replace(destination, source)
+        raise
+    finally:
+        moonshine.invalidate()
+
+    logger.info("Squashed %d revisions into baseline %s", len(replaced), path)
+    return moonshine.script_directory.get_revision(script.revision)
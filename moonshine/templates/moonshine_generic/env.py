@@ -17,6 +17,10 @@ target_metadata = config.attributes.get("target_metadata", None)
 
 engine = config.attributes.get("engine", None)
 output_buffer = config.attributes.get("output_buffer", None)
+transaction_per_migration = config.attributes.get(
+    "transaction_per_migration", False
+)
+on_version_apply = config.attributes.get("on_version_apply", ())
 
 
 def run_migrations_offline():
@@ -38,6 +42,7 @@ def run_migrations_offline():
         literal_binds=True,
         dialect_opts={"paramstyle": "named"},
         output_buffer=output_buffer,
+        transaction_per_migration=transaction_per_migration,
     )
 
     with context.begin_transaction():
@@ -48,16 +53,29 @@ def run_migrations_online():
     """Run migrations in 'online' mode.
 
     In this scenario we need to create an Engine
-    and associate a connection with the context.
+    and associate a connection with the context,
+    unless Moonshine handed us a connection to use.
 
     """
+    connection = config.attributes.get("connection", None)
+    if connection is not None:
+        do_run_migrations(connection)
+        return
+
     with engine.connect() as connection:
-        context.configure(
-            connection=connection, target_metadata=target_metadata
-        )
+        do_run_migrations(connection)
+
+
+def do_run_migrations(connection):
+    context.configure(
+        connection=connection,
+        target_metadata=target_metadata,
+        transaction_per_migration=transaction_per_migration,
+        on_version_apply=on_version_apply,
+    )
 
-        with context.begin_transaction():
-            context.run_migrations()
+    with context.begin_transaction():
+        context.run_migrations()
 
 
 if context.is_offline_mode():
@@ -28,6 +28,27 @@ script_location = %(here)s/${script_location}
 # directories, initial revisions must be specified with --version-path
 # version_locations = %(here)s/bar %(here)s/bat ${script_location}/versions
 
+# cache the revision graph in this file so that heads, history and
+# branches do not import every revision script
+# revision_index = %(here)s/${script_location}/revision_index.json
+
+# set to 'true' to answer heads and current from a compact revision
+# graph, importing revision scripts only when a migration runs
+# compact_revisions = false
+
+# keep the tables reflected by autogenerate in this file, reused as long
+# as the database stays at the same heads
+# reflection_cache = %(here)s/${script_location}/reflection_cache.pickle
+
+# set to 'true' to keep the heads in a single-row moonshine_version
+# table, read in one round trip, and record every applied revision in
+# moonshine_history
+# version_store = false
+
+# set to 'true' to take a database lock around upgrade, downgrade and
+# stamp, so that processes starting together migrate one at a time
+# migration_lock = false
+
 # the output encoding used when revision files
 # are written from script.py.mako
 # output_encoding = utf-8
@@ -0,0 +1,123 @@
+"""Lock and statement timeouts for the migration connection.
+
+A migration waiting on a lock queues the application's queries behind it.
+With a lock timeout the migration gives up instead, and Moonshine retries
+the run after a jittered, exponential backoff.
+
+Timeouts are given in seconds, to :class:`.Moonshine`, per call to
+``upgrade`` and ``downgrade``, or per revision as module attributes of the
+revision script, which win over the others::
+
+    revision = "ae1027a6acf"
+    down_revision = "1975ea83b712"
+    lock_timeout = 2
+    statement_timeout = 600
+
+They are set with ``SET`` statements before each step, on PostgreSQL as
+``lock_timeout`` and ``statement_timeout`` and on MySQL as
+``lock_wait_timeout``, ``innodb_lock_wait_timeout`` and
+``max_execution_time``.  Other dialects are left alone.
+
+"""
+import random
+
+LOCK = "lock"
+STATEMENT = "statement"
+
+# SQLSTATE of PostgreSQL and error numbers of MySQL for timed out statements
+_POSTGRESQL_CODES = {"55P03": LOCK, "57014": STATEMENT}
+_MYSQL_CODES = {1205: LOCK, 3024: STATEMENT}
+
+
+def timeout_kind(error):
+    """Return :data:`.LOCK` or :data:`.STATEMENT` when ``error`` is a
+    timed out statement, otherwise ``None``.
+
+    """
+    orig = getattr(error, "orig", error)
+    code = getattr(orig, "pgcode", None) or getattr(orig, "sqlstate", None)
+    if code in _POSTGRESQL_CODES:
+        return _POSTGRESQL_CODES[code]
+    args = getattr(orig, "args", None)
+    if args and isinstance(args[0], int) and args[0] in _MYSQL_CODES:
+        return _MYSQL_CODES[args[0]]
+    return None
+
+
+def backoff(attempt, base=1.0, cap=30.0):
+    """Seconds to wait before retry ``attempt``, counting from 0: a random
+    share of the exponentially growing, capped delay ("full jitter").
+
+    """
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+def set_statements(dialect, lock_timeout, statement_timeout):
+    """Return the statements that set the timeouts for ``dialect``;
+    ``None`` restores the server default.
+
+    """
+    if dialect == "postgresql":
+
+        def value(seconds):
+            if seconds is None:
+                return "DEFAULT"
+            return "'%dms'" % int(seconds * 1000)
+
+        return [
+            "SET lock_timeout = %s" % value(lock_timeout),
+            "SET statement_timeout = %s" % value(statement_timeout),
+        ]
+    if dialect == "mysql":
+
+        def value(seconds, scale=1, minimum=1):
+            if seconds is None:
+                return "DEFAULT"
+            return "%d" % max(minimum, int(seconds * scale))
+
+        return [
+            "SET SESSION lock_wait_timeout = %s" % value(lock_timeout),
+            "SET SESSION innodb_lock_wait_timeout = %s" % value(lock_timeout),
+            "SET SESSION max_execution_time = %s"
+            % value(statement_timeout, 1000, 0),
+        ]
+    return []
+
+
+class Guard:
+    """Sets the timeouts of each migration step, falling back to the given
+    defaults when the revision script does not name its own.
+
+    """
+
+    def __init__(self, lock_timeout=None, statement_timeout=None):
+        self.lock_timeout = lock_timeout
+        self.statement_timeout = statement_timeout
+
+    def wrap(self, fn):
+        def guarded(rev, context):
+            return self.steps(fn(rev, context), context)
+
+        return guarded
+
+    def timeouts(self, step):
+        script = getattr(step, "revision", None)
+        module = getattr(script, "module", None)
+        return (
+            getattr(module, "lock_timeout", self.lock_timeout),
+            getattr(module, "statement_timeout", self.statement_timeout),
+        )
+
+    def steps(self, steps, context):
+        dialect = context.dialect.name
+        current = (None, None)
+        for step in steps:
+            timeouts = self.timeouts(step)
+            if timeouts != current:
+                for statement in set_statements(dialect, *timeouts):
+                    context.execute(statement)
+                current = timeouts
+            yield step
+        if current != (None, None):
+            for statement in set_statements(dialect, None, None):
+                context.execute(statement)
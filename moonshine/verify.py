@@ -0,0 +1,146 @@
+"""Find revision files that changed after they were applied.
+
+The :class:`.TableVersionStore` records the SHA-1 of each revision file as
+it is applied.  :func:`.verify` compares those with the files as they are
+now, and reports each difference as a :class:`.Drift`.
+
+The current checksums come from a :class:`.RevisionIndex`: a file is only
+hashed again when its modification time or size changed since it was
+indexed, and never imported.  The applied checksums of a database are read
+in a single query.  :func:`.verify_many` computes the current checksums
+once and compares every database of a fleet against them.
+
+"""
+import logging
+import os
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+from alembic import util
+
+from .fleet import FleetResult, target_name
+from .index import INDEX_FILE, RevisionIndex
+
+logger = logging.getLogger(__name__)
+
+
+class Drift:
+    """A revision whose file differs from the one that was applied.
+
+    ``current`` is ``None`` when the file is gone.
+
+    """
+
+    def __init__(self, revision, path, applied, current):
+        self.revision = revision
+        self.path = path
+        self.applied = applied
+        self.current = current
+
+    @property
+    def missing(self):
+        return self.current is None
+
+    def __repr__(self):
+        return "Drift(%r, applied=%r, current=%r)" % (
+            self.revision,
+            self.applied,
+            self.current,
+        )
+
+
+def file_checksums(moonshine):
+    """Return ``{revision: (path, checksum)}`` for the revision files of
+    ``moonshine``, through its revision index if it has one.
+
+    """
+    script_directory = moonshine.script_directory
+    index_path = moonshine._revision_index_path()
+    if index_path is True:
+        index_path = os.path.join(script_directory.dir, INDEX_FILE)
+    index = RevisionIndex(index_path)
+    if index_path:
+        index.load()
+    entries = index.refresh(script_directory)
+    if index_path:
+        try:
+            index.save()
+        except (IOError, OSError) as err:
+            logger.warning("Could not write revision index: %s", err)
+    return {
+        entry["revision"]: (path, entry["sha1"]) for path, entry in entries
+    }
+
+
+def compare(applied, checksums):
+    """Return the :class:`.Drift` of each revision whose ``applied``
+    checksum differs from the current one, sorted by revision.
+
+    """
+    drift = []
+    for revision, checksum in sorted(applied.items()):
+        if checksum is None:
+            # stamped, or applied before checksums were recorded
+            continue
+        path, current = checksums.get(revision, (None, None))
+        if current != checksum:
+            drift.append(Drift(revision, path, checksum, current))
+    return drift
+
+
+def _applied_checksums(moonshine, engine):
+    store = moonshine.version_store
+    with engine.connect() as conn:
+        applied = store.applied_checksums(conn)
+    if applied is None:
+        raise util.CommandError(
+            "%s does not record checksums, set version_store"
+            % type(store).__name__
+        )
+    return applied
+
+
+def verify(moonshine, engine, checksums=None):
+    """Compare the revision files applied to ``engine`` with the current
+    ones.
+
+    :return: list of :class:`.Drift`, empty if nothing changed.
+
+    """
+    if checksums is None:
+        checksums = file_checksums(moonshine)
+    return compare(_applied_checksums(moonshine, engine), checksums)
+
+
+def verify_many(moonshine, targets, max_workers=None):
+    """:func:`.verify` many targets concurrently, on a thread pool.
+
+    :return: list of :class:`.FleetResult`, in the order of ``targets``,
+     whose output is the list of :class:`.Drift`.
+
+    """
+    targets = list(targets)
+    if max_workers is None:
+        max_workers = (os.cpu_count() or 1) + 4
+    max_workers = max(1, min(max_workers, len(targets)))
+    checksums = file_checksums(moonshine)
+
+    def run(target):
+        start = time.time()
+        output = error = None
+        try:
+            engine = moonshine._get_engine(target)
+            output = verify(moonshine, engine, checksums)
+        except Exception:
+            error = traceback.format_exc()
+            logger.error("verify failed for %s", target_name(target))
+        return FleetResult(
+            target_name(target),
+            output=output,
+            elapsed=time.time() - start,
+            error=error,
+        )
+
+    with ThreadPoolExecutor(max_workers) as executor:
+        return list(executor.map(run, targets))
@@ -0,0 +1,314 @@
+"""Where Moonshine reads the current heads from, and records what it applied.
+
+Alembic reads the ``alembic_version`` table with a table existence check
+and a select of all its rows.  The :class:`.TableVersionStore` keeps the
+heads in a single row of its own table instead: a JSON list with a checksum
+and the time it was written, read and written by primary key in one round
+trip each.  Each applied migration step adds a row to a history table,
+with its direction, duration, host and the checksum of the revision file,
+so that what ran where can be audited from the database, and files
+changed after they were applied found by :mod:`moonshine.verify`.
+
+Alembic still maintains ``alembic_version`` while migrating, as its
+migration logic depends on it.  The store is written from alembic's
+``on_version_apply`` callback, in the same transaction as each step.
+Online migrations only: ``--sql`` scripts do not write the store, except
+for those :meth:`.Moonshine.upgrade_grouped` executes, which record their
+steps and sync it afterwards.  Every online run syncs the store, even when
+there was nothing to apply, so it catches up with versions changed without
+it.  A store row whose checksum does not match, or a missing store table,
+falls back to ``alembic_version``.
+
+"""
+import hashlib
+import json
+import logging
+import socket
+import time
+
+from alembic.runtime.migration import MigrationContext
+from sqlalchemy import (
+    Column,
+    DateTime,
+    Float,
+    Integer,
+    MetaData,
+    String,
+    Table,
+    Text,
+    exc,
+    func,
+    select,
+)
+
+from .instrument import _migration_info
+
+logger = logging.getLogger(__name__)
+
+_ROW_ID = 1
+
+#: default names of the tables of :class:`.TableVersionStore`
+VERSION_TABLE = "moonshine_version"
+HISTORY_TABLE = "moonshine_history"
+
+
+def heads_checksum(heads):
+    """Checksum of a set of heads, as stored next to them."""
+    text = json.dumps(sorted(heads))
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+
+def alembic_heads(connection):
+    """The heads of alembic's version table."""
+    return tuple(MigrationContext.configure(connection).get_current_heads())
+
+
+def file_checksum(path):
+    """SHA-1 of the file at ``path``, or ``None`` if it can not be read."""
+    try:
+        with open(path, "rb") as file_:
+            return hashlib.sha1(file_.read()).hexdigest()
+    except (IOError, OSError, TypeError):
+        return None
+
+
+def script_checksum(script):
+    """SHA-1 of the file of ``script``, from the revision index if it
+    comes from one.
+
+    """
+    checksum = getattr(script, "checksum", None)
+    if checksum is None:
+        checksum = file_checksum(getattr(script, "path", None))
+    return checksum
+
+
+class VersionStore:
+    """Reads the heads from alembic's version table, and records nothing.
+
+    The default store; subclasses override :meth:`.read_heads`,
+    :meth:`.write_heads`, :meth:`.record`, :meth:`.history` and
+    :meth:`.applied_checksums`.
+
+    """
+
+    def read_heads(self, connection):
+        return alembic_heads(connection)
+
+    def write_heads(self, connection, heads):
+        pass
+
+    def record(
+        self, connection, revision, direction, duration=None, checksum=None
+    ):
+        pass
+
+    def history(self, connection, limit=None):
+        return []
+
+    def applied_checksums(self, connection):
+        """Return the checksum of each applied revision file by revision,
+        or ``None`` if the store does not record them.
+
+        """
+        return None
+
+    def sync(self, connection):
+        """Write the heads of alembic's version table to the store."""
+
+    def wrap(self, fn):
+        """Wrap a migration function so that its steps are recorded, and
+        the heads written after each of them; see :class:`._Recorder`.
+
+        """
+        return _Recorder(self, fn)
+
+
+class _Recorder:
+    """The migration function of one run, which records each step and the
+    heads after it from alembic's ``on_version_apply`` callback, inside
+    the transaction of the step.
+
+    ``env.py`` passes :meth:`.on_version_apply` to ``context.configure``
+    as the ``on_version_apply`` config attribute; it is added to the
+    migration context here for an ``env.py`` that does not.
+
+    """
+
+    def __init__(self, store, fn):
+        self.store = store
+        self.fn = fn
+        self.started = None
+
+    def __call__(self, rev, context):
+        steps = self.fn(rev, context)
+        if context.as_sql or context.connection is None:
+            return steps
+        callbacks = tuple(context.on_version_apply_callbacks)
+        if self.on_version_apply not in callbacks:
+            context.on_version_apply_callbacks = callbacks + (
+                self.on_version_apply,
+            )
+        return self.steps(steps, context)
+
+    def steps(self, steps, context):
+        ran = False
+        for step in steps:
+            self.started = time.perf_counter()
+            ran = True
+            yield step
+        if not ran:
+            # catch up with version changes made without the store
+            self.store.sync(context.connection)
+
+    def on_version_apply(self, ctx, step, heads, run_args):
+        if ctx.as_sql:
+            return
+        info = _migration_info(step)
+        checksum = None
+        if step.is_migration and len(step.up_revision_ids) == 1:
+            checksum = script_checksum(step.up_revision)
+        duration = None
+        if self.started is not None:
+            duration = time.perf_counter() - self.started
+        self.store.record(
+            ctx.connection,
+            info["revision"],
+            info["direction"],
+            duration,
+            checksum,
+        )
+        self.store.write_heads(ctx.connection, heads)
+
+
+class TableVersionStore(VersionStore):
+    """Keeps the heads in a single row of ``table`` and the applied steps
+    in ``history_table``.
+
+    The tables are created when first written to.
+
+    """
+
+    def __init__(
+        self,
+        table=VERSION_TABLE,
+        history_table=HISTORY_TABLE,
+        schema=None,
+    ):
+        metadata = MetaData()
+        self.table = Table(
+            table,
+            metadata,
+            Column("id", Integer, primary_key=True, autoincrement=False),
+            Column("heads", Text, nullable=False),
+            Column("checksum", String(40), nullable=False),
+            Column("applied_at", DateTime, nullable=False),
+            schema=schema,
+        )
+        self.history_table = Table(
+            history_table,
+            metadata,
+            Column("id", Integer, primary_key=True),
+            Column("revision", String(255), nullable=False, index=True),
+            Column("direction", String(16), nullable=False),
+            Column("applied_at", DateTime, nullable=False),
+            Column("duration", Float),
+            Column("host", String(255)),
+            Column("checksum", String(40)),
+            schema=schema,
+        )
+        self.metadata = metadata
+        self.host = socket.gethostname()
+        self._created = set()
+
+    def read_heads(self, connection):
+        table = self.table
+        try:
+            row = connection.execute(
+                select([table.c.heads, table.c.checksum]).where(
+                    table.c.id == _ROW_ID
+                )
+            ).first()
+        except exc.DBAPIError:
+            row = None
+        if row is None:
+            return VersionStore.read_heads(self, connection)
+        heads = tuple(json.loads(row[0]))
+        if row[1] != heads_checksum(heads):
+            logger.warning(
+                "Checksum of %s does not match its heads, reading %s",
+                table.name,
+                "alembic_version",
+            )
+            return VersionStore.read_heads(self, connection)
+        return heads
+
+    def _create(self, connection):
+        key = repr(connection.engine.url)
+        if key not in self._created:
+            self.metadata.create_all(connection, checkfirst=True)
+            self._created.add(key)
+
+    def sync(self, connection):
+        self.write_heads(connection, alembic_heads(connection))
+
+    def write_heads(self, connection, heads):
+        self._create(connection)
+        table = self.table
+        values = dict(
+            heads=json.dumps(sorted(heads)),
+            checksum=heads_checksum(heads),
+            applied_at=func.current_timestamp(),
+        )
+        result = connection.execute(
+            table.update().where(table.c.id == _ROW_ID).values(**values)
+        )
+        if result.rowcount == 0:
+            connection.execute(table.insert().values(id=_ROW_ID, **values))
+
+    def record(
+        self, connection, revision, direction, duration=None, checksum=None
+    ):
+        self._create(connection)
+        connection.execute(
+            self.history_table.insert().values(
+                revision=revision,
+                direction=direction,
+                applied_at=func.current_timestamp(),
+                duration=duration,
+                host=self.host,
+                checksum=checksum,
+            )
+        )
+
+    def history(self, connection, limit=None):
+        """Return the recorded steps as ``dict`` objects, latest first."""
+        table = self.history_table
+        query = select([table]).order_by(table.c.id.desc())
+        if limit is not None:
+            query = query.limit(limit)
+        try:
+            rows = connection.execute(query).fetchall()
+        except exc.DBAPIError:
+            return []
+        return [dict(zip(row.keys(), row)) for row in rows]
+
+    def applied_checksums(self, connection):
+        """The checksums of the revisions whose latest step is an upgrade,
+        in one query over the history.
+
+        """
+        table = self.history_table
+        latest = select([func.max(table.c.id)]).group_by(table.c.revision)
+        query = select(
+            [table.c.revision, table.c.direction, table.c.checksum]
+        ).where(table.c.id.in_(latest))
+        try:
+            rows = connection.execute(query).fetchall()
+        except exc.DBAPIError:
+            return {}
+        return {
+            revision: checksum
+            for revision, direction, checksum in rows
+            if direction == "upgrade"
+        }
@@ -0,0 +1,52 @@
+"""Shared fixtures for `moonshine` tests."""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from moonshine import Moonshine
+
+
+class MoonshineTestCase(unittest.TestCase):
+    """Builds a throwaway migration environment backed by SQLite."""
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.tempdir = tempfile.mkdtemp()
+        os.chdir(self.tempdir)
+        self.config_file = os.path.join(self.tempdir, "moonshine.ini")
+        self.directory = os.path.join(self.tempdir, "migrations")
+        Moonshine(config_file=self.config_file).init("migrations")
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.tempdir)
+
+    def database_url(self, name="test"):
+        return "sqlite:///%s" % os.path.join(self.tempdir, "%s.db" % name)
+
+    def moonshine(self, name="test", **kw):
+        return Moonshine(
+            config_file=self.config_file,
+            engine_config={"sqlalchemy.url": self.database_url(name)},
+            **kw
+        )
+
+    def make_revisions(self, count, **kw):
+        moonshine = Moonshine(config_file=self.config_file)
+        return [
+            moonshine.revision(message="revision %d" % i, **kw)
+            for i in range(count)
+        ]
+
+    def write_upgrade(self, script, body):
+        """Replace the ``upgrade()`` body of a generated revision."""
+        with open(script.path) as file_:
+            source = file_.read()
+        with open(script.path, "w") as file_:
+            file_.write(
+                source.replace(
+                    "def upgrade():\n    pass", "def upgrade():\n    " + body
+                )
+            )
@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+
+"""Tests for `moonshine.branches`."""
+
+from sqlalchemy import create_engine, inspect
+
+from moonshine.branches import groups
+from moonshine.plan import script_tables
+from tests.helpers import MoonshineTestCase
+
+
+def create_table(name, *extra):
+    columns = ["sa.Column('id', sa.Integer, primary_key=True)"]
+    columns.extend(extra)
+    return "op.create_table('%s', %s)" % (name, ", ".join(columns))
+
+
+class TestBranches(MoonshineTestCase):
+    """Tests for upgrading independent branches concurrently."""
+
+    def branch(self, label, body):
+        (script,) = self.make_revisions(1, head="base", branch_label=label)
+        self.write_upgrade(script, body)
+        return script
+
+    def test_script_tables(self):
+        (script,) = self.make_revisions(1)
+        self.write_upgrade(
+            script,
+            create_table(
+                "invoice",
+                "sa.Column('account_id', sa.ForeignKey('account.id'))",
+            )
+            + "\n    op.create_index('ix_x', 'ledger', ['id'])",
+        )
+        assert script_tables(script.path, "upgrade") == {
+            "invoice",
+            "account",
+            "ledger",
+        }
+
+        assert script_tables(script.path, "downgrade") == set()
+        (script,) = self.make_revisions(1)
+        self.write_upgrade(script, "op.execute('DELETE FROM account')")
+        assert script_tables(script.path, "upgrade") is None
+
+    def test_script_tables_helper(self):
+        (script,) = self.make_revisions(1)
+        self.write_upgrade(script, "_backfill()")
+        with open(script.path, "a") as file_:
+            file_.write(
+                "\n\ndef _backfill():\n"
+                "    op.execute('UPDATE account SET x = 1')\n"
+            )
+        assert script_tables(script.path, "upgrade") is None
+
+        (script,) = self.make_revisions(1)
+        self.write_upgrade(
+            script,
+            "with op.batch_alter_table('account') as batch:\n"
+            "        batch.add_column(sa.Column('y', sa.Integer))",
+        )
+        assert script_tables(script.path, "upgrade") == {"account"}
+
+    def test_groups(self):
+        billing = self.branch("billing", create_table("invoice"))
+        users = self.branch("users", create_table("account"))
+        shared = self.branch(
+            "shared", "op.add_column('invoice', sa.Column('x', sa.Integer))"
+        )
+        raw = self.branch("raw", "op.execute('SELECT 1')")
+        moonshine = self.moonshine()
+
+        found = groups(moonshine.script_directory, ())
+
+        assert [group.concurrent for group in found] == [True, True, False]
+        assert {frozenset(group.revisions) for group in found[:2]} == {
+            frozenset([billing.revision, shared.revision]),
+            frozenset([users.revision]),
+        }
+        assert found[2].revisions == {raw.revision}
+
+    def test_same_current_head(self):
+        (base,) = self.make_revisions(1)
+        (left,) = self.make_revisions(1, head=base.revision)
+        (right,) = self.make_revisions(1, head=base.revision, splice=True)
+        moonshine = self.moonshine()
+
+        (group,) = groups(moonshine.script_directory, (base.revision,))
+        assert group.revisions == {left.revision, right.revision}
+
+        found = groups(moonshine.script_directory, ())
+        assert len(found) == 1
+
+    def test_upgrade_branches(self):
+        billing = self.branch("billing", create_table("invoice"))
+        self.branch("users", create_table("account"))
+        (more,) = self.make_revisions(1, head="users@head")
+        self.write_upgrade(
+            more, "op.add_column('account', sa.Column('x', sa.Integer))"
+        )
+        moonshine = self.moonshine()
+
+        results = moonshine.upgrade_branches(max_workers=2)
+
+        assert len(results) == 2
+        assert all(result.ok for result in results), [
+            result.error for result in results
+        ]
+        assert sorted(sc.revision for sc in moonshine.current) == sorted(
+            [billing.revision, more.revision]
+        )
+        engine = create_engine(self.database_url())
+        columns = inspect(engine).get_columns("account")
+        assert "x" in [column["name"] for column in columns]
+        assert "invoice" in inspect(engine).get_table_names()
+
+        assert moonshine.upgrade_branches() == []
+
+    def test_upgrade_branches_version_store(self):
+        scripts = [
+            self.branch(label, create_table(label))
+            for label in ("billing", "users", "audit")
+        ]
+        moonshine = self.moonshine(version_store=True)
+
+        results = moonshine.upgrade_branches(max_workers=3)
+
+        assert all(result.ok for result in results), [
+            result.error for result in results
+        ]
+        expected = sorted(script.revision for script in scripts)
+        assert sorted(sc.revision for sc in moonshine.current) == expected
+        with moonshine.engine.connect() as conn:
+            heads = moonshine.version_store.read_heads(conn)
+        assert sorted(heads) == expected
@@ -0,0 +1,160 @@
+#!/usr/bin/env python
+
+"""Tests for `moonshine.fleet`."""
+
+import threading
+
+from sqlalchemy import create_engine
+
+from moonshine import Moonshine
+from moonshine import moonshine as moonshine_module
+from moonshine.fleet import FleetResult
+from tests.helpers import MoonshineTestCase
+
+
+class TestUpgradeMany(MoonshineTestCase):
+    """Tests for `Moonshine.upgrade_many`."""
+
+    def test_upgrade_many(self):
+        first, second = self.make_revisions(2)
+        moonshine = self.moonshine()
+        targets = [self.database_url("tenant_%d" % i) for i in range(3)]
+
+        results = moonshine.upgrade_many(targets, "head", max_workers=2)
+
+        assert [result.ok for result in results] == [True, True, True]
+        for target in targets:
+            engine = create_engine(target)
+            version = engine.execute("select version_num from alembic_version")
+            assert version.scalar() == second.revision
+
+    def test_upgrade_many_continues_past_failure(self):
+        self.make_revisions(1)
+        moonshine = self.moonshine()
+        targets = [self.database_url("ok"), "sqlite:////nonexistent/dir/x.db"]
+
+        results = moonshine.upgrade_many(targets, "head", max_workers=2)
+
+        assert isinstance(results[0], FleetResult)
+        assert results[0].ok
+        assert not results[1].ok
+        assert "OperationalError" in results[1].error
+
+    def test_env_lock_held_by_other_thread(self):
+        (first,) = self.make_revisions(1)
+        moonshine = self.moonshine()
+        targets = [self.database_url("a"), self.database_url("b")]
+        held, release = threading.Event(), threading.Event()
+
+        def hold():
+            with moonshine_module._env_lock:
+                held.set()
+                release.wait(10)
+
+        holder = threading.Thread(target=hold)
+        holder.start()
+        held.wait(10)
+        results = []
+        upgrade = threading.Thread(
+            target=lambda: results.extend(
+                moonshine.upgrade_many(targets, "head", max_workers=2)
+            ),
+            daemon=True,
+        )
+        upgrade.start()
+        upgrade.join(10)
+        hung = upgrade.is_alive()
+        release.set()
+        holder.join()
+
+        assert not hung
+        assert [result.ok for result in results] == [True, True]
+
+    def test_upgrade_many_sql(self):
+        (first,) = self.make_revisions(1)
+        moonshine = self.moonshine()
+
+        results = moonshine.upgrade_many(
+            [self.database_url("a"), self.database_url("b")], "head", sql=True
+        )
+
+        for result in results:
+            assert "INSERT INTO alembic_version" in result.output
+            assert first.revision in result.output
+
+
+class TestCurrentMany(MoonshineTestCase):
+    """Tests for `Moonshine.current_many`."""
+
+    def test_current_many(self):
+        first, second = self.make_revisions(2)
+        self.moonshine("a").upgrade(first.revision)
+        self.moonshine("b").upgrade(second.revision)
+        moonshine = self.moonshine()
+
+        results = moonshine.current_many(
+            [self.database_url("a"), self.database_url("b")]
+        )
+
+        assert [[sc.revision for sc in r.output] for r in results] == [
+            [first.revision],
+            [second.revision],
+        ]
+
+
+class TestGrouped(MoonshineTestCase):
+    """Tests for `Moonshine.survey` and `Moonshine.upgrade_grouped`."""
+
+    def test_survey(self):
+        first, second = self.make_revisions(2)
+        self.moonshine("a").upgrade(first.revision)
+        self.moonshine("b").upgrade(first.revision)
+        targets = [self.database_url(name) for name in ("a", "b", "c")]
+
+        survey = self.moonshine().survey(targets)
+
+        assert survey.groups == {
+            (first.revision,): targets[:2],
+            (): targets[2:],
+        }
+        assert survey.failed == []
+
+    def test_upgrade_grouped(self):
+        first, second = self.make_revisions(2)
+        self.write_upgrade(first, 'op.execute("CREATE TABLE t (n INTEGER)")')
+        self.write_upgrade(second, 'op.execute("INSERT INTO t VALUES (1)")')
+        self.moonshine("a").upgrade(first.revision)
+        self.moonshine("b").upgrade("head")
+        targets = [self.database_url(name) for name in ("a", "c", "b")]
+        moonshine = self.moonshine()
+
+        results = moonshine.upgrade_grouped(targets)
+
+        assert [result.ok for result in results] == [True, True, True]
+        assert results[0].output.revisions == [second.revision]
+        assert len(results[2].output) == 0
+        for target in targets:
+            engine = create_engine(target)
+            version = engine.execute("select version_num from alembic_version")
+            assert version.scalar() == second.revision
+            assert engine.execute("select count(*) from t").scalar() == 1
+
+    def test_upgrade_grouped_without_engine(self):
+        self.make_revisions(1)
+        moonshine = Moonshine(config_file=self.config_file)
+
+        (result,) = moonshine.upgrade_grouped([self.database_url("a")])
+
+        assert result.ok, result.error
+        assert len(self.moonshine("a").current) == 1
+
+    def test_upgrade_grouped_from_downgraded_base(self):
+        (first,) = self.make_revisions(1)
+        self.moonshine("a").upgrade("head")
+        self.moonshine("a").downgrade("base")
+        moonshine = self.moonshine()
+
+        (result,) = moonshine.upgrade_grouped([self.database_url("a")])
+
+        assert result.ok, result.error
+        assert self.moonshine("a").current[0].revision == first.revision
@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+
+"""Tests for `moonshine.graph`."""
+
+from moonshine.graph import Node, RevisionGraph
+from tests.helpers import MoonshineTestCase
+
+
+class TestRevisionGraph(MoonshineTestCase):
+    """Tests for the compact revision graph."""
+
+    def test_heads_without_revision_map(self):
+        first, second = self.make_revisions(2)
+        moonshine = self.moonshine(compact_revisions=True)
+
+        (head,) = moonshine.heads()
+
+        assert isinstance(head, Node)
+        assert head.revision == second.revision
+        assert head.down_revision == first.revision
+        assert head._script is None
+        revision_map = moonshine.script_directory.revision_map
+        assert "_revision_map" not in vars(revision_map)
+
+        assert head.doc == "revision 1"
+        assert second.revision in head.cmd_format(False)
+
+    def test_current_after_upgrade(self):
+        first, second = self.make_revisions(2)
+        moonshine = self.moonshine(compact_revisions=True)
+        moonshine.upgrade(first.revision)
+
+        (current,) = moonshine.current
+        assert current.revision == first.revision
+        assert not current.is_head
+        assert "(head)" not in current.cmd_format(False)
+
+        moonshine.upgrade("head")
+        assert [sc.revision for sc in moonshine.current] == [second.revision]
+
+    def test_branches_labels_and_prefixes(self):
+        (base,) = self.make_revisions(1)
+        (left,) = self.make_revisions(1, head=base.revision)
+        (right,) = self.make_revisions(
+            1, head=base.revision, splice=True, branch_label="right"
+        )
+        moonshine = self.moonshine()
+        graph = RevisionGraph(moonshine.script_directory)
+
+        assert len(graph) == 3
+        assert sorted(graph.heads) == sorted([left.revision, right.revision])
+        assert graph.bases == (base.revision,)
+        assert graph.get(base.revision).is_branch_point
+        assert graph.get("right") is graph.get(right.revision)
+        assert graph.get(left.revision[:6]).revision == left.revision
+        assert graph.get_revisions("base") == ()
+        with self.assertRaises(KeyError):
+            graph.get_revisions("head")
+
+    def test_new_revisions_picked_up(self):
+        (first,) = self.make_revisions(1)
+        moonshine = self.moonshine(compact_revisions=True)
+        assert moonshine.heads()[0].revision == first.revision
+
+        second = moonshine.revision(message="next")
+        assert moonshine.heads()[0].revision == second.revision
+
+    def test_history_indicates_current(self):
+        first, second = self.make_revisions(2)
+        for compact in (False, True):
+            moonshine = self.moonshine(compact_revisions=compact)
+            moonshine.upgrade(first.revision)
+
+            history = moonshine.history(indicate_current=True)
+            assert [
+                (sc.revision, sc._db_current_indicator) for sc in history
+            ] == [(first.revision, True), (second.revision, False)]
+
+            history = moonshine.history("current:heads")
+            assert [sc.revision for sc in history] == [
+                first.revision,
+                second.revision,
+            ]
+            moonshine.downgrade("base")
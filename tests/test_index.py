@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+
+"""Tests for `moonshine.index`."""
+
+import json
+import os
+
+from moonshine.index import INDEX_FILE, IndexedScript, RevisionIndex
+from tests.helpers import MoonshineTestCase
+
+
+class TestRevisionIndex(MoonshineTestCase):
+    """Tests for the persistent revision index."""
+
+    def test_heads_without_import(self):
+        first, second = self.make_revisions(2)
+        moonshine = self.moonshine(revision_index=True)
+
+        (head,) = moonshine.heads()
+
+        assert isinstance(head, IndexedScript)
+        assert head.revision == second.revision
+        assert head.doc == "revision 1"
+        assert head._module is None
+        assert os.path.exists(os.path.join(self.directory, INDEX_FILE))
+
+    def test_false_option(self):
+        moonshine = self.moonshine()
+        moonshine.config.set_main_option("revision_index", "false")
+        assert moonshine._revision_index_path() is None
+        moonshine.config.set_main_option("revision_index", "true")
+        assert moonshine._revision_index_path() is True
+        moonshine.config.set_main_option("revision_index", "index.json")
+        assert moonshine._revision_index_path() == "index.json"
+
+    def test_only_changed_files_are_parsed(self):
+        first, second = self.make_revisions(2)
+        moonshine = self.moonshine(revision_index=True)
+        moonshine.heads()
+        index_path = os.path.join(self.directory, INDEX_FILE)
+
+        with open(second.path, "a") as file_:
+            file_.write("\n# touched\n")
+        index = RevisionIndex(index_path).load()
+        index.refresh(moonshine.script_directory)
+        assert index.parsed == 1
+
+        with open(index_path) as file_:
+            assert len(json.load(file_)["files"]) == 2
+
+    def test_upgrade_loads_modules_on_demand(self):
+        first, second = self.make_revisions(2)
+        moonshine = self.moonshine(revision_index=True)
+
+        moonshine.upgrade("head")
+
+        assert [sc.revision for sc in moonshine.current] == [second.revision]
+        assert [sc.revision for sc in moonshine.history()] == [
+            first.revision,
+            second.revision,
+        ]
@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+
+"""Tests for `moonshine.instrument`."""
+
+import json
+
+from moonshine.instrument import ReportCollector
+from tests.helpers import MoonshineTestCase
+
+
+class TestInstrumentation(MoonshineTestCase):
+    """Tests for migration events and the report collector."""
+
+    def test_events(self):
+        first, second = self.make_revisions(2)
+        self.write_upgrade(first, 'op.execute("CREATE TABLE t (n INTEGER)")')
+        self.write_upgrade(second, 'op.execute("INSERT INTO t VALUES (1)")')
+        moonshine = self.moonshine()
+        events = []
+        moonshine.listen("revision_start", lambda name, p: events.append(name))
+        moonshine.listen("revision_end", lambda name, p: events.append(p))
+
+        moonshine.upgrade("head")
+
+        assert events[0] == "revision_start"
+        assert events[1]["revision"] == first.revision
+        assert events[1]["direction"] == "upgrade"
+        assert events[2] == "revision_start"
+        assert events[3]["revision"] == second.revision
+        assert events[3]["rowcount"] >= 1
+
+    def test_report_collector(self):
+        (first,) = self.make_revisions(1)
+        self.write_upgrade(first, 'op.execute("CREATE TABLE t (n INTEGER)")')
+        moonshine = self.moonshine()
+        collector = ReportCollector().attach(moonshine)
+
+        moonshine.upgrade("head")
+
+        report = json.loads(collector.to_json())
+        (revision,) = report["revisions"]
+        assert revision["revision"] == first.revision
+        assert any(
+            "CREATE TABLE t" in statement["statement"]
+            for statement in revision["statement_log"]
+        )
+        assert (
+            'moonshine_revision_duration_seconds{revision="%s"'
+            % first.revision
+            in collector.prometheus()
+        )
+
+    def test_failed_revision(self):
+        (first,) = self.make_revisions(1)
+        self.write_upgrade(first, 'op.execute("SELECT * FROM missing")')
+        moonshine = self.moonshine()
+        collector = ReportCollector().attach(moonshine)
+
+        with self.assertRaises(Exception):
+            moonshine.upgrade("head")
+
+        assert collector.report()["errors"] == 1
@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+
+"""Tests for `moonshine.lock`."""
+
+import os
+import threading
+import time
+import unittest
+
+from alembic import util
+from sqlalchemy import create_engine, event
+
+from moonshine.lock import PostgresAdvisoryLock, TableLock
+from tests.helpers import MoonshineTestCase
+
+
+class TestMigrationLock(MoonshineTestCase):
+    """Tests for the lock taken around migrations."""
+
+    def test_upgrade(self):
+        first, second = self.make_revisions(2)
+        moonshine = self.moonshine(migration_lock=True)
+
+        moonshine.upgrade(first.revision)
+
+        statements = []
+        event.listen(
+            moonshine.engine,
+            "before_cursor_execute",
+            lambda conn, cursor, statement, *args: statements.append(
+                statement
+            ),
+        )
+        moonshine.upgrade("head")
+        assert any("moonshine_lock" in statement for statement in statements)
+        assert moonshine.current[0].revision == second.revision
+        count = "SELECT count(*) FROM moonshine_lock"
+        assert moonshine.engine.execute(count).scalar() == 0
+
+        del statements[:]
+        moonshine.upgrade("head")
+        assert not any("moonshine_lock" in s for s in statements)
+
+    def test_timeout(self):
+        lock = TableLock(timeout=0)
+        engine = self.moonshine().engine
+
+        with lock.hold(engine):
+            other = TableLock(timeout=0.05, poll_interval=0.01)
+            other._owner = lambda: "other"
+            with self.assertRaises(util.CommandError):
+                with other.hold(engine):
+                    pass
+
+        with other.hold(engine):
+            pass
+
+    def test_expired_lease(self):
+        engine = self.moonshine().engine
+        with engine.connect() as conn:
+            assert TableLock(lease=-1).try_acquire(conn)
+            assert TableLock().try_acquire(conn)
+            assert not TableLock().try_acquire(conn)
+
+    def test_waiting_process_skips(self):
+        self.make_revisions(2)
+        lock = TableLock(poll_interval=0.01)
+        waiter = self.moonshine(migration_lock=lock)
+        events = []
+        waiter.listen(
+            "revision_start", lambda event, payload: events.append(1)
+        )
+        errors = []
+
+        def upgrade():
+            try:
+                waiter.upgrade("head")
+            except Exception as err:
+                errors.append(err)
+
+        with lock.hold(waiter.engine):
+            thread = threading.Thread(target=upgrade)
+            thread.start()
+            time.sleep(0.1)
+            assert thread.is_alive()
+            self.moonshine().upgrade("head")
+        thread.join()
+
+        assert errors == []
+        assert events == []
+        assert len(waiter.current) == 1
+
+
+@unittest.skipUnless(
+    os.environ.get("MOONSHINE_TEST_POSTGRES_URL"),
+    "set MOONSHINE_TEST_POSTGRES_URL to test against PostgreSQL",
+)
+class TestPostgresAdvisoryLock(unittest.TestCase):
+    """Tests for `PostgresAdvisoryLock` against a local PostgreSQL."""
+
+    def test_not_idle_in_transaction(self):
+        engine = create_engine(os.environ["MOONSHINE_TEST_POSTGRES_URL"])
+        lock = PostgresAdvisoryLock()
+        with engine.connect() as conn:
+            assert lock.try_acquire(conn)
+            with conn.begin():
+                pid = conn.execute("SELECT pg_backend_pid()").scalar()
+            try:
+                state = engine.execute(
+                    "SELECT state FROM pg_stat_activity WHERE pid = %s",
+                    pid,
+                ).scalar()
+                assert state == "idle"
+            finally:
+                lock.release(conn)
@@ -3,11 +3,22 @@
 """Tests for `moonshine` package."""
 
 
+import asyncio
+import io
+import subprocess
+import sys
+import threading
 import unittest
+from concurrent.futures import ThreadPoolExecutor
+from unittest import mock
+
+from alembic.ddl.sqlite import SQLiteImpl
 from click.testing import CliRunner
 
 from moonshine import moonshine
 from moonshine import cli
+from moonshine.lock import TableLock
+from tests.helpers import MoonshineTestCase
 
 
 class TestMoonshine(unittest.TestCase):
@@ -30,3 +41,276 @@ class TestMoonshine(unittest.TestCase):
         help_result = runner.invoke(cli.main, ["--help"])
         assert help_result.exit_code == 0
         assert "--help  Show this message and exit." in help_result.output
+
+    def test_cli_import_is_light(self):
+        """alembic and SQLAlchemy are loaded only when a command runs."""
+        output = subprocess.check_output(
+            [
+                sys.executable,
+                "-c",
+                "import sys, moonshine.cli; "
+                "print('alembic' in sys.modules, 'sqlalchemy' in sys.modules)",
+            ],
+            universal_newlines=True,
+        )
+        assert output.split() == ["False", "False"]
+
+
+class TestOfflineSQL(MoonshineTestCase):
+    """Tests for ``--sql`` output."""
+
+    def test_upgrade_sql_returned(self):
+        (first,) = self.make_revisions(1)
+        output = self.moonshine().upgrade("head", sql=True)
+        assert "Running upgrade  -> %s" % first.revision in output
+
+    def test_upgrade_sql_streamed_to_file(self):
+        (first,) = self.make_revisions(1)
+        buffer = io.StringIO()
+        output = self.moonshine().upgrade(
+            "head", sql=True, output_buffer=buffer
+        )
+        assert output is None
+        assert "Running upgrade  -> %s" % first.revision in buffer.getvalue()
+
+    def test_downgrade_sql_streamed_to_callable(self):
+        first, second = self.make_revisions(2)
+        statements = []
+        self.moonshine().downgrade(
+            "%s:%s" % (second.revision, first.revision),
+            sql=True,
+            output_buffer=statements.append,
+        )
+        assert "-- Running downgrade %s -> %s\n\n" % (
+            second.revision,
+            first.revision,
+        ) in statements
+
+
+class TestReuseEnvironment(MoonshineTestCase):
+    """Tests for running a compiled ``env.py``."""
+
+    def test_env_compiled_once(self):
+        first, second = self.make_revisions(2)
+        moonshine = self.moonshine(reuse_environment=True)
+
+        moonshine.upgrade(first.revision)
+        code = moonshine._Moonshine__env_code
+        moonshine.upgrade(second.revision)
+
+        assert moonshine._Moonshine__env_code is code
+        assert [sc.revision for sc in moonshine.current] == [second.revision]
+
+    def test_invalidate(self):
+        self.make_revisions(1)
+        moonshine = self.moonshine(reuse_environment=True)
+        moonshine.upgrade("head", sql=True)
+
+        moonshine.invalidate()
+
+        assert moonshine._Moonshine__env_code is None
+        assert "INSERT INTO alembic_version" in moonshine.upgrade(
+            "head", sql=True
+        )
+
+
+class TestCurrent(MoonshineTestCase):
+    """Tests for ``current``."""
+
+    def test_current_cached_until_upgrade(self):
+        first, second = self.make_revisions(2)
+        moonshine = self.moonshine(current_ttl=60)
+        moonshine.upgrade(first.revision)
+        assert [sc.revision for sc in moonshine.current] == [first.revision]
+
+        self.moonshine().upgrade(second.revision)
+        assert [sc.revision for sc in moonshine.current] == [first.revision]
+
+        moonshine.upgrade(second.revision)
+        assert [sc.revision for sc in moonshine.current] == [second.revision]
+
+
+class TestHistory(MoonshineTestCase):
+    """Tests for ``history``, ``iter_history`` and ``branches``."""
+
+    def test_history_chronological(self):
+        revisions = [sc.revision for sc in self.make_revisions(4)]
+        moonshine = self.moonshine()
+        assert [sc.revision for sc in moonshine.history()] == revisions
+        assert [sc.revision for sc in moonshine.history()] == revisions
+
+    def test_history_follows_new_revisions(self):
+        revisions = [sc.revision for sc in self.make_revisions(2)]
+        moonshine = self.moonshine()
+        moonshine.history()
+        revisions.append(moonshine.revision(message="later").revision)
+        assert [sc.revision for sc in moonshine.history()] == revisions
+
+    def test_iter_history_limit(self):
+        revisions = self.make_revisions(5)
+        latest = list(self.moonshine().iter_history(limit=2))
+        assert [sc.revision for sc in latest] == [
+            revisions[4].revision,
+            revisions[3].revision,
+        ]
+
+    def test_branches(self):
+        root, left = self.make_revisions(2)
+        moonshine = self.moonshine()
+        assert moonshine.branches == []
+        moonshine.revision(message="right", head=root.revision, splice=True)
+        assert [sc.revision for sc in moonshine.branches] == [root.revision]
+
+
+class TestTransactionPerMigration(MoonshineTestCase):
+    """Tests for ``transaction_per_migration``."""
+
+    # SQLite runs without transactions around the steps otherwise
+    @mock.patch.object(SQLiteImpl, "transactional_ddl", True)
+    def test_failed_upgrade_resumes(self):
+        first, second = self.make_revisions(2)
+        self.write_upgrade(first, 'op.execute("SELECT 1")')
+        self.write_upgrade(second, 'op.execute("SELECT * FROM missing")')
+        moonshine = self.moonshine()
+
+        # in a single transaction the first revision is rolled back too
+        with self.assertRaises(Exception):
+            moonshine.upgrade("head")
+        assert moonshine.current == ()
+
+        moonshine = self.moonshine(transaction_per_migration=True)
+
+        with self.assertRaises(Exception):
+            moonshine.upgrade("head")
+        assert [sc.revision for sc in moonshine.current] == [first.revision]
+
+        with open(second.path) as file_:
+            source = file_.read()
+        with open(second.path, "w") as file_:
+            file_.write(source.replace("SELECT * FROM missing", "SELECT 1"))
+        moonshine = self.moonshine(transaction_per_migration=True)
+        moonshine.upgrade("head")
+        assert [sc.revision for sc in moonshine.current] == [second.revision]
+
+
+class TestConnection(MoonshineTestCase):
+    """Tests for running on a given connection."""
+
+    def test_upgrade_on_connection(self):
+        first, second = self.make_revisions(2)
+        moonshine = self.moonshine()
+        with moonshine.engine.connect() as conn:
+            moonshine.upgrade(first.revision, connection=conn)
+        assert [sc.revision for sc in moonshine.current] == [first.revision]
+
+
+@unittest.skipIf(
+    moonshine._async_api()[0] is None, "async support needs SQLAlchemy 1.4"
+)
+class TestAsync(MoonshineTestCase):
+    """Tests for the asyncio variants of the commands."""
+
+    def async_url(self, name="test"):
+        return self.database_url(name).replace("sqlite:", "sqlite+aiosqlite:")
+
+    def test_upgrade_and_current(self):
+        first, second = self.make_revisions(2)
+        ms = self.moonshine()
+        url = self.async_url()
+
+        async def run():
+            await ms.upgrade_async(first.revision, engine=url)
+            before = await ms.current_async(url)
+            await ms.upgrade_async("head", engine=url)
+            return before, await ms.current_async(url)
+
+        before, after = asyncio.run(run())
+        assert [sc.revision for sc in before] == [first.revision]
+        assert [sc.revision for sc in after] == [second.revision]
+
+    def test_current_many(self):
+        (first,) = self.make_revisions(1)
+        self.moonshine("a").upgrade("head")
+        urls = [self.async_url("a"), self.async_url("b")]
+        results = asyncio.run(self.moonshine().current_many_async(urls))
+        assert [sc.revision for sc in results[0].output] == [first.revision]
+        assert results[1].output == ()
+
+    def test_waits_without_blocking(self):
+        (first,) = self.make_revisions(1)
+        lock = TableLock(poll_interval=0.01)
+        ms = self.moonshine(migration_lock=lock)
+        engine = ms.engine
+        ticks = []
+
+        async def tick(task):
+            while not task.done():
+                ticks.append(1)
+                await asyncio.sleep(0.01)
+
+        async def run():
+            task = asyncio.ensure_future(
+                ms.upgrade_async("head", engine=self.async_url())
+            )
+            with lock.hold(engine):
+                await asyncio.sleep(0.1)
+                assert not task.done()
+                # held by another thread, as the tasks of this loop take
+                # turns already
+                holder.start()
+                held.wait(10)
+            ticker = asyncio.ensure_future(tick(task))
+            await asyncio.sleep(0.1)
+            assert not task.done()
+            release.set()
+            await asyncio.gather(task, ticker)
+
+        def hold():
+            with moonshine._env_lock:
+                held.set()
+                release.wait(10)
+
+        held, release = threading.Event(), threading.Event()
+        holder = threading.Thread(target=hold)
+        asyncio.run(run())
+        holder.join()
+        assert len(ticks) > 5
+        assert [sc.revision for sc in ms.current] == [first.revision]
+
+    def test_engine_config(self):
+        config = {
+            "sqlalchemy.url": self.async_url(),
+            "sqlalchemy.echo": "true",
+        }
+        engine = self.moonshine()._get_async_engine(config)
+        assert str(engine.url) == self.async_url()
+        assert engine.sync_engine.echo is True
+
+
+class TestThreads(MoonshineTestCase):
+    """Tests for sharing an instance between threads."""
+
+    def test_target_metadata_per_instance(self):
+        assert (
+            self.moonshine().target_metadata
+            is not self.moonshine().target_metadata
+        )
+
+    def test_concurrent_upgrades(self):
+        first, second = self.make_revisions(2)
+        moonshine = self.moonshine()
+        urls = [self.database_url("tenant_%d" % i) for i in range(8)]
+
+        def upgrade(url):
+            output = moonshine.upgrade("head", sql=True, engine=url)
+            moonshine.upgrade("head", engine=url)
+            return output
+
+        with ThreadPoolExecutor(4) as executor:
+            outputs = list(executor.map(upgrade, urls))
+
+        assert all(second.revision in output for output in outputs)
+        for url in urls:
+            heads = moonshine._get_current_heads(moonshine._get_engine(url))
+            assert heads == (second.revision,)
+        assert "engine" not in moonshine.config.attributes
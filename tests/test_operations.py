@@ -0,0 +1,252 @@
+#!/usr/bin/env python
+
+"""Tests for `moonshine.operations`."""
+
+import os
+import unittest
+
+from alembic import util
+from sqlalchemy import Column, Integer, MetaData, Table, create_engine
+
+from moonshine.operations import (
+    _save_checkpoint,
+    batched_update,
+    online_alter,
+    progress_table,
+)
+from tests.helpers import MoonshineTestCase
+
+
+class TestBatchedUpdate(MoonshineTestCase):
+    """Tests for `batched_update`."""
+
+    def setUp(self):
+        super().setUp()
+        self.engine = create_engine(self.database_url())
+        self.engine.execute(
+            "CREATE TABLE item (id INTEGER PRIMARY KEY, flag INTEGER)"
+        )
+        self.engine.execute(
+            "INSERT INTO item (id, flag) VALUES %s"
+            % ", ".join("(%d, 0)" % i for i in range(1, 2501))
+        )
+
+    def flagged(self):
+        return self.engine.execute(
+            "SELECT count(*) FROM item WHERE flag = 1"
+        ).scalar()
+
+    def test_chunks(self):
+        seen = []
+        with self.engine.connect() as conn:
+            stats = batched_update(
+                "item",
+                {"flag": 1},
+                chunk_size=1000,
+                progress=seen.append,
+                bind=conn,
+            )
+        assert stats["rows"] == 2500
+        assert stats["chunks"] == 3
+        assert [s["last_key"] for s in seen] == [1000, 2000, 2500]
+        assert self.flagged() == 2500
+
+    def test_where(self):
+        with self.engine.connect() as conn:
+            batched_update(
+                "item",
+                {"flag": 1},
+                where=lambda t: t.c.id % 2 == 0,
+                chunk_size=700,
+                bind=conn,
+            )
+        assert self.flagged() == 1250
+
+    def test_resume_from_checkpoint(self):
+        with self.engine.connect() as conn:
+            batched_update("item", {"flag": 0}, chunk_size=5000, bind=conn)
+            _save_checkpoint(conn, "item:flag", 2000, 2000)
+            stats = batched_update(
+                "item", {"flag": 1}, chunk_size=1000, bind=conn
+            )
+        assert stats["rows"] == 2500
+        assert self.flagged() == 500
+
+    def test_in_revision(self):
+        (first,) = self.make_revisions(1)
+        self.write_upgrade(
+            first,
+            "from moonshine.operations import batched_update\n"
+            '    batched_update("item", {"flag": 1}, chunk_size=1000)',
+        )
+        self.moonshine().upgrade("head")
+        assert self.flagged() == 2500
+        assert [sc.revision for sc in self.moonshine().current] == [
+            first.revision
+        ]
+
+
+class TestOnlineAlter(MoonshineTestCase):
+    """Tests for `online_alter`."""
+
+    def setUp(self):
+        super().setUp()
+        self.engine = create_engine(self.database_url())
+        self.engine.execute(
+            "CREATE TABLE item (id INTEGER PRIMARY KEY, name VARCHAR(20))"
+        )
+        self.engine.execute("CREATE INDEX ix_item_name ON item (name)")
+        self.engine.execute(
+            "INSERT INTO item (id, name) VALUES %s"
+            % ", ".join("(%d, 'item %d')" % (i, i) for i in range(1, 2501))
+        )
+
+    def add_flag(self, op, name):
+        op.add_column(name, Column("flag", Integer, server_default="7"))
+
+    def test_alter(self):
+        seen = []
+        with self.engine.connect() as conn:
+            stats = online_alter(
+                "item",
+                self.add_flag,
+                chunk_size=1000,
+                progress=seen.append,
+                bind=conn,
+            )
+        assert stats["rows"] == 2500
+        assert [s["last_key"] for s in seen] == [1000, 2000, 2500]
+
+        item = Table("item", MetaData(), autoload_with=self.engine)
+        assert [c.name for c in item.columns] == ["id", "name", "flag"]
+        assert [i.name for i in item.indexes] == ["ix_item_name"]
+        assert self.engine.execute(
+            "SELECT count(*), sum(flag) FROM item"
+        ).first() == (2500, 2500 * 7)
+        tables = self.engine.table_names()
+        assert "_item_new" not in tables and "_item_old" not in tables
+
+    def test_writes_during_copy(self):
+        def write(stats):
+            if stats["chunks"] == 1:
+                self.engine.execute("DELETE FROM item WHERE id = 10")
+                self.engine.execute(
+                    "UPDATE item SET name = 'changed' WHERE id IN (20, 2200)"
+                )
+                self.engine.execute(
+                    "INSERT INTO item (id, name) VALUES (3000, 'new')"
+                )
+
+        with self.engine.connect() as conn:
+            online_alter(
+                "item",
+                self.add_flag,
+                chunk_size=1000,
+                progress=write,
+                bind=conn,
+            )
+
+        rows = dict(
+            tuple(row)
+            for row in self.engine.execute("SELECT id, name FROM item")
+        )
+        assert len(rows) == 2500
+        assert 10 not in rows
+        assert rows[20] == rows[2200] == "changed"
+        assert rows[3000] == "new"
+
+    def test_stale_checkpoint(self):
+        progress_table.create(self.engine)
+        with self.engine.connect() as conn:
+            _save_checkpoint(conn, "online_alter:item", 2000, 2000)
+            stats = online_alter(
+                "item", self.add_flag, chunk_size=1000, bind=conn
+            )
+        assert stats["rows"] == 2500
+        assert self.engine.execute("SELECT count(*) FROM item").scalar() == (
+            2500
+        )
+
+    def test_lost_rows(self):
+        def lose(stats):
+            if stats["chunks"] == 1:
+                self.engine.execute("DELETE FROM _item_new WHERE id = 10")
+
+        with self.engine.connect() as conn:
+            with self.assertRaises(util.CommandError):
+                online_alter(
+                    "item",
+                    self.add_flag,
+                    chunk_size=1000,
+                    progress=lose,
+                    bind=conn,
+                )
+        item = Table("item", MetaData(), autoload_with=self.engine)
+        assert "flag" not in item.columns
+        assert "_item_new" not in self.engine.table_names()
+
+        with self.engine.connect() as conn:
+            stats = online_alter("item", self.add_flag, bind=conn)
+        assert stats["rows"] == 2500
+        assert self.engine.execute(
+            "SELECT count(*), sum(flag) FROM item"
+        ).first() == (2500, 2500 * 7)
+
+    def test_in_revision(self):
+        (first,) = self.make_revisions(1)
+        self.write_upgrade(
+            first,
+            "from moonshine.operations import online_alter\n"
+            "    online_alter(\n"
+            '        "item",\n'
+            "        lambda op, name: op.add_column(\n"
+            '            name, sa.Column("flag", sa.Integer)\n'
+            "        ),\n"
+            "    )",
+        )
+        self.moonshine().upgrade("head")
+        item = Table("item", MetaData(), autoload_with=self.engine)
+        assert "flag" in item.columns
+        assert [sc.revision for sc in self.moonshine().current] == [
+            first.revision
+        ]
+
+
+@unittest.skipUnless(
+    os.environ.get("MOONSHINE_TEST_POSTGRES_URL"),
+    "set MOONSHINE_TEST_POSTGRES_URL to test against PostgreSQL",
+)
+class TestOnlineAlterPostgres(unittest.TestCase):
+    """Tests for `online_alter` against a local PostgreSQL."""
+
+    def setUp(self):
+        self.engine = create_engine(os.environ["MOONSHINE_TEST_POSTGRES_URL"])
+        self.engine.execute("DROP TABLE IF EXISTS item")
+        self.engine.execute(
+            "CREATE TABLE item (id SERIAL PRIMARY KEY, name VARCHAR(20))"
+        )
+        self.engine.execute("CREATE INDEX ix_item_name ON item (name)")
+        self.engine.execute(
+            "INSERT INTO item (name) SELECT 'item ' || n "
+            "FROM generate_series(1, 2500) AS n"
+        )
+
+    def tearDown(self):
+        self.engine.execute("DROP TABLE IF EXISTS item")
+        self.engine.execute("DROP TABLE IF EXISTS moonshine_batch_progress")
+
+    def test_alter(self):
+        with self.engine.connect() as conn:
+            stats = online_alter(
+                "item",
+                lambda op, name: op.add_column(name, Column("flag", Integer)),
+                chunk_size=1000,
+                bind=conn,
+            )
+        assert stats["rows"] == 2500
+        item = Table("item", MetaData(), autoload_with=self.engine)
+        assert "flag" in item.columns
+        assert [i.name for i in item.indexes] == ["ix_item_name"]
+        # the serial sequence moved over with the table
+        self.engine.execute("INSERT INTO item (name) VALUES ('next')")
+        assert self.engine.execute("SELECT max(id) FROM item").scalar() == 2501
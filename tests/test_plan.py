@@ -0,0 +1,58 @@
+"""Tests for `moonshine.plan`."""
+
+from alembic import util
+
+from tests.helpers import MoonshineTestCase
+
+
+class TestPlan(MoonshineTestCase):
+    """Tests for ``Moonshine.plan``."""
+
+    def test_upgrade_plan(self):
+        first, second = self.make_revisions(2)
+        self.write_upgrade(second, 'op.execute("SELECT 1")')
+        plan = self.moonshine().plan("head", from_="base")
+        assert plan.direction == "upgrade"
+        assert plan.revisions == [first.revision, second.revision]
+        assert [step["operations"] for step in plan] == [[], ["execute"]]
+        assert plan.steps[1]["doc"] == "revision 1"
+
+    def test_downgrade_plan(self):
+        first, second = self.make_revisions(2)
+        plan = self.moonshine().plan("base", from_=second.revision)
+        assert plan.direction == "downgrade"
+        assert plan.revisions == [second.revision, first.revision]
+
+    def test_plan_from_database(self):
+        first, second = self.make_revisions(2)
+        moonshine = self.moonshine()
+        moonshine.upgrade(first.revision)
+        assert moonshine.plan("head").revisions == [second.revision]
+        moonshine.upgrade("head")
+        assert len(moonshine.plan("head")) == 0
+
+    def test_plans_cached_and_grouped(self):
+        first, second = self.make_revisions(2)
+        moonshine = self.moonshine()
+        plan = moonshine.plan("head", from_=first.revision)
+        assert moonshine.plan("head", from_=[first.revision]) is plan
+        assert len({plan, moonshine.plan("head", from_="base")}) == 2
+
+        third = moonshine.revision(message="third")
+        assert moonshine.plan("head", from_=first.revision).revisions == [
+            second.revision,
+            third.revision,
+        ]
+
+    def test_timings(self):
+        first, second = self.make_revisions(2)
+        plan = self.moonshine().plan(
+            "head", from_="base", timings={first.revision: 1.5}
+        )
+        assert plan.estimated_seconds == 1.5
+        assert plan.to_dict()["steps"][1]["estimated_seconds"] is None
+
+    def test_invalid_target(self):
+        self.make_revisions(1)
+        with self.assertRaises(util.CommandError):
+            self.moonshine().plan("nosuchrevision", from_="base")
@@ -0,0 +1,181 @@
+#!/usr/bin/env python
+
+"""Tests for `moonshine.reflection`."""
+
+import os
+import unittest
+
+from sqlalchemy import (
+    Column,
+    Integer,
+    MetaData,
+    String,
+    Table,
+    create_engine,
+    event,
+    inspect,
+)
+
+from moonshine.operations import progress_table
+from moonshine.reflection import CACHE_FILE, BulkInspector, ReflectionCache
+from tests.helpers import MoonshineTestCase
+
+
+class TestAutogenerate(MoonshineTestCase):
+    """Tests for revision(autogenerate=True)."""
+
+    def target_metadata(self):
+        metadata = MetaData()
+        Table(
+            "account",
+            metadata,
+            Column("id", Integer, primary_key=True),
+            Column("name", String(50)),
+        )
+        return metadata
+
+    def test_autogenerate(self):
+        moonshine = self.moonshine(
+            target_metadata=self.target_metadata(), reflection_cache=True
+        )
+
+        script = moonshine.revision("add account", autogenerate=True)
+
+        with open(script.path) as file_:
+            source = file_.read()
+        assert "op.create_table('account'" in source
+        assert os.path.exists(os.path.join(self.directory, CACHE_FILE))
+
+        moonshine.upgrade("head")
+        script = moonshine.revision("nothing", autogenerate=True)
+        with open(script.path) as file_:
+            assert "create_table" not in file_.read()
+
+        cache = ReflectionCache(os.path.join(self.directory, CACHE_FILE))
+        ((heads, entries),) = cache.load().databases.values()
+        assert ("get_columns", None, "account") in entries
+
+    def test_bookkeeping_tables_ignored(self):
+        self.make_revisions(1)
+        moonshine = self.moonshine(
+            target_metadata=MetaData(),
+            version_store=True,
+            migration_lock=True,
+        )
+        moonshine.upgrade("head")
+        progress_table.create(moonshine.engine)
+
+        script = moonshine.revision("nothing", autogenerate=True)
+
+        with open(script.path) as file_:
+            assert "drop_table" not in file_.read()
+
+    def test_false_option(self):
+        moonshine = self.moonshine()
+        moonshine.config.set_main_option("reflection_cache", "false")
+        assert moonshine._reflection_cache().path is None
+        moonshine.config.set_main_option("reflection_cache", "true")
+        assert moonshine._reflection_cache().path == os.path.join(
+            self.directory, CACHE_FILE
+        )
+
+
+class TestBulkInspector(MoonshineTestCase):
+    """Tests for the caching inspector."""
+
+    def setUp(self):
+        super().setUp()
+        self.engine = create_engine(self.database_url())
+        self.engine.execute("CREATE TABLE account (id INTEGER PRIMARY KEY)")
+        self.statements = []
+        event.listen(
+            self.engine,
+            "before_cursor_execute",
+            lambda conn, cursor, statement, *args: self.statements.append(
+                statement
+            ),
+        )
+
+    def test_entries_reused(self):
+        with self.engine.connect() as conn:
+            inspector = BulkInspector(conn)
+            assert inspector.get_table_names() == ["account"]
+            (column,) = inspector.get_columns("account")
+            assert column["name"] == "id"
+            column["name"] = "changed"
+
+            reflected = len(self.statements)
+            inspector = BulkInspector(conn, inspector.entries)
+            assert inspector.get_table_names() == ["account"]
+            (column,) = inspector.get_columns("account")
+            assert column["name"] == "id"
+            assert not any(
+                "table_info" in statement
+                for statement in self.statements[reflected:]
+            )
+
+    def test_new_table_drops_entries(self):
+        with self.engine.connect() as conn:
+            inspector = BulkInspector(conn)
+            inspector.get_table_names()
+            inspector.get_columns("account")
+            conn.execute("CREATE TABLE invoice (id INTEGER PRIMARY KEY)")
+
+            inspector = BulkInspector(conn, inspector.entries)
+            inspector.get_table_names()
+            assert ("get_columns", None, "account") not in inspector.entries
+
+
+class TestReflectionCache(MoonshineTestCase):
+    """Tests for the reflection cache file."""
+
+    def test_heads(self):
+        path = os.path.join(self.tempdir, CACHE_FILE)
+        cache = ReflectionCache(path)
+        cache.entries("db", ("a",))["key"] = "value"
+        cache.save()
+
+        cache = ReflectionCache(path).load()
+        assert cache.entries("db", ("a",)) == {"key": "value"}
+        assert cache.entries("db", ("b",)) == {}
+        assert cache.entries("db", ("a",)) == {}
+
+
+@unittest.skipUnless(
+    os.environ.get("MOONSHINE_TEST_POSTGRES_URL"),
+    "set MOONSHINE_TEST_POSTGRES_URL to test against PostgreSQL",
+)
+class TestPrefetchPostgres(unittest.TestCase):
+    """Tests that bulk reflection matches per-table reflection."""
+
+    def setUp(self):
+        self.engine = create_engine(os.environ["MOONSHINE_TEST_POSTGRES_URL"])
+        self.engine.execute("DROP TABLE IF EXISTS item, tag")
+        self.engine.execute(
+            "CREATE TABLE item (id SERIAL PRIMARY KEY, "
+            "name VARCHAR(20) NOT NULL DEFAULT 'x', price NUMERIC(10, 2))"
+        )
+        self.engine.execute("COMMENT ON TABLE item IS 'things'")
+        self.engine.execute(
+            "CREATE TABLE tag (a INTEGER, b TEXT, PRIMARY KEY (b, a))"
+        )
+
+    def tearDown(self):
+        self.engine.execute("DROP TABLE IF EXISTS item, tag")
+
+    def test_prefetch(self):
+        with self.engine.connect() as conn:
+            stock = inspect(conn)
+            bulk = BulkInspector(conn)
+            for table in ("item", "tag"):
+                for method in (
+                    "get_columns",
+                    "get_pk_constraint",
+                    "get_table_comment",
+                ):
+                    expected = getattr(stock, method)(table)
+                    assert repr(getattr(bulk, method)(table)) == repr(
+                        expected
+                    )
+            assert ("get_columns", None, "item") in bulk.entries
+            assert None in bulk.prefetched
@@ -0,0 +1,111 @@
+"""Tests for the runtime CLI commands and `moonshine serve`."""
+
+import os
+import threading
+
+from click.testing import CliRunner
+
+from moonshine import cli, server
+from tests.helpers import MoonshineTestCase
+
+
+class TestRuntimeCommands(MoonshineTestCase):
+    """Tests for upgrade, downgrade, stamp, current, history and heads."""
+
+    def invoke(self, *args):
+        result = CliRunner().invoke(
+            cli.main, args + ("-c", self.config_file), catch_exceptions=False
+        )
+        assert result.exit_code == 0, result.output
+        return result.output
+
+    def test_upgrade_current_downgrade(self):
+        first, second = self.make_revisions(2)
+        url = self.database_url()
+        self.invoke("upgrade", first.revision, "--url", url)
+        assert first.revision in self.invoke("current", "--url", url)
+
+        self.invoke("upgrade", "--url", url)
+        assert second.revision in self.invoke("current", "--url", url)
+
+        self.invoke("downgrade", "base", "--url", url)
+        assert self.invoke("current", "--url", url) == ""
+
+    def test_upgrade_sql(self):
+        self.make_revisions(1)
+        output = self.invoke("upgrade", "--sql", "--url", self.database_url())
+        assert "INSERT INTO alembic_version" in output
+
+    def test_stamp_heads_history(self):
+        first, second = self.make_revisions(2)
+        url = self.database_url()
+        self.invoke("stamp", first.revision, "--url", url)
+        assert first.revision in self.invoke("current", "--url", url)
+        assert second.revision in self.invoke("heads")
+        history = self.invoke("history")
+        assert first.revision in history and second.revision in history
+
+    def test_missing_url(self):
+        self.make_revisions(1)
+        result = CliRunner().invoke(
+            cli.main, ["current", "-c", self.config_file]
+        )
+        assert result.exit_code != 0
+        assert "needs a database url" in result.output
+
+
+class TestServe(MoonshineTestCase):
+    """Tests for commands answered by the daemon."""
+
+    def setUp(self):
+        super().setUp()
+        self.socket_path = os.path.join(self.tempdir, "moonshine.sock")
+        self.server = server.Server(self.moonshine(), self.socket_path)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+        super().tearDown()
+
+    def invoke(self, *args):
+        result = CliRunner().invoke(
+            cli.main, args + ("--socket", self.socket_path)
+        )
+        return result
+
+    def test_upgrade_and_current(self):
+        (first,) = self.make_revisions(1)
+        url = self.database_url()
+        assert self.invoke("upgrade", "--url", url).exit_code == 0
+        result = self.invoke("current", "--url", url)
+        assert result.exit_code == 0
+        assert first.revision in result.output
+
+    def test_new_revisions_picked_up(self):
+        (first,) = self.make_revisions(1)
+        assert first.revision in self.invoke("heads").output
+        (second,) = self.make_revisions(1)
+        assert second.revision in self.invoke("heads").output
+
+    def test_changed_revisions_picked_up(self):
+        first, second = self.make_revisions(2)
+        assert self.invoke("heads").output.split()[0] == second.revision
+        with open(second.path) as file_:
+            source = file_.read()
+        with open(second.path, "w") as file_:
+            file_.write(
+                source.replace(
+                    "down_revision = '%s'" % first.revision,
+                    "down_revision = None",
+                )
+            )
+        output = self.invoke("heads").output
+        assert first.revision in output and second.revision in output
+
+    def test_error(self):
+        result = self.invoke("upgrade", "nosuchrevision", "--url", "sqlite://")
+        assert result.exit_code != 0
+        assert "nosuchrevision" in result.output
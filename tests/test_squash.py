@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+
+"""Tests for `moonshine.squash`."""
+
+import os
+
+from alembic import util
+from sqlalchemy import create_engine, inspect
+
+from moonshine.squash import REPLACED_DIRECTORY
+from tests.helpers import MoonshineTestCase
+
+
+class TestSquash(MoonshineTestCase):
+    """Tests for squashing revisions into a baseline."""
+
+    def setUp(self):
+        super().setUp()
+        self.first, self.second, self.third = self.make_revisions(3)
+        self.write_upgrade(
+            self.first,
+            "op.create_table('account', "
+            "sa.Column('id', sa.Integer, primary_key=True), "
+            "sa.Column('name', sa.String(50), nullable=False))",
+        )
+        self.write_upgrade(
+            self.second,
+            "op.create_index('ix_account_name', 'account', ['name'])",
+        )
+        self.write_upgrade(
+            self.third,
+            "op.create_table('invoice', "
+            "sa.Column('id', sa.Integer, primary_key=True), "
+            "sa.Column('account_id', sa.Integer, "
+            "sa.ForeignKey('account.id')))",
+        )
+
+    def test_squash(self):
+        self.moonshine("existing").upgrade("head")
+        moonshine = self.moonshine("fresh")
+
+        baseline = moonshine.squash(self.second.revision)
+
+        assert baseline.revision == self.second.revision
+        assert baseline.down_revision is None
+        replaced = os.listdir(os.path.join(self.directory, "versions"))
+        assert os.path.basename(self.first.path) not in replaced
+        assert os.path.basename(self.second.path) not in replaced
+        assert sorted(
+            os.listdir(
+                os.path.join(self.directory, "versions", REPLACED_DIRECTORY)
+            )
+        ) == sorted(
+            os.path.basename(sc.path) for sc in (self.first, self.second)
+        )
+        (head,) = moonshine.heads()
+        assert head.revision == self.third.revision
+        assert head.down_revision == baseline.revision
+
+        moonshine.upgrade("head")
+        engine = create_engine(self.database_url("fresh"))
+        assert set(inspect(engine).get_table_names()) == {
+            "account",
+            "invoice",
+            "alembic_version",
+        }
+        (index,) = inspect(engine).get_indexes("account")
+        assert index["name"] == "ix_account_name"
+        moonshine.downgrade("base")
+        assert "account" not in inspect(engine).get_table_names()
+
+        existing = self.moonshine("existing")
+        assert [sc.revision for sc in existing.current] == [
+            self.third.revision
+        ]
+
+    def test_bookkeeping_tables_left_out(self):
+        self.write_upgrade(
+            self.second,
+            "from moonshine.operations import batched_update\n"
+            "    batched_update('account', {'name': 'x'})",
+        )
+        moonshine = self.moonshine(version_store=True, migration_lock=True)
+
+        baseline = moonshine.squash(self.second.revision)
+
+        with open(baseline.path) as file_:
+            source = file_.read()
+        assert "create_table('account'" in source
+        assert "moonshine_" not in source
+
+    def test_dangling_branch(self):
+        moonshine = self.moonshine()
+        moonshine.revision(
+            message="branch", head=self.first.revision, splice=True
+        )
+
+        with self.assertRaises(util.CommandError):
+            moonshine.squash(self.second.revision)
+        assert os.path.exists(self.first.path)
+
+    def test_base(self):
+        with self.assertRaises(util.CommandError):
+            self.moonshine().squash(self.first.revision)
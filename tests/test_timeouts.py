@@ -0,0 +1,114 @@
+"""Tests for `moonshine.timeouts`."""
+
+import unittest
+
+from moonshine import timeouts
+from moonshine.instrument import ReportCollector
+from tests.helpers import MoonshineTestCase
+
+LOCK_TIMEOUT = """import os
+    if not os.path.exists("attempted"):
+        open("attempted", "w").close()
+
+        class LockNotAvailable(Exception):
+            pgcode = "55P03"
+
+        raise LockNotAvailable("canceling statement due to lock timeout")"""
+
+
+class _Context:
+    """Records the statements executed by a `Guard`."""
+
+    class dialect:
+        name = "postgresql"
+
+    def __init__(self):
+        self.executed = []
+
+    def execute(self, statement):
+        self.executed.append(statement)
+
+
+class _Step:
+    def __init__(self, module):
+        self.revision = type("Script", (), dict(module=module))()
+
+
+class TestTimeouts(unittest.TestCase):
+    """Tests for the timeout statements and errors."""
+
+    def test_set_statements(self):
+        assert timeouts.set_statements("postgresql", 2, None) == [
+            "SET lock_timeout = '2000ms'",
+            "SET statement_timeout = DEFAULT",
+        ]
+        assert timeouts.set_statements("mysql", 0.5, 60) == [
+            "SET SESSION lock_wait_timeout = 1",
+            "SET SESSION innodb_lock_wait_timeout = 1",
+            "SET SESSION max_execution_time = 60000",
+        ]
+        assert timeouts.set_statements("sqlite", 2, 60) == []
+
+    def test_timeout_kind(self):
+        class Orig(Exception):
+            pgcode = "57014"
+
+        class Wrapped(Exception):
+            orig = Orig()
+
+        assert timeouts.timeout_kind(Wrapped()) == timeouts.STATEMENT
+        assert timeouts.timeout_kind(Exception(1205, "Lock wait")) == "lock"
+        assert timeouts.timeout_kind(ValueError("other")) is None
+        assert timeouts.timeout_kind(ValueError({"code": 1205})) is None
+
+    def test_backoff(self):
+        for attempt in range(10):
+            assert 0 <= timeouts.backoff(attempt, 1.0, cap=5.0) <= 5.0
+
+    def test_guard_per_revision(self):
+        class Default:
+            pass
+
+        class Slow:
+            lock_timeout = 10
+
+        context = _Context()
+        guard = timeouts.Guard(lock_timeout=2)
+        steps = [_Step(Default), _Step(Default), _Step(Slow)]
+        assert list(guard.steps(iter(steps), context)) == steps
+        assert context.executed == [
+            "SET lock_timeout = '2000ms'",
+            "SET statement_timeout = DEFAULT",
+            "SET lock_timeout = '10000ms'",
+            "SET statement_timeout = DEFAULT",
+            "SET lock_timeout = DEFAULT",
+            "SET statement_timeout = DEFAULT",
+        ]
+
+
+class TestRetry(MoonshineTestCase):
+    """Tests for retrying runs that hit a timeout."""
+
+    def test_retry_after_lock_timeout(self):
+        first, second = self.make_revisions(2)
+        self.write_upgrade(second, LOCK_TIMEOUT)
+        moonshine = self.moonshine(
+            transaction_per_migration=True, retries=1, retry_backoff=0
+        )
+        collector = ReportCollector().attach(moonshine)
+
+        moonshine.upgrade("head")
+
+        assert [sc.revision for sc in moonshine.current] == [second.revision]
+        report = collector.report()
+        assert [wait["revision"] for wait in report["lock_waits"]] == [
+            second.revision
+        ]
+        assert report["lock_waits"][0]["attempt"] == 0
+        assert "moonshine_lock_timeouts_total 1" in collector.prometheus()
+
+    def test_no_retries(self):
+        first, second = self.make_revisions(2)
+        self.write_upgrade(second, LOCK_TIMEOUT)
+        with self.assertRaises(Exception):
+            self.moonshine().upgrade("head")
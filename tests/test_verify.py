@@ -0,0 +1,63 @@
+#!/usr/bin/env python
+
+"""Tests for `moonshine.verify`."""
+
+import os
+
+from alembic import util
+
+from moonshine.index import INDEX_FILE, RevisionIndex
+from tests.helpers import MoonshineTestCase
+
+
+class TestVerify(MoonshineTestCase):
+    """Tests for `Moonshine.verify` and `Moonshine.verify_many`."""
+
+    def test_verify(self):
+        first, second = self.make_revisions(2)
+        moonshine = self.moonshine(version_store=True, revision_index=True)
+        moonshine.upgrade("head")
+        assert moonshine.verify() == []
+
+        self.write_upgrade(first, 'op.execute("SELECT 1")')
+        os.remove(second.path)
+
+        drift = moonshine.verify()
+        assert sorted((d.revision, d.missing) for d in drift) == sorted(
+            [(first.revision, False), (second.revision, True)]
+        )
+        index = RevisionIndex(os.path.join(self.directory, INDEX_FILE))
+        ((path, entry),) = index.load().entries.items()
+        assert (
+            entry["sha1"]
+            == [d.current for d in drift if d.revision == first.revision][0]
+        )
+
+    def test_downgraded_revision_ignored(self):
+        first, second = self.make_revisions(2)
+        moonshine = self.moonshine(version_store=True)
+        moonshine.upgrade("head")
+        moonshine.downgrade(first.revision)
+
+        self.write_upgrade(second, 'op.execute("SELECT 1")')
+        assert moonshine.verify() == []
+
+    def test_requires_store(self):
+        moonshine = self.moonshine()
+        with self.assertRaises(util.CommandError):
+            moonshine.verify()
+
+    def test_verify_many(self):
+        first, second = self.make_revisions(2)
+        self.moonshine("a", version_store=True).upgrade(first.revision)
+        moonshine = self.moonshine(version_store=True)
+        moonshine.upgrade_grouped([self.database_url("b")])
+        self.write_upgrade(second, 'op.execute("SELECT 1")')
+
+        results = moonshine.verify_many(
+            [self.database_url("a"), self.database_url("b")]
+        )
+
+        assert [result.ok for result in results] == [True, True]
+        assert results[0].output == []
+        assert [d.revision for d in results[1].output] == [second.revision]
@@ -0,0 +1,180 @@
+#!/usr/bin/env python
+
+"""Tests for `moonshine.version_store`."""
+
+import os
+from unittest import mock
+
+from alembic.ddl.sqlite import SQLiteImpl
+from sqlalchemy import create_engine, event, inspect
+
+from moonshine.version_store import TableVersionStore, VersionStore
+from tests.helpers import MoonshineTestCase
+
+
+class TestTableVersionStore(MoonshineTestCase):
+    """Tests for the single-row version table and the apply history."""
+
+    def statements(self, engine):
+        statements = []
+        event.listen(
+            engine,
+            "before_cursor_execute",
+            lambda conn, cursor, statement, *args: statements.append(
+                statement
+            ),
+        )
+        return statements
+
+    def test_default_store(self):
+        self.make_revisions(1)
+        moonshine = self.moonshine()
+        assert type(moonshine.version_store) is VersionStore
+
+        moonshine.upgrade("head")
+
+        assert (
+            "moonshine_version"
+            not in inspect(moonshine.engine).get_table_names()
+        )
+        assert moonshine.apply_history() == []
+
+    def test_upgrade_downgrade(self):
+        first, second = self.make_revisions(2)
+        moonshine = self.moonshine(version_store=True)
+
+        moonshine.upgrade("head")
+
+        statements = self.statements(moonshine.engine)
+        assert moonshine.current[0].revision == second.revision
+        assert len(statements) == 1
+        assert "moonshine_version" in statements[0]
+
+        moonshine.downgrade(first.revision)
+        assert moonshine.current[0].revision == first.revision
+
+        history = moonshine.apply_history()
+        assert [(h["revision"], h["direction"]) for h in history] == [
+            (second.revision, "downgrade"),
+            (second.revision, "upgrade"),
+            (first.revision, "upgrade"),
+        ]
+        assert history[0]["duration"] >= 0
+        assert history[0]["host"]
+        assert len(history[0]["checksum"]) == 40
+        assert len(moonshine.apply_history(limit=1)) == 1
+
+    def test_transaction_per_migration(self):
+        first, second = self.make_revisions(2)
+        self.write_upgrade(second, 'op.execute("SELECT nothing FROM nowhere")')
+        moonshine = self.moonshine(
+            version_store=True, transaction_per_migration=True
+        )
+
+        with self.assertRaises(Exception):
+            moonshine.upgrade("head")
+
+        assert moonshine.current[0].revision == first.revision
+
+    @mock.patch.object(SQLiteImpl, "transactional_ddl", True)
+    def test_recorded_in_step_transaction(self):
+        self.make_revisions(2)
+        moonshine = self.moonshine(
+            version_store=True, transaction_per_migration=True
+        )
+        events = self.statements(moonshine.engine)
+        for name in ("begin", "commit"):
+            event.listen(
+                moonshine.engine,
+                name,
+                lambda conn, name=name: events.append(name),
+            )
+
+        moonshine.upgrade("head")
+
+        markers = [
+            i for i, e in enumerate(events) if e in ("begin", "commit")
+        ]
+        inserts = [
+            i
+            for i, e in enumerate(events)
+            if e.startswith("INSERT INTO moonshine_history")
+        ]
+        assert len(inserts) == 2
+        for insert in inserts:
+            before = [events[i] for i in markers if i < insert]
+            after = [events[i] for i in markers if i > insert]
+            assert before[-1] == "begin"
+            assert after[0] == "commit"
+
+    def test_env_without_callback(self):
+        self.make_revisions(1)
+        env_py = os.path.join(self.directory, "env.py")
+        with open(env_py) as file_:
+            source = file_.read()
+        with open(env_py, "w") as file_:
+            file_.write(
+                source.replace("on_version_apply=on_version_apply,", "")
+            )
+        moonshine = self.moonshine(version_store=True)
+
+        moonshine.upgrade("head")
+
+        assert len(moonshine.apply_history()) == 1
+
+    def test_checksum_mismatch(self):
+        first, second = self.make_revisions(2)
+        moonshine = self.moonshine(version_store=True)
+        moonshine.upgrade("head")
+        moonshine.engine.execute(
+            "UPDATE moonshine_version SET heads = '[\"%s\"]'" % first.revision
+        )
+
+        with self.assertLogs("moonshine.version_store", "WARNING"):
+            assert moonshine.current[0].revision == second.revision
+
+    def test_ini_option(self):
+        with open(self.config_file) as file_:
+            config = file_.read()
+        with open(self.config_file, "w") as file_:
+            file_.write(
+                config.replace("[alembic]", "[alembic]\nversion_store = true")
+            )
+
+        assert isinstance(self.moonshine().version_store, TableVersionStore)
+
+    def test_upgrade_grouped(self):
+        first, second = self.make_revisions(2)
+        self.moonshine("a").upgrade(first.revision)
+        moonshine = self.moonshine(version_store=True)
+
+        moonshine.upgrade_grouped([self.database_url("a")])
+
+        engine = create_engine(self.database_url("a"))
+        with engine.connect() as conn:
+            heads = moonshine.version_store.read_heads(conn)
+        assert heads == (second.revision,)
+
+    def test_catch_up_without_steps(self):
+        first, second = self.make_revisions(2)
+        self.moonshine(version_store=True).upgrade(first.revision)
+        self.moonshine().upgrade("head")
+        moonshine = self.moonshine(version_store=True)
+        assert moonshine.current[0].revision == first.revision
+
+        moonshine.upgrade("head")
+
+        assert moonshine.current[0].revision == second.revision
+
+    def test_lock_reads_alembic_version(self):
+        first, second = self.make_revisions(2)
+        self.moonshine(version_store=True).upgrade("head")
+        self.moonshine().downgrade(first.revision)
+        moonshine = self.moonshine(version_store=True, migration_lock=True)
+
+        moonshine.upgrade("head")
+
+        assert moonshine.current[0].revision == second.revision
+        engine = create_engine(self.database_url())
+        version = engine.execute("select version_num from alembic_version")
+        assert version.scalar() == second.revision